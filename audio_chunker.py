@@ -0,0 +1,136 @@
+import os
+import re
+import glob
+import logging
+from transcode_pool import transcode_executor, PRIORITY_AUDIO
+from video_compressor import run_command
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 时长达到该阈值（秒）的音频使用长音频模式：分段并发分析后按顺序合并
+LONG_AUDIO_MIN_SECONDS = int(os.environ.get("LONG_AUDIO_MIN_SECONDS", "300"))
+
+# 每段的目标时长和上限（秒），优先在目标时长附近的静音处切分
+AUDIO_CHUNK_TARGET_SECONDS = int(os.environ.get("AUDIO_CHUNK_TARGET_SECONDS", "240"))
+AUDIO_CHUNK_MAX_SECONDS = int(AUDIO_CHUNK_TARGET_SECONDS * 1.25)
+AUDIO_CHUNK_MIN_SECONDS = int(AUDIO_CHUNK_TARGET_SECONDS * 0.5)
+
+# 同时发送给Gemini分析的分段数上限
+AUDIO_CHUNK_CONCURRENCY = int(os.environ.get("AUDIO_CHUNK_CONCURRENCY", "4"))
+
+# 静音检测参数：低于该音量且持续超过该时长视为静音
+SILENCE_NOISE_DB = -30
+SILENCE_MIN_DURATION = 0.5
+
+SILENCE_PATTERN = re.compile(r"silence_(start|end): (-?[\d.]+)")
+
+def is_long_audio(duration):
+    """判断音频是否需要使用长音频模式"""
+    return bool(duration and duration >= LONG_AUDIO_MIN_SECONDS)
+
+async def detect_silences(audio_path):
+    """
+    使用ffmpeg silencedetect 检测音频中的静音区间
+
+    返回:
+        [(静音开始秒, 静音结束秒), ...]，按时间顺序排列
+    """
+    cmd = [
+        'ffmpeg', '-i', audio_path,
+        '-vn', '-ac', '1', '-ar', '16000',
+        '-af', f'silencedetect=noise={SILENCE_NOISE_DB}dB:d={SILENCE_MIN_DURATION}',
+        '-f', 'null', '-'
+    ]
+    logging.info(f"开始检测静音区间: {' '.join(cmd)}")
+    returncode, _, stderr = await transcode_executor.run(cmd, PRIORITY_AUDIO)
+    if returncode != 0:
+        raise Exception(f"静音检测失败: {stderr.decode('utf-8', errors='replace')[-500:]}")
+
+    silences = []
+    silence_start = None
+    for kind, value in SILENCE_PATTERN.findall(stderr.decode('utf-8', errors='replace')):
+        if kind == "start":
+            silence_start = max(0.0, float(value))
+        elif silence_start is not None:
+            silences.append((silence_start, float(value)))
+            silence_start = None
+    logging.info(f"检测到 {len(silences)} 个静音区间")
+    return silences
+
+def plan_chunk_boundaries(duration, silences, target=AUDIO_CHUNK_TARGET_SECONDS,
+                          min_length=AUDIO_CHUNK_MIN_SECONDS, max_length=AUDIO_CHUNK_MAX_SECONDS):
+    """
+    规划分段切分点
+
+    每一段在 [min_length, max_length] 范围内选择最接近目标时长的静音中点作为切分点，
+    范围内没有静音时在目标时长处硬切。
+
+    返回:
+        切分时间点列表（秒，不含0和总时长）
+    """
+    cut_points = [(start + end) / 2 for start, end in silences]
+    boundaries = []
+    chunk_start = 0.0
+
+    while duration - chunk_start > max_length:
+        candidates = [t for t in cut_points if min_length <= t - chunk_start <= max_length]
+        if candidates:
+            cut = min(candidates, key=lambda t: abs(t - chunk_start - target))
+        else:
+            cut = chunk_start + target
+        boundaries.append(round(cut, 3))
+        chunk_start = cut
+
+    return boundaries
+
+async def split_audio(audio_path, output_dir, boundaries, output_args):
+    """
+    在给定时间点将音频切分为多段（一次ffmpeg调用，同时转码为 output_args 指定的格式）
+
+    返回:
+        [(分段路径, 开始秒), ...]，按时间顺序排列
+    """
+    pattern = os.path.join(output_dir, "chunk_%03d.mp3")
+    cmd = ['ffmpeg', '-i', audio_path] + output_args
+    if boundaries:
+        cmd += ['-f', 'segment', '-segment_times', ','.join(str(t) for t in boundaries), '-reset_timestamps', '1']
+    cmd += ['-y', pattern if boundaries else pattern % 0]
+
+    logging.info(f"开始切分音频为 {len(boundaries) + 1} 段: {' '.join(cmd)}")
+    await run_command(cmd, priority=PRIORITY_AUDIO)
+
+    chunk_paths = sorted(glob.glob(os.path.join(output_dir, "chunk_*.mp3")))
+    starts = [0.0] + boundaries
+    return list(zip(chunk_paths, starts))
+
+async def chunk_audio(audio_path, output_dir, duration, output_args):
+    """
+    在静音处把长音频切分为有上限的分段
+
+    参数:
+        audio_path: 音频文件路径
+        output_dir: 分段输出目录
+        duration: 音频时长（秒）
+        output_args: 分段的ffmpeg输出参数（编码、声道、采样率等）
+
+    返回:
+        [(分段路径, 开始秒, 结束秒), ...]
+    """
+    try:
+        silences = await detect_silences(audio_path)
+    except Exception as e:
+        logging.warning(f"{e}，将按固定时长切分")
+        silences = []
+
+    boundaries = plan_chunk_boundaries(duration, silences)
+    chunks = await split_audio(audio_path, output_dir, boundaries, output_args)
+    ends = [start for _, start in chunks[1:]] + [duration]
+    return [(path, start, end) for (path, start), end in zip(chunks, ends)]
+
+def format_timestamp(seconds):
+    """将秒数格式化为 时:分:秒 或 分:秒"""
+    seconds = int(seconds)
+    hours, remainder = divmod(seconds, 3600)
+    minutes, secs = divmod(remainder, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes:02d}:{secs:02d}"
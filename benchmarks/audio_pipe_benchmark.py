@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+音频转码微基准测试：对比临时文件方式与管道方式转换语音消息
+
+生成与Telegram语音消息相同格式（OGG/Opus、单声道）的5-60秒测试音频，
+分别用旧的临时文件方式（写入输入文件 -> ffmpeg -> 写入输出文件 -> 读回）
+和 media_handler.convert_audio_to_mp3 的管道方式转换为MP3，比较平均耗时。
+
+用法:
+    python benchmarks/audio_pipe_benchmark.py --durations 5 15 30 60 --iterations 20
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from video_compressor import run_command
+from media_workspace import MediaWorkspace
+from media_handler import convert_audio_to_mp3, SPEECH_AUDIO_ARGS
+
+# 配置日志
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+async def make_voice_note(path, duration):
+    """生成类似语音消息的OGG/Opus测试音频（带噪声的变调正弦波）"""
+    cmd = [
+        'ffmpeg', '-f', 'lavfi', '-i', f'sine=frequency=220:beep_factor=4:duration={duration}',
+        '-f', 'lavfi', '-i', f'anoisesrc=color=pink:amplitude=0.05:duration={duration}',
+        '-filter_complex', 'amix=inputs=2',
+        '-ac', '1', '-ar', '48000',
+        '-c:a', 'libopus', '-b:a', '24k',
+        '-y', path
+    ]
+    await run_command(cmd)
+
+async def convert_with_tempfiles(audio_bytes, original_ext):
+    """旧的转换方式：输入和输出都经过临时文件"""
+    with tempfile.NamedTemporaryFile(suffix=original_ext, delete=False) as input_file:
+        input_path = input_file.name
+        input_file.write(audio_bytes)
+
+    output_fd, output_path = tempfile.mkstemp(suffix='.mp3')
+    os.close(output_fd)
+
+    try:
+        cmd = ['ffmpeg', '-i', input_path] + SPEECH_AUDIO_ARGS + ['-y', output_path]
+        await run_command(cmd)
+        with open(output_path, 'rb') as f:
+            return f.read()
+    finally:
+        os.unlink(input_path)
+        os.unlink(output_path)
+
+async def convert_with_pipes(audio_bytes, original_ext):
+    """新的转换方式：通过管道读写ffmpeg"""
+    with MediaWorkspace("bench") as workspace:
+        return await convert_audio_to_mp3(audio_bytes, original_ext, workspace)
+
+async def time_conversions(convert_func, audio_bytes, iterations):
+    """重复执行转换并返回每次耗时（毫秒）列表"""
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = await convert_func(audio_bytes, '.ogg')
+        timings.append((time.perf_counter() - start) * 1000)
+        if not result:
+            raise RuntimeError(f"{convert_func.__name__} 转换失败")
+    return timings
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        print(f"{'时长(秒)':>8} {'大小KB':>8} {'方式':<10} {'平均(ms)':>9} {'中位数(ms)':>10} {'P95(ms)':>9}")
+        for duration in args.durations:
+            clip_path = os.path.join(work_dir, f"voice_{duration}.ogg")
+            await make_voice_note(clip_path, duration)
+            with open(clip_path, 'rb') as f:
+                audio_bytes = f.read()
+
+            for name, func in [("tempfile", convert_with_tempfiles), ("pipe", convert_with_pipes)]:
+                timings = await time_conversions(func, audio_bytes, args.iterations)
+                p95 = sorted(timings)[max(0, int(len(timings) * 0.95) - 1)]
+                print(f"{duration:>8} {len(audio_bytes) / 1024:>8.1f} {name:<10} "
+                      f"{statistics.mean(timings):>9.1f} {statistics.median(timings):>10.1f} {p95:>9.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="语音消息转码方式微基准测试")
+    parser.add_argument("--durations", type=int, nargs="+", default=[5, 15, 30, 60], help="测试音频时长（秒）")
+    parser.add_argument("--iterations", type=int, default=20, help="每种方式的重复次数")
+    asyncio.run(main(parser.parse_args()))
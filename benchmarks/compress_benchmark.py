@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+视频压缩基准测试：对比码率规划压缩（compress_video）与旧的逐级压缩（compress_video_cascade）
+
+使用ffmpeg生成合成测试视频，分别用两种方案压缩到同一目标大小，
+记录墙钟时间、ffmpeg子进程CPU时间和输出大小。
+
+用法:
+    python benchmarks/compress_benchmark.py --target-mb 4 --durations 20 60
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from video_compressor import compress_video, compress_video_cascade, run_command
+from transcode_cache import transcode_cache
+
+# 配置日志
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 每种方案重复压缩同一个视频，关闭转码缓存以测量真实的编码耗时
+transcode_cache.max_bytes = 0
+
+async def make_synthetic_clip(path, duration, size="1920x1080", rate=30):
+    """生成带噪声纹理和正弦音轨的高码率合成视频（噪声使画面难以压缩，接近真实素材）"""
+    cmd = [
+        'ffmpeg', '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate={rate}:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-vf', 'noise=alls=30:allf=t',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '10',
+        '-c:a', 'aac', '-b:a', '128k',
+        '-shortest', '-y', path
+    ]
+    await run_command(cmd)
+
+def children_cpu_seconds():
+    """返回已结束子进程累计的用户态+内核态CPU时间"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+async def measure(compress_func, input_path, output_path, target_mb, **kwargs):
+    """执行一次压缩并返回 (墙钟时间, CPU时间, 输出大小MB)"""
+    cpu_before = children_cpu_seconds()
+    start = time.perf_counter()
+    result_path = await compress_func(input_path, output_path, target_size_mb=target_mb, **kwargs)
+    wall = time.perf_counter() - start
+    cpu = children_cpu_seconds() - cpu_before
+    size_mb = os.path.getsize(result_path) / (1024 * 1024) if result_path else float('nan')
+    return wall, cpu, size_mb
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        print(f"{'时长(秒)':>8} {'原始MB':>8} {'方案':<12} {'墙钟(秒)':>9} {'CPU(秒)':>9} {'输出MB':>8}")
+        for duration in args.durations:
+            clip_path = os.path.join(work_dir, f"clip_{duration}.mp4")
+            await make_synthetic_clip(clip_path, duration, args.size)
+            source_mb = os.path.getsize(clip_path) / (1024 * 1024)
+
+            variants = [
+                ("cascade", compress_video_cascade, {}),
+                ("single-pass", compress_video, {"two_pass": False}),
+                ("two-pass", compress_video, {"two_pass": True}),
+            ]
+            for name, func, kwargs in variants:
+                output_path = os.path.join(work_dir, f"out_{name}_{duration}.mp4")
+                wall, cpu, size_mb = await measure(func, clip_path, output_path, args.target_mb, **kwargs)
+                print(f"{duration:>8} {source_mb:>8.1f} {name:<12} {wall:>9.2f} {cpu:>9.2f} {size_mb:>8.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="视频压缩方案基准测试")
+    parser.add_argument("--target-mb", type=float, default=4, help="压缩目标大小（MB）")
+    parser.add_argument("--durations", type=int, nargs="+", default=[20, 60], help="合成视频时长（秒）")
+    parser.add_argument("--size", default="1920x1080", help="合成视频分辨率")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+传输阶段基准测试：对比"先下载再上传"与流式传输（边下载边上传）
+
+在本地启动一个限速的替身HTTP服务器，同时扮演Telegram文件下载接口和Gemini可续传上传接口，
+分别测量两种方式完成同一文件传输所需的时间。
+
+用法:
+    python benchmarks/stream_transfer_benchmark.py --sizes 10 15 20 --download-mbps 40 --upload-mbps 40
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+import threading
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streaming_transfer
+from streaming_transfer import stream_transfer, start_upload_session, TRANSFER_TIMEOUT
+
+# 配置日志（被测模块导入时已配置为INFO，这里调高级别避免逐个请求的日志干扰结果输出）
+logging.getLogger().setLevel(logging.WARNING)
+
+THROTTLE_CHUNK = 64 * 1024
+UPLOAD_GRANULARITY = 256 * 1024
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """限速的Telegram下载接口与Gemini可续传上传接口替身"""
+    protocol_version = "HTTP/1.1"
+    payloads = {}  # 路径 -> 文件内容
+    download_rate = 0  # 字节/秒
+    upload_rate = 0
+    sessions = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        data = self.payloads.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        for offset in range(0, len(data), THROTTLE_CHUNK):
+            self.wfile.write(data[offset:offset + THROTTLE_CHUNK])
+            time.sleep(THROTTLE_CHUNK / self.download_rate)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        command = self.headers.get("X-Goog-Upload-Command", "")
+
+        if command == "start":
+            self.rfile.read(length)
+            session_id = uuid.uuid4().hex
+            self.sessions[session_id] = 0
+            self.send_response(200)
+            self.send_header("X-Goog-Upload-URL", f"http://{self.headers['Host']}/session/{session_id}")
+            self.send_header("X-Goog-Upload-Chunk-Granularity", str(UPLOAD_GRANULARITY))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        session_id = self.path.rsplit("/", 1)[-1]
+        remaining = length
+        while remaining:
+            chunk = self.rfile.read(min(THROTTLE_CHUNK, remaining))
+            remaining -= len(chunk)
+            time.sleep(len(chunk) / self.upload_rate)
+        self.sessions[session_id] += length
+
+        body = b""
+        self.send_response(200)
+        if "finalize" in command:
+            body = json.dumps({"file": {"name": f"files/{session_id}", "sizeBytes": str(self.sessions[session_id])}}).encode()
+            self.send_header("X-Goog-Upload-Status", "final")
+            self.send_header("Content-Type", "application/json")
+        else:
+            self.send_header("X-Goog-Upload-Status", "active")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+async def sequential_transfer(client, download_url, size):
+    """旧方式：完整下载到内存后再一次性上传"""
+    response = await client.get(download_url)
+    response.raise_for_status()
+    upload_url, _ = await start_upload_session(client, size, "video/mp4", "bench", api_key="bench")
+    response = await client.post(
+        upload_url,
+        headers={"X-Goog-Upload-Command": "upload, finalize", "X-Goog-Upload-Offset": "0"},
+        content=response.content,
+    )
+    response.raise_for_status()
+
+async def streamed_transfer(client, download_url, size):
+    """新方式：边下载边上传"""
+    await stream_transfer(download_url, size, "video/mp4", "bench", client=client, api_key="bench")
+
+async def main(args):
+    StandInHandler.download_rate = args.download_mbps * 1024 * 1024 / 8
+    StandInHandler.upload_rate = args.upload_mbps * 1024 * 1024 / 8
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    streaming_transfer.GEMINI_UPLOAD_URL = f"{base_url}/upload"
+
+    print(f"下载带宽 {args.download_mbps} Mbps, 上传带宽 {args.upload_mbps} Mbps")
+    print(f"{'大小MB':>6} {'方式':<12} {'平均(秒)':>9} {'中位数(秒)':>10} {'加速比':>7}")
+
+    async with httpx.AsyncClient(timeout=TRANSFER_TIMEOUT) as client:
+        for size_mb in args.sizes:
+            size = int(size_mb * 1024 * 1024)
+            path = f"/file/{size_mb}"
+            StandInHandler.payloads[path] = os.urandom(size)
+            download_url = base_url + path
+
+            results = {}
+            for name, func in [("sequential", sequential_transfer), ("streaming", streamed_transfer)]:
+                timings = []
+                for _ in range(args.iterations):
+                    start = time.perf_counter()
+                    await func(client, download_url, size)
+                    timings.append(time.perf_counter() - start)
+                results[name] = timings
+
+            baseline = statistics.mean(results["sequential"])
+            for name, timings in results.items():
+                mean = statistics.mean(timings)
+                print(f"{size_mb:>6} {name:<12} {mean:>9.2f} {statistics.median(timings):>10.2f} {baseline / mean:>6.2f}x")
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="流式传输与先下载后上传的传输时间对比")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[10, 15, 20], help="测试文件大小（MB）")
+    parser.add_argument("--download-mbps", type=float, default=40, help="替身下载接口带宽（Mbps）")
+    parser.add_argument("--upload-mbps", type=float, default=40, help="替身上传接口带宽（Mbps）")
+    parser.add_argument("--iterations", type=int, default=3, help="每种方式的重复次数")
+    asyncio.run(main(parser.parse_args()))
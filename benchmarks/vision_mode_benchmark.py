@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+图片分析模式基准测试：对比两段式（Gemini描述 → Poe文本回复）与直接发送（图片附件 → Poe视觉模型）
+
+在本地启动一个替身HTTP服务器，同时扮演Gemini流式生成接口、Poe附件上传接口和Poe机器人接口，
+按配置的首字延迟、生成速度和上传带宽模拟上游，分别测量两种模式从拿到图片到回复结束的端到端延迟，
+以及用户看到最终回复第一个字的时间。
+
+两段式使用 gemini_stream.generate_content_stream，直接发送与机器人相同，
+先用 vision_direct.upload_images 上传附件，再用 vision_direct.build_vision_message 构建消息，
+Poe回复都通过 fastapi_poe.get_bot_response 流式接收，与机器人中的调用方式一致。
+
+用法:
+    python benchmarks/vision_mode_benchmark.py --images 1 4 --gemini-ttft 1.0 --poe-ttft 1.5
+"""
+import os
+import sys
+import json
+import time
+import types
+import asyncio
+import logging
+import argparse
+import threading
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import fastapi_poe as fp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vision_direct
+from gemini_stream import generate_content_stream
+
+# 配置日志（被测模块导入时已配置为INFO，这里调高级别避免逐个请求的日志干扰结果输出）
+logging.getLogger().setLevel(logging.WARNING)
+
+THROTTLE_CHUNK = 64 * 1024
+TOKENS_PER_EVENT = 5
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Gemini流式生成、Poe附件上传与Poe机器人接口的替身"""
+    protocol_version = "HTTP/1.0"  # 响应以关闭连接结束，流式输出无需分块编码
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self, rate=None):
+        remaining = int(self.headers.get("Content-Length", 0))
+        body = bytearray()
+        while remaining:
+            chunk = self.rfile.read(min(THROTTLE_CHUNK, remaining))
+            remaining -= len(chunk)
+            body.extend(chunk)
+            if rate:
+                time.sleep(len(chunk) / rate)
+        return bytes(body)
+
+    def stream_tokens(self, ttft, token_count, content_type, render):
+        """等待首字延迟后按生成速度逐段输出"""
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.end_headers()
+        time.sleep(ttft)
+        for start in range(0, token_count, TOKENS_PER_EVENT):
+            count = min(TOKENS_PER_EVENT, token_count - start)
+            self.wfile.write(render("字" * count))
+            self.wfile.flush()
+            time.sleep(count / self.config.tokens_per_second)
+
+    def do_POST(self):
+        config = self.config
+
+        if self.path.endswith("/file_upload_3RD_PARTY_POST"):
+            self.read_body(config.upload_mbps * 1024 * 1024 / 8)
+            time.sleep(config.upload_latency)
+            body = json.dumps({"attachment_url": f"http://{self.headers['Host']}/attachment", "mime_type": "image/jpeg"}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if self.path == "/gemini":
+            # 图片随请求一起上传，模拟inline图片数据的传输时间
+            self.read_body(config.upload_mbps * 1024 * 1024 / 8)
+            self.stream_tokens(config.gemini_ttft, config.description_tokens, "text/plain; charset=utf-8",
+                               lambda text: text.encode())
+            return
+
+        # Poe机器人接口（fastapi_poe 的服务端协议）
+        request = json.loads(self.read_body() or b"{}")
+        if request.get("type") != "query":
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        has_attachments = any(message.get("attachments") for message in request.get("query", []))
+        ttft = config.poe_ttft + (config.vision_extra_ttft if has_attachments else 0)
+
+        def render(text):
+            return f"event: text\ndata: {json.dumps({'text': text})}\n\n".encode()
+
+        self.stream_tokens(ttft, config.reply_tokens, "text/event-stream", render)
+        self.wfile.write(b"event: done\ndata: {}\n\n")
+
+class StandInGeminiModel:
+    """替身Gemini模型：generate_content(stream=True) 逐段返回替身服务器的流式输出"""
+
+    def __init__(self, url):
+        self.url = url
+
+    def generate_content(self, contents, stream=False):
+        payload = b"".join(part for part in contents if isinstance(part, bytes))
+        with httpx.stream("POST", self.url, content=payload, timeout=60) as response:
+            for text in response.iter_text():
+                yield types.SimpleNamespace(text=text)
+
+async def poe_reply(session, messages, bot_name, base_url, timings, start):
+    """与 main.get_responses 相同的方式流式接收Poe回复，记录首字时间"""
+    parts = []
+    async for chunk in fp.get_bot_response(messages=messages, bot_name=bot_name, api_key="bench",
+                                          base_url=base_url, session=session):
+        if not parts:
+            timings["first_reply"] = time.perf_counter() - start
+        parts.append(chunk.text)
+    return "".join(parts)
+
+async def two_hop(session, images_bytes, base_url):
+    """两段式：Gemini描述图片后，把描述作为文本发送给Poe"""
+    timings = {}
+    start = time.perf_counter()
+    model = StandInGeminiModel(f"{base_url}/gemini")
+    description = await generate_content_stream(model, ["请详细描述这些图片", *images_bytes])
+    prompt = f"图片分析:\n{description}\n\n用户说明: 请分析这张图片"
+    messages = [fp.ProtocolMessage(role="user", content=prompt)]
+    await poe_reply(session, messages, "Claude-3.5-Sonnet", f"{base_url}/bot/", timings, start)
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+async def direct(session, images_bytes, base_url):
+    """直接发送：图片上传为附件，一次请求由视觉模型回复"""
+    timings = {}
+    start = time.perf_counter()
+    attachments = await vision_direct.upload_images(images_bytes, "bench")
+    message = vision_direct.build_vision_message(attachments, "请分析这张图片")
+    await poe_reply(session, [message], vision_direct.VISION_BOT_NAME, f"{base_url}/bot/", timings, start)
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+async def main(args):
+    StandInHandler.config = args
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    vision_direct.POE_UPLOAD_BASE_URL = f"{base_url}/poe_api/"
+
+    print(f"Gemini首字 {args.gemini_ttft}s, Poe首字 {args.poe_ttft}s (+{args.vision_extra_ttft}s 含图片), "
+          f"生成速度 {args.tokens_per_second} 字/秒, 上传带宽 {args.upload_mbps} Mbps")
+    print(f"{'图片数':>6} {'模式':<8} {'首字平均(秒)':>12} {'总时间平均(秒)':>14} {'总时间中位数(秒)':>16} {'加速比':>7}")
+
+    async with httpx.AsyncClient(timeout=60) as session:
+        for image_count in args.images:
+            images_bytes = [os.urandom(int(args.image_kb * 1024)) for _ in range(image_count)]
+
+            results = {}
+            for name, func in [("two_hop", two_hop), ("direct", direct)]:
+                results[name] = [await func(session, images_bytes, base_url) for _ in range(args.iterations)]
+
+            baseline = statistics.mean(t["total"] for t in results["two_hop"])
+            for name, runs in results.items():
+                first = statistics.mean(t["first_reply"] for t in runs)
+                totals = [t["total"] for t in runs]
+                mean = statistics.mean(totals)
+                print(f"{image_count:>6} {name:<8} {first:>12.2f} {mean:>14.2f} {statistics.median(totals):>16.2f} {baseline / mean:>6.2f}x")
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="两段式与直接发送图片分析的端到端延迟对比")
+    parser.add_argument("--images", type=int, nargs="+", default=[1, 4], help="每次请求的图片数量")
+    parser.add_argument("--image-kb", type=float, default=250, help="每张图片大小（KB）")
+    parser.add_argument("--gemini-ttft", type=float, default=1.0, help="替身Gemini首字延迟（秒）")
+    parser.add_argument("--poe-ttft", type=float, default=1.5, help="替身Poe机器人首字延迟（秒）")
+    parser.add_argument("--vision-extra-ttft", type=float, default=0.5, help="请求含图片附件时Poe额外的首字延迟（秒）")
+    parser.add_argument("--upload-latency", type=float, default=0.2, help="Poe附件上传接口的处理延迟（秒）")
+    parser.add_argument("--upload-mbps", type=float, default=20, help="替身上传带宽（Mbps）")
+    parser.add_argument("--tokens-per-second", type=float, default=80, help="替身生成速度（字/秒）")
+    parser.add_argument("--description-tokens", type=int, default=300, help="Gemini图片描述长度（字）")
+    parser.add_argument("--reply-tokens", type=int, default=300, help="Poe回复长度（字）")
+    parser.add_argument("--iterations", type=int, default=3, help="每种模式的重复次数")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,263 @@
+import os
+import time
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 统计窗口（秒）：只根据最近这段时间内的调用结果判断依赖是否可用
+BREAKER_WINDOW_SECONDS = float(os.environ.get("BREAKER_WINDOW_SECONDS", "60"))
+
+# 窗口内至少有这么多次调用才判断，避免一两次失败就熔断
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "5"))
+
+# 窗口内失败率达到该比例时熔断
+BREAKER_FAILURE_RATE = float(os.environ.get("BREAKER_FAILURE_RATE", "0.5"))
+
+# 窗口内慢调用（首字节耗时超过依赖的慢调用阈值）达到该比例时熔断
+BREAKER_SLOW_RATE = 0.8
+
+# 熔断后等待多久（秒）进入半开状态，放行一次试探调用
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
+
+# 熔断器状态
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+STATE_NAMES = {
+    STATE_CLOSED: "正常",
+    STATE_OPEN: "熔断",
+    STATE_HALF_OPEN: "半开（试探中）",
+}
+
+class CircuitOpenError(Exception):
+    """依赖已熔断，调用被直接拒绝"""
+
+    def __init__(self, breaker):
+        self.breaker = breaker.name
+        self.retry_after = breaker.retry_after()
+        super().__init__(f"{breaker.label}暂时不可用，请约 {max(1, round(self.retry_after))} 秒后再试")
+
+class BreakerCall:
+    """
+    一次受熔断器保护的调用；流式调用收到首个数据时调用 mark 记录首字节耗时
+
+    trial 为 True 表示这是半开状态下放行的试探调用，只有它的结果决定恢复还是重新熔断。
+    """
+
+    def __init__(self, trial=False):
+        self.start_time = time.time()
+        self.latency = None
+        self.trial = trial
+
+    def mark(self):
+        if self.latency is None:
+            self.latency = time.time() - self.start_time
+
+class CircuitBreaker:
+    """
+    外部依赖的熔断器（所有请求共享）
+
+    - 正常（closed）：记录窗口内每次调用的结果，失败率或慢调用比例超过阈值时熔断
+    - 熔断（open）：调用直接抛出 CircuitOpenError，不再等待注定失败的请求和重试
+    - 半开（half_open）：熔断 BREAKER_OPEN_SECONDS 秒后放行一次试探调用，
+      成功且不慢则恢复正常，否则重新熔断
+
+    调用方的错误（如文件过大、格式不支持）不代表依赖故障，由 is_client_error 排除，不计入失败。
+
+    用法:
+        async with gemini_breaker.guard() as call:
+            for chunk in stream:
+                call.mark()   # 首字节
+    """
+
+    def __init__(self, name, label, slow_seconds, client_errors=()):
+        self.name = name
+        self.label = label  # 给用户看的依赖名称
+        self.slow_seconds = slow_seconds
+        self.client_errors = [pattern.lower() for pattern in client_errors]
+        self.state = STATE_CLOSED
+        self.since = time.time()
+        self._results = deque()  # (时间, 结果)，结果为 "ok"、"slow" 或 "failure"
+        self._trial = None  # 半开状态下正在执行的试探调用（BreakerCall）
+        self.last_error = None
+        self.stats = {
+            "calls": 0,
+            "failures": 0,
+            "slow_calls": 0,
+            "rejected": 0,
+            "opens": 0,
+        }
+
+    def is_client_error(self, error):
+        """调用方的错误，不计入依赖的失败"""
+        message = str(error).lower()
+        return any(pattern in message for pattern in self.client_errors)
+
+    def retry_after(self):
+        """熔断状态下距离下次试探还有多少秒"""
+        if self.state != STATE_OPEN:
+            return 0.0
+        return max(0.0, self.since + BREAKER_OPEN_SECONDS - time.time())
+
+    def _transition(self, state):
+        if state == self.state:
+            return
+        log = logging.warning if state == STATE_OPEN else logging.info
+        log(f"熔断器 {self.name}: {STATE_NAMES[self.state]} -> {STATE_NAMES[state]}")
+        self.state = state
+        self.since = time.time()
+        if state == STATE_OPEN:
+            self.stats["opens"] += 1
+        elif state == STATE_CLOSED:
+            self._results.clear()
+
+    def _prune(self, now):
+        while self._results and now - self._results[0][0] > BREAKER_WINDOW_SECONDS:
+            self._results.popleft()
+
+    def allow(self):
+        """
+        判断现在能否发起调用，必要时从熔断转为半开
+
+        返回:
+            能发起调用时返回 True；半开状态下只放行一次试探调用
+        """
+        if self.state == STATE_OPEN and self.retry_after() <= 0:
+            self._transition(STATE_HALF_OPEN)
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_HALF_OPEN and self._trial is None:
+            return True
+        return False
+
+    def check(self):
+        """
+        不能发起调用时抛出 CircuitOpenError
+
+        返回:
+            本次调用的 BreakerCall；半开状态下为试探调用（trial 为 True）
+        """
+        if not self.allow():
+            self.stats["rejected"] += 1
+            raise CircuitOpenError(self)
+        call = BreakerCall(trial=self.state == STATE_HALF_OPEN)
+        if call.trial:
+            self._trial = call
+        return call
+
+    def record(self, outcome, error=None, call=None):
+        """
+        记录一次调用结果
+
+        参数:
+            outcome: "ok"、"slow"、"failure"，None 表示不计入（如调用被取消或为调用方的错误）
+            error: 失败时的异常
+            call: check 返回的 BreakerCall；只有当前的试探调用的结果决定半开状态的去向，
+                熔断前发起或通过 allow 直接放行的调用在非正常状态下结束时只计入统计
+        """
+        trial = call is not None and call is self._trial
+        if trial:
+            self._trial = None
+        if outcome is None:
+            return
+
+        now = time.time()
+        self.stats["calls"] += 1
+        if outcome == "failure":
+            self.stats["failures"] += 1
+            self.last_error = f"{type(error).__name__}: {error}" if error else None
+        elif outcome == "slow":
+            self.stats["slow_calls"] += 1
+
+        if trial and self.state == STATE_HALF_OPEN:
+            self._transition(STATE_CLOSED if outcome == "ok" else STATE_OPEN)
+            return
+        if self.state != STATE_CLOSED:
+            return
+
+        self._results.append((now, outcome))
+        self._prune(now)
+        total = len(self._results)
+        if total < BREAKER_MIN_CALLS:
+            return
+        failures = sum(1 for _, result in self._results if result == "failure")
+        slow = sum(1 for _, result in self._results if result == "slow")
+        if failures / total >= BREAKER_FAILURE_RATE or slow / total >= BREAKER_SLOW_RATE:
+            logging.warning(f"熔断器 {self.name}: 最近 {total} 次调用中失败 {failures} 次、慢调用 {slow} 次，暂停调用 {BREAKER_OPEN_SECONDS:.0f} 秒")
+            self._transition(STATE_OPEN)
+
+    @asynccontextmanager
+    async def guard(self, timed=True):
+        """
+        保护一次调用：熔断时抛出 CircuitOpenError，结束时按结果和首字节耗时记录
+
+        参数:
+            timed: 是否按耗时判断慢调用（上传等耗时取决于文件大小的调用应传 False）
+        """
+        call = self.check()
+        outcome = None
+        error = None
+        try:
+            yield call
+            call.mark()
+            outcome = "slow" if timed and call.latency > self.slow_seconds else "ok"
+        except Exception as e:
+            if not self.is_client_error(e):
+                outcome = "failure"
+                error = e
+            raise
+        finally:
+            # 调用被取消时 outcome 为 None，只释放半开状态的试探名额
+            self.record(outcome, error, call)
+
+    def reset(self):
+        """手动恢复为正常状态"""
+        self._trial = None
+        self._transition(STATE_CLOSED)
+
+    def get_stats(self):
+        """返回熔断器统计（包括当前状态和窗口内的失败率）"""
+        self.allow()
+        self._prune(time.time())
+        total = len(self._results)
+        failures = sum(1 for _, result in self._results if result == "failure")
+        slow = sum(1 for _, result in self._results if result == "slow")
+        return {
+            **self.stats,
+            "name": self.name,
+            "label": self.label,
+            "state": self.state,
+            "state_name": STATE_NAMES[self.state],
+            "state_seconds": time.time() - self.since,
+            "retry_after": self.retry_after(),
+            "window_calls": total,
+            "failure_rate": failures / total if total else 0.0,
+            "slow_rate": slow / total if total else 0.0,
+            "slow_seconds": self.slow_seconds,
+            "last_error": self.last_error,
+        }
+
+# 创建全局实例
+# Poe：按首个回复片段的耗时判断慢调用
+poe_breaker = CircuitBreaker(
+    "poe", "Poe服务",
+    slow_seconds=float(os.environ.get("POE_SLOW_SECONDS", "30")),
+)
+# Gemini：分析按首个生成片段的耗时判断慢调用；文件过大、格式不支持等属于调用方的错误
+gemini_breaker = CircuitBreaker(
+    "gemini", "Google Gemini服务",
+    slow_seconds=float(os.environ.get("GEMINI_SLOW_SECONDS", "60")),
+    client_errors=("file too large", "unsupported file type", "invalid argument", "safety"),
+)
+# Telegram文件接口：按 get_file 的耗时判断慢调用；文件过大、文件尚未就绪不代表接口故障
+telegram_breaker = CircuitBreaker(
+    "telegram", "Telegram文件服务",
+    slow_seconds=float(os.environ.get("TELEGRAM_SLOW_SECONDS", "20")),
+    client_errors=("file is too big", "invalid file_id", "wrong file_id", "file is not accessible"),
+)
+
+breakers = {breaker.name: breaker for breaker in (poe_breaker, gemini_breaker, telegram_breaker)}
@@ -0,0 +1,132 @@
+import os
+import random
+import asyncio
+import logging
+from memory_budget import memory_budget
+from circuit_breaker import CircuitOpenError, telegram_breaker
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 就绪探测参数：立即尝试下载，只有Telegram报告文件未就绪时才按抖动指数退避等待
+PROBE_BASE_DELAY = float(os.environ.get("DOWNLOAD_PROBE_BASE_DELAY", "0.5"))  # 首次退避时间（秒）
+PROBE_MAX_DELAY = float(os.environ.get("DOWNLOAD_PROBE_MAX_DELAY", "8"))  # 单次退避上限（秒）
+PROBE_MAX_WAIT = float(os.environ.get("DOWNLOAD_PROBE_MAX_WAIT", "60"))  # 累计等待上限（秒）
+
+# 表示文件尚未就绪、值得稍后重试的错误特征
+NOT_READY_ERRORS = [
+    "file is not accessible",
+    "wrong file_id",
+    "temporarily unavailable",
+    "timed out",
+    "network",
+    "bad gateway",
+]
+
+# 表示重试也无济于事的错误特征
+PERMANENT_ERRORS = [
+    "file is too big",
+    "invalid file_id",
+]
+
+def backoff_delay(attempt, base_delay=PROBE_BASE_DELAY, max_delay=PROBE_MAX_DELAY):
+    """
+    计算第 attempt 次探测前的退避时间（带±50%随机抖动，避免多个下载同时重试）
+    """
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.5)
+
+def is_not_ready_error(error_msg):
+    """判断错误是否表示文件暂未就绪"""
+    error_msg = error_msg.lower()
+    return any(pattern in error_msg for pattern in NOT_READY_ERRORS)
+
+def is_permanent_error(error_msg):
+    """判断错误是否无法通过重试解决"""
+    error_msg = error_msg.lower()
+    return any(pattern in error_msg for pattern in PERMANENT_ERRORS)
+
+async def download_file(bot, file_id, dest_path=None, expected_size=None, max_wait=PROBE_MAX_WAIT, stage="acquire"):
+    """
+    下载Telegram文件到磁盘（或内存）
+
+    不做任何预先等待：立即通过 get_file 获取文件并开始下载。只有在 Telegram 报告
+    文件未就绪（get_file 报错、文件大小小于预期、下载不完整）时才退避后再次探测。
+
+    Telegram库会先把整个文件读入内存再写盘，因此下载到磁盘时在下载期间按文件大小预留内存预算；
+    下载到内存时数据在返回后仍被使用，由调用方负责预留。
+    每次探测都受 Telegram 熔断器保护：熔断时（包括重试过程中熔断）抛出 CircuitOpenError，不再等待。
+
+    参数:
+        bot: Telegram机器人对象
+        file_id: 文件ID
+        dest_path: 保存路径（通常位于任务的工作目录内）；为None时下载到内存，仅用于小文件
+        expected_size: 消息中声明的文件大小（字节），用于判断文件是否已完整可用
+        max_wait: 因文件未就绪而累计等待的最长时间（秒）
+        stage: 内存预算统计中记录的处理阶段
+
+    返回:
+        下载完成的文件路径（dest_path为None时返回字节数据），失败返回 None
+    """
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    total_wait = 0.0
+    attempt = 0
+
+    while True:
+        reason = None
+        try:
+            async with telegram_breaker.guard() as call:
+                file = await bot.get_file(file_id)
+                call.mark()
+            file_size = file.file_size
+
+            if expected_size and file_size is not None and file_size < expected_size:
+                reason = f"文件大小 {file_size} 字节小于预期的 {expected_size} 字节"
+            else:
+                # 文件已就绪，开始下载；记录从收到请求到开始下载的时间（含就绪等待，不是收到首个字节的时间）
+                time_to_download_start = loop.time() - start_time
+                # 下载耗时取决于文件大小，熔断器只统计成败
+                if dest_path:
+                    async with memory_budget.reserve(file_size or expected_size, stage):
+                        async with telegram_breaker.guard(timed=False):
+                            await file.download_to_drive(dest_path)
+                    downloaded_size = os.path.getsize(dest_path)
+                else:
+                    async with telegram_breaker.guard(timed=False):
+                        file_bytes = await file.download_as_bytearray()
+                    downloaded_size = len(file_bytes)
+
+                if file_size is not None and downloaded_size != file_size:
+                    reason = f"下载不完整：期望 {file_size} 字节，实际 {downloaded_size} 字节"
+                else:
+                    total_time = loop.time() - start_time
+                    logging.info(
+                        f"文件下载完成: {downloaded_size} 字节, 开始下载前耗时 {time_to_download_start:.2f} 秒, "
+                        f"就绪等待 {total_wait:.2f} 秒, 总耗时 {total_time:.2f} 秒, 探测次数 {attempt+1}"
+                    )
+                    return dest_path if dest_path else file_bytes
+        except CircuitOpenError:
+            logging.error("Telegram文件服务已熔断，放弃下载")
+            raise
+        except Exception as e:
+            error_msg = str(e)
+            if is_permanent_error(error_msg):
+                logging.error(f"下载文件失败，无法重试: {error_msg}")
+                return None
+            if not is_not_ready_error(error_msg) and attempt >= 2:
+                # 未知错误只再给两次机会
+                logging.error(f"下载文件时出错 (探测 {attempt+1} 次): {error_msg}")
+                return None
+            reason = error_msg
+
+        # 文件未就绪，退避后再次探测
+        delay = backoff_delay(attempt)
+        if total_wait + delay > max_wait:
+            logging.error(f"文件在 {total_wait:.1f} 秒内仍未就绪，放弃下载: {reason}")
+            return None
+
+        logging.info(f"文件暂未就绪 ({reason})，{delay:.2f} 秒后再次探测 (第 {attempt+1} 次)")
+        await asyncio.sleep(delay)
+        total_wait += delay
+        attempt += 1
@@ -0,0 +1,189 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+import google.generativeai as genai
+from downloader import backoff_delay
+from media_probe import content_hash
+from circuit_breaker import gemini_breaker
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 远程文件在最后一次使用后保留的时间（秒），期间相同内容的分析（如换一个说明重新提问）直接复用
+# Gemini 服务端会在48小时后自动删除上传的文件，这里的保留时间应远小于该值
+GEMINI_FILE_TTL = float(os.environ.get("GEMINI_FILE_TTL", "3600"))
+
+# 等待文件变为ACTIVE状态的轮询参数
+ACTIVE_POLL_BASE_DELAY = 0.5  # 首次轮询间隔（秒）
+ACTIVE_POLL_MAX_DELAY = 5  # 单次轮询间隔上限（秒）
+ACTIVE_WAIT_TIMEOUT = float(os.environ.get("GEMINI_ACTIVE_TIMEOUT", "180"))  # 累计等待上限（秒）
+
+class GeminiFileManager:
+    """
+    Gemini远程文件管理器
+
+    同一内容只上传一次：按内容哈希记录远程文件句柄，上传后轮询文件状态直到ACTIVE，
+    重试时只重新调用 generate_content。文件在最后一次使用后保留 ttl 秒，
+    过期且没有请求在使用的远程文件会被删除。
+    """
+
+    def __init__(self, ttl=GEMINI_FILE_TTL):
+        self.ttl = ttl
+        self._files = {}  # 内容哈希 -> {"file": 远程文件句柄, "expires": 过期时间, "in_use": 使用中的请求数}
+        self._locks = {}  # 内容哈希 -> [上传锁, 持有和等待的请求数]，避免同一内容被并发重复上传
+        self.stats = {
+            "uploads": 0,
+            "streamed_uploads": 0,
+            "reuses": 0,
+            "deletes": 0,
+            "failed_uploads": 0,
+            "upload_seconds": 0.0,
+            "active_wait_seconds": 0.0,
+        }
+
+    @asynccontextmanager
+    async def _key_lock(self, key):
+        """
+        按内容哈希加锁
+
+        没有请求持有或等待时移除锁（包括上传失败、记录被移除或过期的内容），锁表只包含进行中的内容。
+        """
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] <= 0 and self._locks.get(key) is entry:
+                del self._locks[key]
+
+    async def wait_until_active(self, remote_file):
+        """
+        轮询远程文件状态直到ACTIVE（带抖动的指数退避）
+
+        返回:
+            最新的远程文件句柄
+        """
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        attempt = 0
+
+        while remote_file.state.name == "PROCESSING":
+            delay = backoff_delay(attempt, ACTIVE_POLL_BASE_DELAY, ACTIVE_POLL_MAX_DELAY)
+            if loop.time() - start_time + delay > ACTIVE_WAIT_TIMEOUT:
+                raise Exception(f"文件 {remote_file.name} 在 {ACTIVE_WAIT_TIMEOUT:.0f} 秒内未变为ACTIVE状态")
+            await asyncio.sleep(delay)
+            remote_file = await asyncio.to_thread(genai.get_file, remote_file.name)
+            attempt += 1
+
+        if remote_file.state.name != "ACTIVE":
+            raise Exception(f"文件 {remote_file.name} 处理失败，状态: {remote_file.state.name}")
+
+        wait_seconds = loop.time() - start_time
+        self.stats["active_wait_seconds"] += wait_seconds
+        logging.info(f"文件 {remote_file.name} 已就绪 (等待 {wait_seconds:.2f} 秒, 轮询 {attempt} 次)")
+        return remote_file
+
+    async def acquire(self, path):
+        """
+        获取文件对应的远程文件句柄，必要时上传并等待其就绪
+
+        使用完毕后必须调用 release(key)。
+
+        参数:
+            path: 本地文件路径
+
+        返回:
+            (内容哈希, 远程文件句柄)
+        """
+        await self.purge_expired()
+        key = await content_hash(path)
+
+        async with self._key_lock(key):
+            entry = self._files.get(key)
+            if entry and entry["expires"] > time.time():
+                entry["in_use"] += 1
+                self.stats["reuses"] += 1
+                logging.info(f"复用已上传的Gemini文件: {entry['file'].name}")
+                return key, entry["file"]
+
+            start_time = time.time()
+            try:
+                # 上传耗时取决于文件大小，熔断器只统计成败
+                async with gemini_breaker.guard(timed=False):
+                    remote_file = await asyncio.to_thread(genai.upload_file, path)
+                    self.stats["upload_seconds"] += time.time() - start_time
+                    logging.info(f"文件已上传到Gemini: {remote_file.name} ({os.path.getsize(path)} 字节, {time.time() - start_time:.2f} 秒)")
+                    remote_file = await self.wait_until_active(remote_file)
+            except Exception:
+                self.stats["failed_uploads"] += 1
+                raise
+
+            self.stats["uploads"] += 1
+            self._files[key] = {"file": remote_file, "expires": time.time() + self.ttl, "in_use": 1}
+            return key, remote_file
+
+    async def register(self, key, remote_file, streamed=False):
+        """
+        登记已通过其他途径（如流式传输）上传的远程文件，等待其就绪后供之后的 acquire 复用
+
+        参数:
+            key: 文件内容的SHA-256
+            remote_file: 远程文件句柄
+            streamed: 是否为流式上传（用于统计）
+        """
+        async with self._key_lock(key):
+            if key in self._files:
+                # 相同内容已有可用的远程文件，删除这次重复的上传
+                await self._delete(remote_file)
+                return
+            remote_file = await self.wait_until_active(remote_file)
+            self.stats["uploads"] += 1
+            if streamed:
+                self.stats["streamed_uploads"] += 1
+            self._files[key] = {"file": remote_file, "expires": time.time() + self.ttl, "in_use": 0}
+
+    def release(self, key):
+        """结束一次使用，文件从此刻起再保留 ttl 秒"""
+        entry = self._files.get(key)
+        if entry:
+            entry["in_use"] = max(0, entry["in_use"] - 1)
+            entry["expires"] = time.time() + self.ttl
+
+    async def invalidate(self, key):
+        """远程文件已失效（如被服务端删除）时移除记录，下次使用时重新上传"""
+        entry = self._files.pop(key, None)
+        if entry:
+            await self._delete(entry["file"])
+
+    async def _delete(self, remote_file):
+        try:
+            await asyncio.to_thread(genai.delete_file, remote_file.name)
+            self.stats["deletes"] += 1
+            logging.info(f"已删除Gemini文件: {remote_file.name}")
+        except Exception as e:
+            logging.warning(f"删除Gemini文件 {remote_file.name} 失败: {e}")
+
+    async def purge_expired(self):
+        """删除已过期且没有请求在使用的远程文件"""
+        now = time.time()
+        expired = [key for key, entry in self._files.items() if entry["expires"] <= now and not entry["in_use"]]
+        for key in expired:
+            entry = self._files.pop(key)
+            await self._delete(entry["file"])
+
+    def get_stats(self):
+        """返回上传统计（包括当前缓存的远程文件数和复用率）"""
+        total = self.stats["uploads"] + self.stats["reuses"]
+        return {
+            **self.stats,
+            "cached_files": len(self._files),
+            "locks": len(self._locks),
+            "reuse_rate": self.stats["reuses"] / total if total else 0.0,
+        }
+
+# 创建全局实例
+gemini_files = GeminiFileManager()
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import threading
+from circuit_breaker import gemini_breaker
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+async def generate_content_stream(model, contents, on_text=None):
+    """
+    以流式方式调用Gemini的 generate_content，边生成边回调
+
+    SDK 的流式迭代是同步的，在线程中进行，收到的文本片段通过队列交回事件循环；
+    每收到一段文本，就以目前为止的累计文本调用 on_text，调用方可据此渐进显示结果。
+    on_text 出错只记录日志，不影响生成。
+    调用方出错或被取消（如任务取消、流水线超时、关闭）时通知线程在下一个分块处停止迭代，不再占用线程和配额。
+    调用受 Gemini 熔断器保护：熔断时直接抛出 CircuitOpenError，慢调用按首个文本片段的耗时判断。
+
+    参数:
+        model: genai.GenerativeModel
+        contents: 请求内容（提示和媒体）
+        on_text: 异步回调 on_text(累计文本)，为None时只返回完整结果
+
+    返回:
+        完整的生成文本
+    """
+    async with gemini_breaker.guard() as call:
+        return await _stream(model, contents, on_text, call)
+
+async def _stream(model, contents, on_text, call):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()  # 调用方不再需要结果时设置
+
+    def put(item):
+        # 事件循环已关闭（如进程关闭）时丢弃
+        if loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            pass
+
+    def produce():
+        try:
+            for chunk in model.generate_content(contents, stream=True):
+                if stop.is_set():
+                    logging.info("Gemini流式生成已被调用方取消，停止读取")
+                    return
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # 只包含结束原因等元数据、没有文本的分块
+                    continue
+                put(("text", text))
+            put(("done", None))
+        except Exception as e:
+            put(("error", e))
+
+    producer = loop.run_in_executor(None, produce)
+    parts = []
+
+    try:
+        while True:
+            kind, value = await queue.get()
+            if kind == "error":
+                raise value
+            if kind == "done":
+                break
+            call.mark()
+            parts.append(value)
+            if on_text:
+                try:
+                    await on_text("".join(parts))
+                except Exception as e:
+                    logging.warning(f"渐进显示分析结果失败: {e}")
+    finally:
+        stop.set()
+
+    await producer
+    if not parts:
+        raise Exception("Gemini没有返回任何文本内容")
+    return "".join(parts)
@@ -1,9 +1,13 @@
 import os
-import base64
 import logging
+import asyncio
 import google.generativeai as genai
 from PIL import Image
 from io import BytesIO
+from gemini_stream import generate_content_stream
+import vision_direct
+from media_pipeline import MediaError, DOWNLOAD_FAILED, ANALYSIS_FAILED, NOT_CONFIGURED, report_progress, hold_memory
+from circuit_breaker import CircuitOpenError, telegram_breaker
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,26 +21,24 @@ if GOOGLE_API_KEY:
 else:
     logging.warning("未设置 GOOGLE_API_KEY 环境变量")
 
-def image_to_base64(image_bytes):
-    """
-    将图片转换为base64编码
-    """
-    return base64.b64encode(image_bytes).decode('utf-8')
+# 图片在处理过程中占用的内存约为文件大小的倍数：下载数据、上传附件时的副本，
+# 以及Gemini分析时解码后的像素（JPEG解码后通常是文件大小的10倍左右）
+PHOTO_MEMORY_FACTOR = 12
+PHOTO_DEFAULT_BYTES = 300 * 1024  # Telegram未返回文件大小时的估计值
 
-async def download_image(bot, file_id):
-    """
-    下载Telegram图片
-    """
-    file = await bot.get_file(file_id)
-    image_bytes = await file.download_as_bytearray()
-    return image_bytes
-
-async def analyze_image_with_gemini(image_bytes):
+async def analyze_image_with_gemini(image_bytes, on_text=None):
     """
     使用Google Gemini API分析图片内容
+    
+    参数:
+        image_bytes: 图片字节数据
+        on_text: 流式生成时的回调 on_text(累计文本)，用于渐进显示分析结果
+    
+    返回:
+        分析结果文本；失败时抛出 MediaError
     """
     if not GOOGLE_API_KEY:
-        return "（无法分析图片：未配置Google API密钥）"
+        raise MediaError(NOT_CONFIGURED, "无法分析图片：未配置Google API密钥")
     
     try:
         # 使用 gemini-2.0-flash 模型，比gemini-pro-vision更先进
@@ -48,40 +50,91 @@ async def analyze_image_with_gemini(image_bytes):
         # 构建提示
         prompt = "请详细描述这张图片中的内容，包括可见的物体、人物、场景、文字等。请用中文回答。"
         
-        # 调用API分析图片
-        response = model.generate_content([prompt, image])
-        
-        # 返回分析结果
-        return response.text
+        # 以流式方式调用API分析图片，边生成边显示
+        return await generate_content_stream(model, [prompt, image], on_text)
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logging.error(f"使用Google Gemini API分析图片时出错: {e}")
-        return f"（图片分析失败: {str(e)}）"
+        raise MediaError(ANALYSIS_FAILED, f"图片分析失败: {str(e)}")
 
-async def process_image(bot, file_id):
+async def analyze_images_with_gemini(images_bytes, caption="", on_text=None):
     """
-    处理图片：下载、分析、转换为base64
+    使用Google Gemini API在一次请求中分析多张图片（相册）
+    
+    参数:
+        images_bytes: 图片字节数据列表
+        caption: 用户说明
+        on_text: 流式生成时的回调 on_text(累计文本)，用于渐进显示分析结果
+    
+    返回:
+        分析结果文本；失败时抛出 MediaError
     """
+    if not GOOGLE_API_KEY:
+        raise MediaError(NOT_CONFIGURED, "无法分析图片：未配置Google API密钥")
+    
     try:
-        # 下载图片
-        image_bytes = await download_image(bot, file_id)
-        
-        # 分析图片
-        description = await analyze_image_with_gemini(image_bytes)
+        model = genai.GenerativeModel('gemini-2.0-flash')
         
-        # 将图片转换为base64
-        base64_image = image_to_base64(image_bytes)
+        images = [Image.open(BytesIO(image_bytes)) for image_bytes in images_bytes]
         
-        # 创建markdown格式的图片引用
-        # base64_markdown = f"![图片](data:image/jpeg;base64,{base64_image})"
+        # 构建提示，要求按顺序逐张描述，并说明图片之间的关联
+        prompt = f"以下是用户一次发送的一组图片（共{len(images)}张）。请按顺序逐张详细描述每张图片中的内容，包括可见的物体、人物、场景、文字等，最后总结这些图片之间的关联。"
+        if caption:
+            prompt += f"如果用户提供了说明: {caption}，请特别关注相关内容。"
+        prompt += "请用中文回答。"
         
-        # 返回分析结果和base64格式的图片
-        return {
-            "description": description,
-            "base64_image": base64_image
-        }
+        # 一次调用API分析所有图片
+        return await generate_content_stream(model, [prompt, *images], on_text)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logging.error(f"使用Google Gemini API分析多张图片时出错: {e}")
+        raise MediaError(ANALYSIS_FAILED, f"图片分析失败: {str(e)}")
+
+async def acquire_photos(request):
+    """下载阶段：按图片大小一次性预留内存预算后，并发下载所有图片（按消息顺序）"""
+    try:
+        async with telegram_breaker.guard() as call:
+            files = await asyncio.gather(*(request.bot.get_file(file_id) for file_id in request.file_ids))
+            call.mark()
+        await hold_memory(request, sum(file.file_size or PHOTO_DEFAULT_BYTES for file in files) * PHOTO_MEMORY_FACTOR)
+        async with telegram_breaker.guard(timed=False):
+            request.images = await asyncio.gather(*(file.download_as_bytearray() for file in files))
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logging.error(f"下载图片时出错: {e}")
+        raise MediaError(DOWNLOAD_FAILED, f"下载图片失败: {str(e)}")
+
+async def transform_photos(request):
+    """
+    处理阶段：直接发送模式下将图片上传为Poe附件
+    
+    上传失败时不报错，留给分析阶段改用Gemini描述图片（两段式）。
+    """
+    if not vision_direct.use_direct_vision(len(request.images)):
+        return
+    try:
+        request.attachments = await vision_direct.upload_images(request.images, vision_direct.POE_API_KEY)
+        vision_direct.vision_stats["direct"] += 1
     except Exception as e:
-        logging.error(f"处理图片时出错: {e}")
-        return {
-            "description": f"处理图片时出错: {str(e)}",
-            "base64_image": None
-        } 
\ No newline at end of file
+        vision_direct.vision_stats["fallbacks"] += 1
+        logging.warning(f"直接发送图片给 {vision_direct.VISION_BOT_NAME} 失败，回退到Gemini分析: {type(e).__name__}: {e}")
+
+async def analyze_photos(request):
+    """分析阶段：未使用直接发送模式时，由Gemini在一次请求中描述全部图片"""
+    if request.attachments:
+        return
+    await report_progress(request, "🔍 Google Gemini 2.0 正在分析图片...")
+    if len(request.images) > 1:
+        request.description = await analyze_images_with_gemini(request.images, request.caption, request.on_text)
+    else:
+        request.description = await analyze_image_with_gemini(request.images[0], request.on_text)
+
+# 图片处理的各阶段
+PHOTO_STAGES = {
+    "acquire": acquire_photos,
+    "transform": transform_photos,
+    "analyze": analyze_photos,
+}
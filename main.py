@@ -4,10 +4,26 @@ from telegram import Update, constants, BotCommand
 from telegram.ext import Application, MessageHandler, filters, CommandHandler
 import logging
 import os
+import time
+import html
 import image_handler
 import media_handler  # 导入媒体处理模块
 import usage_stats  # 导入用户使用统计模块
+import transcode_pool  # 导入转码执行器模块
+import gemini_files  # 导入Gemini文件上传管理模块
+import vision_direct  # 导入图片直接发送给视觉模型的模块
+import media_jobs  # 导入后台媒体任务队列模块
+import memory_budget  # 导入媒体内存预算模块
+import media_workspace  # 导入媒体工作目录管理模块
+import transcode_cache  # 导入转码结果缓存模块
+from overload_control import overload_controller, LEVEL_NAMES, LEVEL_FAST_TEXT, LEVEL_SHED, OVERLOAD_QUEUE_LEVELS, OVERLOAD_INFLIGHT_LEVELS, OVERLOAD_CONTEXT_MESSAGES
+from circuit_breaker import breakers, CircuitOpenError, BREAKER_WINDOW_SECONDS
+from poe_stream import poe_streamer
+from model_router import model_router, CLASS_NAMES, ROUTER_WINDOW_SECONDS
+from media_pipeline import MediaPipeline, MediaRequest, stage_limiter, ANALYSIS_FAILED, INTERNAL
+from audio_chunker import is_long_audio, format_timestamp
 from datetime import datetime, timedelta
+from functools import partial
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -21,10 +37,24 @@ bot_names = {
 }
 default_bot_name = bot_names['claude3']
 
+# 按 bot_names 加载各模型的首字节截止时间和对冲目标
+poe_streamer.configure(bot_names)
+model_router.configure(bot_names)
+
+# 中度过载时文本请求改用的较快模型（bot_names中的键）
+fast_bot_name = bot_names.get(os.environ.get("OVERLOAD_FAST_MODEL", "claude35"), bot_names['claude35'])
+
+# /compare 同时请求的模型（bot_names中的键，逗号分隔）
+compare_bot_names = [bot_names[key.strip()] for key in os.environ.get("COMPARE_MODELS", ",".join(bot_names)).split(',') if key.strip() in bot_names] or list(bot_names.values())
+
 # 用户会话管理
 user_tasks = {}
 user_context = {}
 
+# 相册（media_group）缓冲：Telegram会把相册拆成多条带相同media_group_id的消息分别推送
+ALBUM_COLLECT_DELAY = float(os.environ.get("ALBUM_COLLECT_DELAY", "1.5"))  # 等待同一相册后续图片的时间（秒）
+album_buffers = {}
+
 # 管理员ID列表 - 从环境变量获取
 admin_users_str = os.environ.get("ADMIN_USERS", "1561126701")  # 默认包含提供的ID
 admin_users = list(map(int, admin_users_str.split(',')))
@@ -45,20 +75,29 @@ else:
 
 logging.info(f"已启用用户白名单，允许的用户ID: {allowed_users}")
 
-# 从Poe获取响应
-async def get_responses(api_key, messages, response_list, done, bot_name):
-    async for chunk in fp.get_bot_response(messages=messages, bot_name=bot_name, api_key=api_key):
-        response_list.append(chunk.text)
-    done.set()
+# 从Poe获取响应（超过首字节截止时间时发起对冲请求，受Poe熔断器保护）
+# 传入 timing 字典时记录首字节耗时 ttft 和总耗时 total（秒）
+async def get_responses(api_key, messages, response_list, done, bot_name, hedge=True, timing=None):
+    start_time = time.time()
+    try:
+        async for text in poe_streamer.stream(messages, bot_name, api_key, hedge=hedge):
+            if timing is not None and 'ttft' not in timing:
+                timing['ttft'] = time.time() - start_time
+            response_list.append(text)
+    finally:
+        if timing is not None:
+            timing['total'] = time.time() - start_time
+        # 出错时也要结束消息更新循环
+        done.set()
     
 # 更新Telegram消息
-async def update_telegram_message(update, context, response_list, done, response_text, update_interval=1):
+async def update_telegram_message(bot, chat_id, response_list, done, response_text, update_interval=1):
     response_message = None
     last_response_text = ""
 
     while not done.is_set():
         if response_list:
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=constants.ChatAction.TYPING)
+            await bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
 
             response_text[0] += "".join(response_list)
             response_list.clear()
@@ -66,12 +105,12 @@ async def update_telegram_message(update, context, response_list, done, response
             if response_text[0].strip() != last_response_text.strip():
                 try:
                     if response_message is None:
-                        response_message = await context.bot.send_message(chat_id=update.effective_chat.id, text=response_text[0], parse_mode="Markdown")
+                        response_message = await bot.send_message(chat_id=chat_id, text=response_text[0], parse_mode="Markdown")
                     else:
                         await response_message.edit_text(response_text[0], parse_mode="Markdown")
                 except Exception:
                     if response_message is None:
-                        response_message = await context.bot.send_message(chat_id=update.effective_chat.id, text=response_text[0])
+                        response_message = await bot.send_message(chat_id=chat_id, text=response_text[0])
                     else:
                         await response_message.edit_text(response_text[0])
                 
@@ -87,31 +126,121 @@ async def update_telegram_message(update, context, response_list, done, response
         if response_text[0].strip() != last_response_text.strip():
             try:
                 if response_message is None:
-                    response_message = await context.bot.send_message(chat_id=update.effective_chat.id, text=response_text[0], parse_mode="Markdown")
+                    response_message = await bot.send_message(chat_id=chat_id, text=response_text[0], parse_mode="Markdown")
                 else:
                     await response_message.edit_text(response_text[0], parse_mode="Markdown")
             except Exception:
                 if response_message is None:
-                    response_message = await context.bot.send_message(chat_id=update.effective_chat.id, text=response_text[0])
+                    response_message = await bot.send_message(chat_id=chat_id, text=response_text[0])
                 else:
                     await response_message.edit_text(response_text[0])
 
+# 中度过载时的文本降级：较慢的模型改用 fast_bot_name，只发送最近的消息（保存的上下文不变）
+async def degrade_text_request(user_id, chat_id, bot, messages, bot_name):
+    if not overload_controller.at_least(LEVEL_FAST_TEXT):
+        return messages, bot_name
+    
+    if len(messages) > OVERLOAD_CONTEXT_MESSAGES:
+        messages = messages[-OVERLOAD_CONTEXT_MESSAGES:]
+        # 从用户消息开始，避免上下文以机器人的回复开头
+        while len(messages) > 1 and messages[0].role != "user":
+            messages = messages[1:]
+        overload_controller.record("context_trimmed")
+    
+    if bot_name != fast_bot_name and bot_name in bot_names.values():
+        overload_controller.record("text_rerouted")
+        # 每次进入过载状态只提示一次
+        transitions = overload_controller.stats['transitions']
+        if user_context[user_id].get('overload_notice') != transitions:
+            user_context[user_id]['overload_notice'] = transitions
+            await bot.send_message(
+                chat_id=chat_id,
+                text=f"⚡ 当前使用人数较多，回复临时改用更快的 {fast_bot_name} 模型，负载恢复后自动切回 {bot_name}。"
+            )
+        bot_name = fast_bot_name
+    return messages, bot_name
+
+# 自动模式：按请求类型和各模型最近的延迟表现选择模型，同一对话中尽量沿用上次的选择
+async def route_auto_request(user_id, chat_id, bot):
+    context = user_context[user_id]
+    # 对话中包含图片附件时只能继续使用视觉模型
+    if not context.get('auto') or context.get('auto_pinned'):
+        return context['bot_name']
+    
+    request_class = model_router.classify(context['messages'], media=context.get('auto_media', False))
+    previous = context.get('auto_bot')
+    bot_name = model_router.choose(request_class, sticky=previous)
+    if previous is not None and bot_name != previous:
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"🔀 自动模式：{previous} 最近响应较慢，本对话改用 {bot_name} 模型。"
+        )
+    context['auto_bot'] = bot_name
+    context['bot_name'] = bot_name
+    return bot_name
+
 # 处理用户请求
-async def handle_user_request(user_id, update, context):
+async def handle_user_request(user_id, chat_id, bot):
     if user_id in user_context and user_context[user_id]['messages']:
         response_list = []
         done = asyncio.Event()
         response_text = [""]
+        await route_auto_request(user_id, chat_id, bot)
+        messages, bot_name = await degrade_text_request(user_id, chat_id, bot, user_context[user_id]['messages'], user_context[user_id]['bot_name'])
         
         # 创建两个任务：一个获取AI响应，一个更新Telegram消息
-        api_task = asyncio.create_task(get_responses(api_key, user_context[user_id]['messages'], response_list, done, user_context[user_id]['bot_name']))
-        telegram_task = asyncio.create_task(update_telegram_message(update, context, response_list, done, response_text))
+        api_task = asyncio.create_task(get_responses(api_key, messages, response_list, done, bot_name))
+        telegram_task = asyncio.create_task(update_telegram_message(bot, chat_id, response_list, done, response_text))
 
-        await asyncio.gather(api_task, telegram_task)
+        try:
+            await asyncio.gather(api_task, telegram_task)
+        except CircuitOpenError as e:
+            # Poe已熔断：立即告知用户，不等待注定失败的请求
+            await telegram_task
+            await bot.send_message(chat_id=chat_id, text=f"⚠️ {e}。您的消息已保留在对话中，稍后发送新消息即可继续。")
+            return
 
         # 将AI的响应添加到用户上下文中
         user_context[user_id]['messages'].append(fp.ProtocolMessage(role="bot", content=response_text[0]))
 
+# 进度消息中分析结果预览的最大长度（Telegram单条消息上限为4096字符）
+PROGRESS_PREVIEW_LIMIT = 3500
+
+# 编辑进度消息，可附带分析结果预览；编辑失败只记录日志
+async def edit_progress(message, header, text=""):
+    if text:
+        if len(text) > PROGRESS_PREVIEW_LIMIT:
+            text = text[:PROGRESS_PREVIEW_LIMIT] + "…"
+        header = f"{header}\n\n{text}"
+    try:
+        await message.edit_text(header)
+    except Exception as e:
+        logging.warning(f"更新进度消息失败: {e}")
+
+# 创建渐进显示回调：Gemini流式生成的分析结果按固定间隔写入进度消息
+def progress_preview(message, header, update_interval=1):
+    last_edit = [0.0]
+    
+    async def on_text(text):
+        now = asyncio.get_running_loop().time()
+        if now - last_edit[0] < update_interval:
+            return
+        last_edit[0] = now
+        await edit_progress(message, header, text)
+    
+    return on_text
+
+# 严重过载时拒绝新的媒体请求（不计入配额），已排队的任务照常处理
+async def reject_if_overloaded(update: Update, context, kind, media_name):
+    if not overload_controller.at_least(LEVEL_SHED):
+        return False
+    overload_controller.record(f"{kind}_rejected")
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"⏳ 机器人当前负载过高，暂时无法处理新的{media_name}，请稍后再发送。文字消息仍可正常使用。"
+    )
+    return True
+
 # 检查用户是否有权限使用机器人
 def check_user_permission(user_id, update, context):
     if user_id not in allowed_users:
@@ -126,11 +255,66 @@ def check_user_permission(user_id, update, context):
 # 处理用户图片
 async def handle_photo(update: Update, context):
     user_id = update.effective_user.id
+    media_group_id = update.message.media_group_id
+    
+    # 相册中的图片先放入缓冲区，等同一相册的其他图片到达后统一处理
+    if media_group_id:
+        key = (update.effective_chat.id, media_group_id)
+        album = album_buffers.get(key)
+        if album is None:
+            # 检查用户是否有权限（每个相册只检查一次）
+            if not check_user_permission(user_id, update, context):
+                return
+            album = {'update': update, 'items': [], 'caption': None, 'deadline': 0}
+            album_buffers[key] = album
+            asyncio.create_task(flush_album(key, context))
+        
+        album['items'].append((update.message.message_id, update.message.photo[-1].file_id))
+        if update.message.caption and not album['caption']:
+            album['caption'] = update.message.caption
+        # 每收到一张图片就顺延截止时间
+        album['deadline'] = asyncio.get_running_loop().time() + ALBUM_COLLECT_DELAY
+        return
     
     # 检查用户是否有权限
     if not check_user_permission(user_id, update, context):
         return
     
+    # 获取图片ID (选择最大分辨率的图片)
+    photo = update.message.photo[-1]
+    await process_photos(update, context, [photo.file_id], update.message.caption)
+
+# 相册收集完成后统一处理
+async def flush_album(key, context):
+    loop = asyncio.get_running_loop()
+    album = album_buffers[key]
+    
+    # 等待直到一段时间内没有新的图片到达
+    while True:
+        remaining = album['deadline'] - loop.time()
+        if remaining <= 0:
+            break
+        await asyncio.sleep(remaining)
+    
+    del album_buffers[key]
+    
+    # 按消息顺序排列图片
+    file_ids = [file_id for _, file_id in sorted(album['items'])]
+    logging.info(f"相册 {key[1]} 收集完成，共 {len(file_ids)} 张图片")
+    
+    try:
+        await process_photos(album['update'], context, file_ids, album['caption'])
+    except Exception as e:
+        logging.error(f"处理相册时出错: {e}")
+
+# 处理一张或一组图片：只计一次配额、一次回复
+async def process_photos(update: Update, context, file_ids, caption=None):
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    
+    if await reject_if_overloaded(update, context, "photo", "图片"):
+        return
+    
     # 检查使用限制
     allow_request, daily_used, daily_limit = usage_stats.usage_stats.record_request(
         user_id=user_id, 
@@ -140,73 +324,33 @@ async def handle_photo(update: Update, context):
     
     if not allow_request:
         await context.bot.send_message(
-            chat_id=update.effective_chat.id, 
+            chat_id=chat_id, 
             text=f"🚫 您今日的请求配额已用尽（{daily_used}/{daily_limit}）。请明天再试或联系管理员提高限制。"
         )
         return
     
-    logging.info(f"开始处理用户 {user_id} 的图片请求 (今日第 {daily_used}/{daily_limit} 次请求)")
+    logging.info(f"开始处理用户 {user_id} 的图片请求，共 {len(file_ids)} 张 (今日第 {daily_used}/{daily_limit} 次请求)")
     
-    # 获取图片ID (选择最大分辨率的图片)
-    photo = update.message.photo[-1]
-    file_id = photo.file_id
+    is_album = len(file_ids) > 1
     
     # 告知用户图片正在处理
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id, 
-        text="正在使用Google Gemini 2.0分析您的图片，请稍等..."
-    )
-    
-    # 处理图片
-    result = await image_handler.process_image(context.bot, file_id)
-    
-    # 用户说明文本
-    caption = update.message.caption or "请分析这张图片"
-    
-    # 构建消息内容
-    if result["base64_image"]:
-        # 构建提示
-        prompt = f"""以下是一张图片的分析（由Google Gemini 2.0 Flash模型生成）以及图片的base64编码：
-
-图片分析:
-{result["description"]}
-
-用户说明: {caption}
-
-图片的base64编码（已省略部分内容）:
-{result["base64_image"][:1000]}...
-
-请根据上述图片分析和用户说明，详细回答用户的问题。如果用户没有特定问题，请对图片内容进行深入解读。"""
-        
-        # 添加到用户上下文
-        message = fp.ProtocolMessage(role="user", content=prompt)
-        
-        # 获取或创建用户上下文
-        if user_id not in user_context:
-            user_context[user_id] = {'messages': [message], 'bot_name': bot_names['claude35']}  # 图片处理默认使用Claude-3.5-Sonnet
-        else:
-            if user_context[user_id]['bot_name'] != bot_names['claude35']:
-                # 临时记住原来的模型
-                original_model = user_context[user_id]['bot_name']
-                # 切换到Claude-3.5-Sonnet
-                user_context[user_id]['bot_name'] = bot_names['claude35']
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id, 
-                    text=f"图片处理已临时切换到 {bot_names['claude35']} 模型"
-                )
-            user_context[user_id]['messages'].append(message)
-        
-        # 处理用户请求
-        if user_id not in user_tasks or user_tasks[user_id].done():
-            user_tasks[user_id] = asyncio.create_task(handle_user_request(user_id, update, context))
+    if vision_direct.use_direct_vision(len(file_ids)):
+        text = f"正在将图片发送给 {vision_direct.VISION_BOT_NAME}，请稍等..."
+    elif is_album:
+        text = f"正在使用Google Gemini 2.0分析您的{len(file_ids)}张图片，请稍等..."
     else:
-        # 处理图片失败
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, 
-            text=f"处理图片时出错: {result['description']}"
-        )
+        text = "正在使用Google Gemini 2.0分析您的图片，请稍等..."
+    progress_message = await context.bot.send_message(chat_id=chat_id, text=text)
+    
+    # 保留用户的原始说明（可能为空）交给Gemini，默认说明只在构建给Poe的提示时使用
+    request = MediaRequest("photo", context.bot, chat_id, user_id, caption or "", "图片", progress_message, file_ids=file_ids)
+    # 两段式时Gemini的分析结果边生成边显示在进度消息中
+    request.on_text = progress_preview(progress_message, "🔍 Google Gemini 2.0 正在分析图片...")
+    result = await photo_pipeline.run(request)
+    if not result.ok:
+        await report_media_error(request, result.error)
 
-# 处理用户视频
+# 处理用户视频：检查权限和配额后登记后台任务，立即返回
 async def handle_video(update: Update, context):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
@@ -215,6 +359,9 @@ async def handle_video(update: Update, context):
     if not check_user_permission(user_id, update, context):
         return
     
+    if await reject_if_overloaded(update, context, "video", "视频"):
+        return
+    
     # 检查使用限制
     allow_request, daily_used, daily_limit = usage_stats.usage_stats.record_request(
         user_id=user_id, 
@@ -271,118 +418,20 @@ async def handle_video(update: Update, context):
         text=message_text
     )
     
-    # 添加等待时间，与文件大小成正比
-    wait_time = 2 + int(file_size / (5*1024*1024))  # 每5MB增加1秒等待，最少2秒
-    logging.info(f"等待 {wait_time} 秒，确保文件上传完成")
-    await asyncio.sleep(wait_time)
-    
-    # 更新进度信息
-    try:
-        await progress_message.edit_text(f"📥 正在接收视频文件，请稍等...\n⏳ 正在下载和处理视频...\n(大小: {file_size/1024/1024:.2f}MB, 时长: {duration}秒)")
-    except Exception as e:
-        logging.warning(f"更新进度消息失败: {e}")
-    
-    # 处理视频
-    caption = update.message.caption or "请分析这个视频"
-    
-    # 尝试处理视频，如果失败，给出更详细的反馈
-    try:
-        result = await media_handler.process_video(context.bot, file_id, caption, chat_id)
-        
-        # 更新进度消息
-        if "下载视频失败" in result["description"] or "视频压缩后仍然过大" in result["description"] or "视频压缩失败" in result["description"]:
-            # 对于特定错误类型，给出更具体的建议
-            error_message = result["description"]
-            if "下载视频失败" in error_message:
-                error_message = f"❌ 下载视频失败。可能原因：\n1. 文件仍在上传中\n2. 文件格式不兼容\n3. 网络连接问题\n\n建议：\n- 稍后重试\n- 压缩后再上传\n- 转换为MP4格式"
-            
-            try:
-                await progress_message.edit_text(error_message)
-            except:
-                await context.bot.send_message(chat_id=chat_id, text=error_message)
-            return
-    except Exception as e:
-        logging.error(f"视频处理异常: {e}")
-        error_message = f"❌ 视频处理出错: {str(e)}\n\n请尝试：\n- 上传更小的视频文件\n- 使用标准MP4格式\n- 降低视频分辨率"
-        try:
-            await progress_message.edit_text(error_message)
-        except:
-            await context.bot.send_message(chat_id=chat_id, text=error_message)
-        return
-    
-    try:
-        await progress_message.edit_text("📥 视频接收完成\n🔍 正在使用Google Gemini 2.0 Flash分析视频内容...\n⏳ 这可能需要较长时间，请耐心等待")
-    except Exception as e:
-        logging.warning(f"更新进度消息失败: {e}")
-        # 可能是由于消息已被其他更新替换，创建新消息
-        progress_message = await context.bot.send_message(
-            chat_id=chat_id,
-            text="🔍 正在使用Google Gemini 2.0 Flash分析视频内容...\n⏳ 这可能需要较长时间，请耐心等待"
-        )
-    
-    # 构建消息内容
-    if result["description"]:
-        # 视频分析完成，更新进度消息
-        if "分析失败" in result["description"]:
-            try:
-                await progress_message.edit_text(f"❌ {result['description']}\n\n建议：\n- 上传更短的视频片段（30秒以内）\n- 使用MP4格式\n- 降低视频分辨率")
-            except:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"❌ {result['description']}\n\n建议：\n- 上传更短的视频片段（30秒以内）\n- 使用MP4格式\n- 降低视频分辨率"
-                )
-            return
-            
-        try:
-            await progress_message.edit_text("📥 视频接收完成\n✅ 视频分析完成\n💬 正在生成详细回复...")
-        except:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="✅ 视频分析完成\n💬 正在生成详细回复..."
-            )
-        
-        # 构建提示
-        prompt = f"""以下是一个视频的分析（由Google Gemini 2.0 Flash模型生成）：
-
-视频分析:
-{result["description"]}
+    # 登记后台任务：下载、压缩、分析和回复都由任务队列执行，并通过进度消息报告进度
+    position = await media_jobs.media_jobs.submit("video", chat_id, progress_message.message_id, {
+        "user_id": user_id,
+        "file_id": file_id,
+        "file_size": file_size,
+        "duration": duration,
+        "mime_type": video.mime_type,
+        "media_name": "视频",
+        "caption": update.message.caption or "请分析这个视频",
+    })
+    if position:
+        await edit_progress(progress_message, f"{message_text}\n⏳ 已加入视频处理队列，前面还有 {position} 个视频任务...")
 
-用户说明: {caption}
-
-请根据上述视频分析和用户说明，详细回答用户的问题。如果用户没有特定问题，请对视频内容进行深入解读。如果分析结果表明视频未能被正确处理，请建议用户提供不同格式或更短的视频片段。"""
-        
-        # 添加到用户上下文
-        message = fp.ProtocolMessage(role="user", content=prompt)
-        
-        # 获取或创建用户上下文
-        if user_id not in user_context:
-            user_context[user_id] = {'messages': [message], 'bot_name': bot_names['claude35']}  # 视频处理默认使用Claude-3.5-Sonnet
-        else:
-            if user_context[user_id]['bot_name'] != bot_names['claude35']:
-                # 临时记住原来的模型
-                original_model = user_context[user_id]['bot_name']
-                # 切换到Claude-3.5-Sonnet
-                user_context[user_id]['bot_name'] = bot_names['claude35']
-                await context.bot.send_message(
-                    chat_id=chat_id, 
-                    text=f"视频处理已临时切换到 {bot_names['claude35']} 模型"
-                )
-            user_context[user_id]['messages'].append(message)
-        
-        # 处理用户请求
-        if user_id not in user_tasks or user_tasks[user_id].done():
-            user_tasks[user_id] = asyncio.create_task(handle_user_request(user_id, update, context))
-    else:
-        # 处理视频失败
-        try:
-            await progress_message.edit_text(f"❌ 处理视频时出错: {result.get('description', '未知错误')}")
-        except:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"❌ 处理视频时出错: {result.get('description', '未知错误')}"
-            )
-
-# 处理用户音频
+# 处理用户音频：检查权限和配额后登记后台任务，立即返回
 async def handle_audio(update: Update, context):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
@@ -391,6 +440,9 @@ async def handle_audio(update: Update, context):
     if not check_user_permission(user_id, update, context):
         return
     
+    if await reject_if_overloaded(update, context, "audio", "语音" if update.message.voice else "音频"):
+        return
+    
     # 检查使用限制
     allow_request, daily_used, daily_limit = usage_stats.usage_stats.record_request(
         user_id=user_id, 
@@ -423,17 +475,11 @@ async def handle_audio(update: Update, context):
     
     logging.info(f"接收到{audio_type}，格式: {file_format}, 大小: {file_size} 字节, 时长: {duration}秒")
     
-    # 检查音频时长和大小
-    if duration and duration > 300:  # 大于5分钟的音频
+    # 长音频将分段并发分析
+    if is_long_audio(duration):
         await context.bot.send_message(
             chat_id=chat_id, 
-            text=f"⚠️ {audio_type}时长超过5分钟，可能无法完整分析。建议上传较短的{audio_type}片段。"
-        )
-    
-    if file_size and file_size > 20*1024*1024:  # 大于20MB
-        await context.bot.send_message(
-            chat_id=chat_id, 
-            text=f"⚠️ {audio_type}文件过大，可能导致处理失败。建议上传小于20MB的{audio_type}文件。"
+            text=f"⏱️ {audio_type}时长约 {format_timestamp(duration)}，将在停顿处分段并行分析，完成后按顺序合并结果。"
         )
     
     # 告知用户音频正在处理
@@ -442,90 +488,163 @@ async def handle_audio(update: Update, context):
         text=f"📥 正在接收{audio_type}文件，请稍等..."
     )
     
-    # 更新进度信息
-    await asyncio.sleep(2)  # 等待文件上传
-    await progress_message.edit_text(f"📥 正在接收{audio_type}文件，请稍等...\n⏳ 正在下载文件...")
-    
-    # 处理音频
-    caption = update.message.caption or f"请分析这个{audio_type}"
-    result = await media_handler.process_audio(context.bot, file_id, caption, chat_id)
-    
-    # 更新进度消息
-    if "下载音频失败" in result["description"] or "音频文件过大" in result["description"]:
-        await progress_message.edit_text(f"❌ {result['description']}")
-        return
-    
+    # 登记后台任务：下载、转换、分析和回复都由任务队列执行，并通过进度消息报告进度
+    position = await media_jobs.media_jobs.submit("audio", chat_id, progress_message.message_id, {
+        "user_id": user_id,
+        "file_id": file_id,
+        "file_size": file_size,
+        "duration": duration,
+        "mime_type": audio.mime_type,
+        "media_name": audio_type,
+        "caption": update.message.caption or f"请分析这个{audio_type}",
+    })
+    if position:
+        await edit_progress(progress_message, f"📥 正在接收{audio_type}文件，请稍等...\n⏳ 已加入音频处理队列，前面还有 {position} 个音频任务...")
+
+# 执行视频或音频任务：按任务类型选择流水线
+async def run_media_job(job, bot, progress_message):
+    payload = job["payload"]
+    media_name = payload.get("media_name") or payload.get("audio_type", "视频")  # 兼容升级前登记的任务
+    request = MediaRequest(
+        job["kind"], bot, job["chat_id"], payload["user_id"], payload["caption"], media_name, progress_message,
+        file_id=payload["file_id"], file_size=payload["file_size"], duration=payload["duration"], mime_type=payload["mime_type"]
+    )
+    request.on_text = progress_preview(progress_message, f"📥 {media_name}接收完成\n🔍 Google Gemini 2.0 Flash 正在分析{media_name}内容...")
+    result = await MEDIA_PIPELINES[job["kind"]].run(request)
+    if not result.ok:
+        await report_media_error(request, result.error)
+    return result
+
+# 报告媒体处理失败：优先编辑进度消息，编辑失败时发送新消息
+async def report_media_error(request, error):
+    text = error.user_text()
     try:
-        await progress_message.edit_text(f"📥 {audio_type}接收完成\n🔍 正在使用Google Gemini 2.0 Flash分析{audio_type}内容...\n⏳ 这可能需要较长时间，请耐心等待")
-    except Exception as e:
-        logging.warning(f"更新进度消息失败: {e}")
-        # 可能是由于消息已被其他更新替换，创建新消息
-        progress_message = await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"🔍 正在使用Google Gemini 2.0 Flash分析{audio_type}内容...\n⏳ 这可能需要较长时间，请耐心等待"
-        )
+        await request.progress.edit_text(text)
+    except Exception:
+        await request.bot.send_message(chat_id=request.chat_id, text=text)
+
+# 提示阶段（图片）：直接发送模式附带图片附件，两段式附带Gemini的分析结果
+async def build_photo_prompt(request):
+    image_count = len(request.images)
+    caption = request.caption or ("请分析这组图片" if image_count > 1 else "请分析这张图片")
+    if request.attachments:
+        request.message = vision_direct.build_vision_message(request.attachments, caption)
+        request.bot_name = vision_direct.VISION_BOT_NAME
+        return
     
-    # 构建消息内容
-    if result["description"]:
-        # 音频分析完成，更新进度消息
-        if "分析失败" in result["description"]:
-            try:
-                await progress_message.edit_text(f"❌ {result['description']}")
-            except:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"❌ {result['description']}"
-                )
-            return
-            
-        try:
-            await progress_message.edit_text(f"📥 {audio_type}接收完成\n✅ {audio_type}分析完成\n💬 正在生成详细回复...")
-        except:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"✅ {audio_type}分析完成\n💬 正在生成详细回复..."
-            )
-        
-        # 构建提示
-        prompt = f"""以下是一个{audio_type}的分析（由Google Gemini 2.0 Flash模型生成）：
+    if image_count > 1:
+        prompt = f"""以下是用户一次发送的一组图片（共{image_count}张）的分析（由Google Gemini 2.0 Flash模型生成）：
 
-{audio_type}分析:
-{result["description"]}
+图片分析:
+{request.description}
 
 用户说明: {caption}
 
-请根据上述{audio_type}分析和用户说明，详细回答用户的问题。如果用户没有特定问题，请对{audio_type}内容进行深入解读。如果分析结果表明无法处理或识别该音频，请礼貌地告知用户，并建议提供不同格式的音频。"""
-        
-        # 添加到用户上下文
-        message = fp.ProtocolMessage(role="user", content=prompt)
-        
-        # 获取或创建用户上下文
-        if user_id not in user_context:
-            user_context[user_id] = {'messages': [message], 'bot_name': bot_names['claude35']}  # 音频处理默认使用Claude-3.5-Sonnet
-        else:
-            if user_context[user_id]['bot_name'] != bot_names['claude35']:
-                # 临时记住原来的模型
-                original_model = user_context[user_id]['bot_name']
-                # 切换到Claude-3.5-Sonnet
-                user_context[user_id]['bot_name'] = bot_names['claude35']
-                await context.bot.send_message(
-                    chat_id=chat_id, 
-                    text=f"{audio_type}处理已临时切换到 {bot_names['claude35']} 模型"
-                )
-            user_context[user_id]['messages'].append(message)
-        
-        # 处理用户请求
-        if user_id not in user_tasks or user_tasks[user_id].done():
-            user_tasks[user_id] = asyncio.create_task(handle_user_request(user_id, update, context))
+请根据上述图片分析和用户说明，详细回答用户的问题。如果用户没有特定问题，请对这组图片的内容及其关联进行深入解读。"""
     else:
-        # 处理音频失败
-        try:
-            await progress_message.edit_text(f"❌ 处理{audio_type}时出错: {result.get('description', '未知错误')}")
-        except:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"❌ 处理{audio_type}时出错: {result.get('description', '未知错误')}"
-            )
+        prompt = f"""以下是一张图片的分析（由Google Gemini 2.0 Flash模型生成）：
+
+图片分析:
+{request.description}
+
+用户说明: {caption}
+
+请根据上述图片分析和用户说明，详细回答用户的问题。如果用户没有特定问题，请对图片内容进行深入解读。"""
+    request.message = fp.ProtocolMessage(role="user", content=prompt)
+    request.bot_name = bot_names['claude35']
+
+# 分析结果不可用时给Poe的额外说明
+MEDIA_PROMPT_NOTES = {
+    "video": "如果分析结果表明视频未能被正确处理，请建议用户提供不同格式或更短的视频片段。",
+    "audio": "如果分析结果表明无法处理或识别该音频，请礼貌地告知用户，并建议提供不同格式的音频。",
+}
+
+# 提示阶段（视频和音频）：附带Gemini的分析结果
+async def build_media_prompt(request):
+    name = request.media_name
+    prompt = f"""以下是一个{name}的分析（由Google Gemini 2.0 Flash模型生成）：
+
+{name}分析:
+{request.description}
+
+用户说明: {request.caption}
+
+请根据上述{name}分析和用户说明，详细回答用户的问题。如果用户没有特定问题，请对{name}内容进行深入解读。{MEDIA_PROMPT_NOTES.get(request.kind, "")}"""
+    request.message = fp.ProtocolMessage(role="user", content=prompt)
+    request.bot_name = bot_names['claude35']
+
+# 回复阶段：将消息加入用户上下文，立即开始请求Poe
+async def respond_to_media(request):
+    user_id = request.user_id
+    bot_name = request.bot_name
+    
+    # 获取或创建用户上下文
+    switched_model = False
+    if user_id not in user_context:
+        user_context[user_id] = {'messages': [request.message], 'bot_name': bot_name}  # 媒体处理默认使用视觉模型或Claude-3.5-Sonnet
+    elif user_context[user_id].get('auto') and not request.attachments:
+        # 自动模式下分析结果是文本，仍由路由按媒体追问的延迟目标选择模型
+        user_context[user_id]['auto_media'] = True
+        user_context[user_id]['messages'].append(request.message)
+    else:
+        if user_context[user_id].get('auto'):
+            # 图片附件只能发给视觉模型，本对话不再自动选择
+            user_context[user_id]['auto_pinned'] = True
+        if user_context[user_id]['bot_name'] != bot_name:
+            # 切换到处理媒体的模型
+            user_context[user_id]['bot_name'] = bot_name
+            switched_model = True
+        user_context[user_id]['messages'].append(request.message)
+    
+    # 图片或分析结果一就绪就立即开始请求Poe，状态消息随后再更新
+    if user_id not in user_tasks or user_tasks[user_id].done():
+        user_tasks[user_id] = asyncio.create_task(handle_user_request(user_id, request.chat_id, request.bot))
+    
+    if switched_model:
+        await request.bot.send_message(
+            chat_id=request.chat_id, 
+            text=f"{request.media_name}处理已临时切换到 {bot_name} 模型"
+        )
+    
+    if request.attachments:
+        await edit_progress(request.progress, f"✅ 图片已发送给 {bot_name}\n💬 正在生成详细回复...")
+    else:
+        await edit_progress(request.progress, f"✅ {request.media_name}分析完成\n💬 正在生成详细回复...", request.description)
+
+# 各媒体类型的流水线：下载、探测、转换、分析由各媒体模块提供，提示和回复阶段共用
+photo_pipeline = MediaPipeline(
+    "photo",
+    {**image_handler.PHOTO_STAGES, "prompt": build_photo_prompt, "respond": respond_to_media},
+    use_workspace=False,
+)
+video_pipeline = MediaPipeline(
+    "video",
+    {**media_handler.VIDEO_STAGES, "prompt": build_media_prompt, "respond": respond_to_media},
+    progress={
+        "acquire": "📥 正在接收视频文件，请稍等...\n⏳ 正在下载视频...",
+        "transform": "📥 视频接收完成\n⚙️ 正在处理视频...",
+        "analyze": "📥 视频接收完成\n🔍 Google Gemini 2.0 Flash 正在分析视频内容...",
+    },
+    hints={
+        ANALYSIS_FAILED: "- 上传更短的视频片段（30秒以内）\n- 使用MP4格式\n- 降低视频分辨率",
+        INTERNAL: "- 上传更小的视频文件\n- 使用标准MP4格式\n- 降低视频分辨率",
+    },
+)
+audio_pipeline = MediaPipeline(
+    "audio",
+    {**media_handler.AUDIO_STAGES, "prompt": build_media_prompt, "respond": respond_to_media},
+    progress={
+        "acquire": "📥 正在接收{media_name}文件，请稍等...\n⏳ 正在下载文件...",
+        "transform": "📥 {media_name}接收完成\n⚙️ 正在处理{media_name}...",
+        "analyze": "📥 {media_name}接收完成\n🔍 Google Gemini 2.0 Flash 正在分析{media_name}内容...",
+    },
+)
+
+# 在后台任务队列中执行的媒体类型
+MEDIA_PIPELINES = {
+    "video": video_pipeline,
+    "audio": audio_pipeline,
+}
 
 # 处理用户消息
 async def handle_message(update: Update, context):
@@ -566,7 +685,7 @@ async def handle_message(update: Update, context):
 
     # 处理用户请求
     if user_id not in user_tasks or user_tasks[user_id].done():
-        user_tasks[user_id] = asyncio.create_task(handle_user_request(user_id, update, context))
+        user_tasks[user_id] = asyncio.create_task(handle_user_request(user_id, update.effective_chat.id, context.bot))
 
 # 开始命令处理程序
 async def start(update: Update, context):
@@ -574,7 +693,7 @@ async def start(update: Update, context):
     
     await context.bot.send_message(
         chat_id=update.effective_chat.id, 
-        text=f"欢迎使用Poe AI助手! 请输入您的问题或发送图片。[基于Claude-3-Opus]\n您的用户ID是: {user_id}"
+        text=f"欢迎使用Poe AI助手! 请输入您的问题或发送图片。[基于Claude-3-Opus，发送 /auto 可按响应速度自动选择模型]\n您的用户ID是: {user_id}"
     )
     
     if user_id not in allowed_users:
@@ -592,10 +711,13 @@ async def new_conversation(update: Update, context):
         return
     
     bot_name = default_bot_name
+    auto = False
     if user_id in user_context:
         bot_name = user_context[user_id]['bot_name']
-        user_context[user_id] = {'messages': [], 'bot_name': bot_name}
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=f"====== 新的对话开始（{bot_name}） ======")
+        auto = user_context[user_id].get('auto', False)
+        user_context[user_id] = {'messages': [], 'bot_name': bot_name, 'auto': auto}
+    label = "自动选择模型" if auto else bot_name
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=f"====== 新的对话开始（{label}） ======")
 
 # 切换到GPT-4
 async def gpt4(update: Update, context):
@@ -630,9 +752,121 @@ async def claude35(update: Update, context):
     bot_name = bot_names['claude35']
     await switch_model(user_id, bot_name, update, context)
 
-# 切换模型通用函数
+# 自动模式：按延迟表现为每个对话选择模型
+async def auto_model(update: Update, context):
+    user_id = update.effective_user.id
+    
+    # 检查用户是否有权限
+    if not check_user_permission(user_id, update, context):
+        return
+    
+    if user_id in user_context and user_context[user_id].get('auto'):
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="当前已经是自动模式。")
+        return
+    
+    user_context[user_id] = {'messages': [], 'bot_name': default_bot_name, 'auto': True}
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text="已切换到自动模式,并清空上下文。每个对话会根据各模型最近的响应速度选择模型，使用 /gpt4、/claude3、/claude35 可切回固定模型。"
+    )
+    await new_conversation(update, context)
+
+# 对比模式：把当前对话同时发给多个模型，各自流式输出到单独的消息，不改变当前模型和上下文
+async def compare_models(update: Update, context):
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    
+    # 检查用户是否有权限
+    if not check_user_permission(user_id, update, context):
+        return
+    
+    # 对比会同时发出多个请求，中度过载时暂停
+    if overload_controller.at_least(LEVEL_FAST_TEXT):
+        overload_controller.record("compare_rejected")
+        await context.bot.send_message(chat_id=chat_id, text="⏳ 机器人当前负载较高，暂时无法同时请求多个模型，请稍后再试。")
+        return
+    
+    if user_id in user_tasks and not user_tasks[user_id].done():
+        await context.bot.send_message(chat_id=chat_id, text="⏳ 上一个回复还在生成中，请稍后再对比。")
+        return
+    
+    messages = list(user_context[user_id]['messages']) if user_id in user_context else []
+    question = " ".join(context.args).strip() if context.args else ""
+    if question:
+        messages.append(fp.ProtocolMessage(role="user", content=question))
+    else:
+        # 没有给出问题时重新提问最近一个问题，去掉它之后的回复
+        while messages and messages[-1].role != "user":
+            messages.pop()
+    if not messages:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="用法: /compare <问题>\n在对话中直接发送 /compare 则让各模型重新回答最近一个问题。"
+        )
+        return
+    
+    # 每个模型计一次请求，配额不足时只对比前面的模型
+    models = []
+    for bot_name in compare_bot_names:
+        allow_request, daily_used, daily_limit = usage_stats.usage_stats.record_request(
+            user_id=user_id,
+            model=bot_name,
+            is_image=False
+        )
+        if not allow_request:
+            break
+        models.append(bot_name)
+    if not models:
+        await context.bot.send_message(
+            chat_id=chat_id, 
+            text=f"🚫 您今日的请求配额已用尽（{daily_used}/{daily_limit}）。请明天再试或联系管理员提高限制。"
+        )
+        return
+    if len(models) < len(compare_bot_names):
+        await context.bot.send_message(chat_id=chat_id, text=f"⚠️ 今日剩余配额只够对比 {len(models)} 个模型: {', '.join(models)}")
+    
+    logging.info(f"用户 {user_id} 对比模型: {', '.join(models)}")
+    user_tasks[user_id] = asyncio.create_task(run_comparison(chat_id, context.bot, messages, models))
+
+# 同时请求各模型并汇报首字节耗时和总耗时
+async def run_comparison(chat_id, bot, messages, models):
+    start_time = time.time()
+    timings = {bot_name: {} for bot_name in models}
+    headers = {bot_name: f"🤖 {bot_name}\n\n" for bot_name in models}
+    response_texts = {bot_name: [headers[bot_name]] for bot_name in models}
+    tasks = []
+    for bot_name in models:
+        response_list = []
+        done = asyncio.Event()
+        # 对比时不对冲到其他模型，每条消息都是该模型自己的回复
+        tasks.append(get_responses(api_key, messages, response_list, done, bot_name, hedge=False, timing=timings[bot_name]))
+        tasks.append(update_telegram_message(bot, chat_id, response_list, done, response_texts[bot_name]))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    wall_seconds = time.time() - start_time
+    
+    message = f"📊 <b>模型对比</b>: 共用时 {wall_seconds:.1f} 秒（依次请求约需 {sum(timing.get('total', 0.0) for timing in timings.values()):.1f} 秒）\n"
+    for index, bot_name in enumerate(models):
+        timing = timings[bot_name]
+        error = results[index * 2]
+        if isinstance(results[index * 2 + 1], Exception):
+            logging.error(f"发送 {bot_name} 的对比回复时出错: {results[index * 2 + 1]}")
+        message += f"- {html.escape(bot_name)}: "
+        if isinstance(error, Exception):
+            message += f"❌ {html.escape(str(error))}"
+            if 'ttft' in timing:
+                message += f" (首字节 {timing['ttft']:.2f} 秒)"
+        elif 'ttft' not in timing:
+            message += f"没有返回内容 (总耗时 {timing['total']:.2f} 秒)"
+        else:
+            chars = len(response_texts[bot_name][0]) - len(headers[bot_name])
+            message += f"首字节 {timing['ttft']:.2f} 秒, 总耗时 {timing['total']:.2f} 秒, {chars} 字符"
+        message += "\n"
+    message += "\n对比的回复不会加入当前对话上下文。"
+    await bot.send_message(chat_id=chat_id, text=message, parse_mode="HTML")
+
+# 切换模型通用函数（同时退出自动模式）
 async def switch_model(user_id, bot_name, update, context):
-    if user_id not in user_context or user_context[user_id]['bot_name'] != bot_name:
+    if user_id not in user_context or user_context[user_id]['bot_name'] != bot_name or user_context[user_id].get('auto'):
         user_context[user_id] = {'messages': [], 'bot_name': bot_name}
         await context.bot.send_message(chat_id=update.effective_chat.id, text=f"已切换到 {bot_name} 模型,并清空上下文。")
         await new_conversation(update, context)
@@ -808,6 +1042,55 @@ async def list_users(update: Update, context):
         text=message
     )
 
+# 管理员查看外部依赖的熔断器状态，/breakers reset [名称] 手动恢复
+async def breaker_status(update: Update, context):
+    user_id = update.effective_user.id
+    
+    # 检查是否为管理员
+    if user_id not in admin_users:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id, 
+            text="抱歉，只有管理员可以使用此命令。"
+        )
+        return
+    
+    if context.args and context.args[0] == "reset":
+        names = context.args[1:] or list(breakers)
+        unknown = [name for name in names if name not in breakers]
+        if unknown:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text=f"未知的熔断器: {', '.join(unknown)}\n可用: {', '.join(breakers)}"
+            )
+            return
+        for name in names:
+            breakers[name].reset()
+        logging.info(f"管理员 {user_id} 手动恢复了熔断器: {', '.join(names)}")
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"✅ 已将熔断器恢复为正常状态: {', '.join(names)}"
+        )
+        return
+    
+    icons = {"closed": "🟢", "open": "🔴", "half_open": "🟡"}
+    message = f"🔌 <b>外部依赖熔断器</b> (统计窗口 {BREAKER_WINDOW_SECONDS:.0f} 秒)\n"
+    for breaker in breakers.values():
+        stats = breaker.get_stats()
+        message += f"\n{icons[stats['state']]} <b>{stats['label']}</b> ({stats['name']}): {stats['state_name']}, 已持续 {stats['state_seconds']:.0f} 秒\n"
+        if stats['state'] == "open":
+            message += f"- 约 {stats['retry_after']:.0f} 秒后试探恢复\n"
+        message += f"- 窗口内: {stats['window_calls']} 次调用, 失败率 {stats['failure_rate']:.0%}, 慢调用 {stats['slow_rate']:.0%} (超过 {stats['slow_seconds']:.0f} 秒)\n"
+        message += f"- 累计: 调用 {stats['calls']}, 失败 {stats['failures']}, 慢调用 {stats['slow_calls']}, 熔断 {stats['opens']} 次, 拒绝 {stats['rejected']} 次\n"
+        if stats['last_error']:
+            message += f"- 最近错误: {html.escape(stats['last_error'][:200])}\n"
+    message += "\n使用 /breakers reset [名称] 手动恢复"
+    
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=message,
+        parse_mode="HTML"
+    )
+
 # 查看个人使用统计
 async def stats(update: Update, context):
     user_id = update.effective_user.id
@@ -987,6 +1270,167 @@ async def reset_usage(update: Update, context):
             text="请提供有效的用户ID。"
         )
 
+# 管理员查看媒体处理运行状态
+async def status(update: Update, context):
+    user_id = update.effective_user.id
+    
+    # 检查是否为管理员
+    if user_id not in admin_users:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id, 
+            text="抱歉，只有管理员可以使用此命令。"
+        )
+        return
+    
+    transcode_stats = transcode_pool.transcode_executor.get_stats()
+    job_stats = media_jobs.media_jobs.get_stats()
+    poe_stats = poe_streamer.get_stats()
+    
+    message = "🖥️ <b>媒体处理运行状态</b>\n\n"
+    
+    overload_stats = overload_controller.get_stats()
+    message += "<b>过载保护</b>:\n"
+    state = "" if overload_stats['enabled'] else " (已关闭自动降级)"
+    message += f"- 当前级别: {overload_stats['level']} {overload_stats['level_name']}{state}, 已持续 {overload_stats['level_for_seconds']:.0f} 秒\n"
+    for name, value in overload_stats['values'].items():
+        thresholds = "/".join(f"{threshold:g}" for threshold in overload_stats['thresholds'].get(name, []))
+        message += f"- {name}: {value:.2f} (阈值 {thresholds})\n" if isinstance(value, float) else f"- {name}: {value} (阈值 {thresholds})\n"
+    message += f"- 事件循环最大延迟: {overload_stats['max_lag']:.2f} 秒\n"
+    message += f"- 级别切换: {overload_stats['transitions']} 次, 最高级别 {overload_stats['max_level']}\n"
+    if overload_stats['actions']:
+        message += "- 降级/拒绝: " + ", ".join(f"{name} {count}" for name, count in overload_stats['actions'].items()) + "\n"
+    message += "\n"
+    
+    if poe_stats:
+        message += "<b>Poe回复</b> (首字节耗时 p50/p90, 截止时间):\n"
+        for name, stats in poe_stats.items():
+            message += f"- {name}: {stats['ttft_p50']:.2f}/{stats['ttft_p90']:.2f} 秒, 截止 {stats['deadline']:g} 秒"
+            if stats['throughput']:
+                message += f", 输出 {stats['throughput']:.0f} 字符/秒"
+            if stats['requests']:
+                message += f", 请求 {stats['requests']} 次 (失败 {stats['failures']})"
+            message += "\n"
+            if stats['hedges'] or stats['fallbacks']:
+                message += f"  对冲/备用: {stats['hedges']}/{stats['fallbacks']} 次 → {stats['hedge_bot']}, 对冲胜出 {stats['hedge_wins']} 次, 主请求胜出 {stats['primary_wins']} 次"
+                if stats['win_samples']:
+                    message += f", 胜出时对冲请求平均首字节 {stats['avg_win_seconds']:.2f} 秒"
+                message += "\n"
+        message += "\n"
+    
+    router_stats = model_router.get_stats()
+    if router_stats['routed']:
+        message += f"<b>自动模式</b> (最近 {ROUTER_WINDOW_SECONDS / 60:.0f} 分钟):\n"
+        message += f"- 选择 {router_stats['routed']} 次, 沿用 {router_stats['sticky']} 次, 换模型 {router_stats['switches']} 次, 均未达标 {router_stats['slo_misses']} 次\n"
+        for request_class, counts in router_stats['decisions'].items():
+            choices = ", ".join(f"{name} {count}" for name, count in counts.items())
+            message += f"- {CLASS_NAMES[request_class]} (目标 {router_stats['slos'][request_class]:g} 秒): {choices}\n"
+        message += "\n"
+    
+    message += "<b>媒体任务队列</b>:\n"
+    message += f"- 工作协程: {job_stats['running']}/{job_stats['workers']} 执行中, {job_stats['queued']} 排队中\n"
+    lanes = ", ".join(f"{kind} {count}" for kind, count in job_stats['lanes'].items())
+    reserved = ", ".join(f"{kind} {count}" for kind, count in job_stats['reserved_workers'].items() if count)
+    message += f"- 各通道排队: {lanes}" + (f" (专用工作协程: {reserved})" if reserved else "") + "\n"
+    message += f"- 登记/完成/失败: {job_stats['submitted']}/{job_stats['completed']}/{job_stats['failed']} 个\n"
+    message += f"- 重启后恢复/放弃: {job_stats['recovered']}/{job_stats['abandoned']} 个\n"
+    message += f"- 平均等待时间: {job_stats['avg_wait_seconds']:.2f} 秒, 平均执行时间: {job_stats['avg_run_seconds']:.2f} 秒\n\n"
+    message += "<b>转码执行器</b>:\n"
+    message += f"- 槽位: {transcode_stats['running']}/{transcode_stats['slots']} 运行中, {transcode_stats['queued']} 排队中\n"
+    message += f"- 每任务线程数: {transcode_stats['threads_per_job']}\n"
+    message += f"- 完成/失败: {transcode_stats['completed']}/{transcode_stats['failed']} 次\n"
+    message += f"- 取消/超时: {transcode_stats['cancelled']}/{transcode_stats['timeouts']} 次\n"
+    message += f"- 平均排队时间: {transcode_stats['avg_queue_seconds']:.2f} 秒\n"
+    message += f"- 平均执行时间: {transcode_stats['avg_run_seconds']:.2f} 秒\n"
+    message += f"- 累计CPU时间: {transcode_stats['cpu_seconds']:.1f} 秒\n"
+    
+    cache_stats = transcode_cache.transcode_cache.get_stats()
+    message += "\n<b>转码缓存</b>:\n"
+    if cache_stats['max_bytes']:
+        message += f"- 命中/未命中: {cache_stats['hits']}/{cache_stats['misses']} 次 (命中率 {cache_stats['hit_rate']:.0%})\n"
+        message += f"- 节省CPU时间: {cache_stats['cpu_seconds_saved']:.1f} 秒\n"
+        message += f"- 缓存结果: {cache_stats['entries']} 个, {cache_stats['bytes'] / 1024 / 1024:.1f}MB/{cache_stats['max_bytes'] / 1024 / 1024:.0f}MB, 已淘汰 {cache_stats['evictions']} 个\n"
+    else:
+        message += "- 已关闭\n"
+    
+    file_stats = gemini_files.gemini_files.get_stats()
+    uploads = file_stats['uploads']
+    message += "\n<b>Gemini文件上传</b>:\n"
+    message += f"- 上传/复用: {uploads}/{file_stats['reuses']} 次 (复用率 {file_stats['reuse_rate']:.0%})\n"
+    message += f"- 缓存中的远程文件: {file_stats['cached_files']} 个, 已删除 {file_stats['deletes']} 个\n"
+    message += f"- 上传失败: {file_stats['failed_uploads']} 次\n"
+    if uploads:
+        message += f"- 平均上传时间: {file_stats['upload_seconds'] / uploads:.2f} 秒, 平均就绪等待: {file_stats['active_wait_seconds'] / uploads:.2f} 秒\n"
+    
+    vision_stats = vision_direct.vision_stats
+    message += "\n<b>图片直接发送</b>:\n"
+    message += f"- 模式: 单图 {vision_direct.PHOTO_ANALYSIS_MODE}, 相册 {vision_direct.ALBUM_ANALYSIS_MODE} (视觉模型 {vision_direct.VISION_BOT_NAME})\n"
+    message += f"- 直接发送/回退: {vision_stats['direct']}/{vision_stats['fallbacks']} 次\n"
+    if vision_stats['direct']:
+        message += f"- 平均附件上传时间: {vision_stats['upload_seconds'] / vision_stats['direct']:.2f} 秒\n"
+    
+    workspace_stats = media_workspace.workspace_manager.get_stats()
+    quota = f"{workspace_stats['quota'] / 1024 / 1024:.0f}MB" if workspace_stats['quota'] else "不限"
+    message += "\n<b>媒体工作目录</b>:\n"
+    message += f"- 目录: {workspace_stats['root']}\n"
+    message += f"- 进行中/等待配额: {workspace_stats['active']}/{workspace_stats['waiting']} 个\n"
+    message += f"- 占用/预留/峰值/配额: {workspace_stats['used'] / 1024 / 1024:.1f}MB/{workspace_stats['reserved'] / 1024 / 1024:.1f}MB/{workspace_stats['peak_used'] / 1024 / 1024:.1f}MB/{quota}\n"
+    if workspace_stats['free'] is not None:
+        message += f"- 剩余磁盘空间: {workspace_stats['free'] / 1024 / 1024:.0f}MB\n"
+    message += f"- 每任务写入: 平均 {workspace_stats['avg_job_bytes'] / 1024 / 1024:.2f}MB, 最大 {workspace_stats['max_job_bytes'] / 1024 / 1024:.2f}MB\n"
+    message += f"- 配额等待: {workspace_stats['waits']} 次, 共 {workspace_stats['wait_seconds']:.2f} 秒\n"
+    message += f"- 清理遗留目录: {workspace_stats['orphans_removed']} 个 ({workspace_stats['orphan_bytes'] / 1024 / 1024:.1f}MB)\n"
+    
+    memory_stats = memory_budget.memory_budget.get_stats()
+    limit = f"{memory_stats['limit'] / 1024 / 1024:.0f}MB" if memory_stats['limit'] else "不限"
+    message += "\n<b>内存预算</b>:\n"
+    message += f"- 使用中/峰值/上限: {memory_stats['in_use'] / 1024 / 1024:.1f}MB/{memory_stats['peak'] / 1024 / 1024:.1f}MB/{limit}\n"
+    message += f"- 排队等待: 当前 {memory_stats['waiting']} 个, 累计 {memory_stats['waits']} 次, 共 {memory_stats['wait_seconds']:.2f} 秒\n"
+    message += f"- 改用磁盘处理: {memory_stats['spills']} 次\n"
+    for name, stats in memory_stats['stages'].items():
+        message += f"- {name}: 使用中 {stats['in_use'] / 1024 / 1024:.1f}MB, 峰值 {stats['peak'] / 1024 / 1024:.1f}MB\n"
+    
+    message += "\n<b>处理阶段</b> (执行次数/失败, 平均执行/排队时间, 并发):\n"
+    for name, stats in stage_limiter.get_stats().items():
+        if not stats['runs'] and not stats['active']:
+            continue
+        limit = stats['limit'] or "不限"
+        message += f"- {name}: {stats['runs']}/{stats['failures']} 次, {stats['avg_run_seconds']:.2f}/{stats['avg_wait_seconds']:.2f} 秒, {stats['active']}/{limit} 执行中, {stats['waiting']} 排队中\n"
+    
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=message,
+        parse_mode="HTML"
+    )
+
+# 进行中的Poe请求和媒体任务数，作为过载控制的指标
+def count_inflight():
+    text_requests = sum(1 for task in user_tasks.values() if not task.done())
+    return text_requests + media_jobs.media_jobs.get_stats()['running']
+
+# 负载级别变化时通知管理员
+async def notify_overload_change(bot, old_level, level, values):
+    icon = "🔴" if level > old_level else "🟢"
+    text = f"{icon} 负载级别变化: {LEVEL_NAMES[old_level]} → {LEVEL_NAMES[level]}\n"
+    text += "\n".join(f"- {name}: {value:.2f}" if isinstance(value, float) else f"- {name}: {value}" for name, value in values.items())
+    for admin_id in admin_users:
+        try:
+            await bot.send_message(chat_id=admin_id, text=text)
+        except Exception as e:
+            logging.warning(f"通知管理员 {admin_id} 负载级别变化失败: {e}")
+
+# 机器人启动后清理遗留的工作目录，恢复并启动后台媒体任务队列和过载控制
+async def post_init(application):
+    overload_controller.on_change(partial(notify_overload_change, application.bot))
+    await media_workspace.workspace_manager.start()
+    await media_jobs.media_jobs.start(application.bot)
+    await overload_controller.start()
+
+# 机器人退出时停止工作协程，执行中的任务下次启动时恢复
+async def post_shutdown(application):
+    await overload_controller.stop()
+    await media_jobs.media_jobs.stop()
+    await media_workspace.workspace_manager.stop()
+
 def main():
     # 检查环境变量
     telegram_token = os.environ.get("TELEGRAM_BOT_TOKEN", "")
@@ -999,8 +1443,17 @@ def main():
     if not google_api_key:
         logging.warning("未设置 GOOGLE_API_KEY 环境变量，图片识别功能将不可用")
     
-    # 创建应用
-    application = Application.builder().token(telegram_token).build()
+    # 注册后台媒体任务的执行函数；音频（多为语音消息）优先执行，并有专用工作协程，不必排在长视频压缩后面
+    media_jobs.media_jobs.register("audio", run_media_job, priority=0, reserved_workers=media_jobs.MEDIA_AUDIO_JOB_WORKERS)
+    media_jobs.media_jobs.register("video", run_media_job, priority=1)
+    
+    # 注册过载控制的负载指标（事件循环延迟由控制器自行测量）
+    overload_controller.register_signal("media_queue", lambda: media_jobs.media_jobs.get_stats()['queued'], OVERLOAD_QUEUE_LEVELS)
+    overload_controller.register_signal("transcode_queue", lambda: transcode_pool.transcode_executor.get_stats()['queued'], OVERLOAD_QUEUE_LEVELS)
+    overload_controller.register_signal("inflight", count_inflight, OVERLOAD_INFLIGHT_LEVELS)
+    
+    # 创建应用（启动时恢复未完成的媒体任务并启动工作协程，退出时停止）
+    application = Application.builder().token(telegram_token).post_init(post_init).post_shutdown(post_shutdown).build()
 
     # 添加处理程序
     application.add_handler(CommandHandler('start', start))
@@ -1008,6 +1461,8 @@ def main():
     application.add_handler(CommandHandler('gpt4', gpt4))
     application.add_handler(CommandHandler('claude3', claude3))
     application.add_handler(CommandHandler('claude35', claude35))
+    application.add_handler(CommandHandler('auto', auto_model))  # 按延迟表现自动选择模型
+    application.add_handler(CommandHandler('compare', compare_models))  # 同时请求多个模型对比回复
     application.add_handler(CommandHandler('adduser', add_user))
     application.add_handler(CommandHandler('removeuser', remove_user))
     application.add_handler(CommandHandler('listusers', list_users))
@@ -1017,6 +1472,8 @@ def main():
     application.add_handler(CommandHandler('allstats', all_stats))  # 管理员查看所有用户统计
     application.add_handler(CommandHandler('setlimit', set_limit))  # 设置用户使用限制
     application.add_handler(CommandHandler('resetusage', reset_usage))  # 重置用户今日使用量
+    application.add_handler(CommandHandler('status', status))  # 管理员查看媒体处理运行状态
+    application.add_handler(CommandHandler('breakers', breaker_status))  # 管理员查看外部依赖熔断器状态
     
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))  # 添加图片处理
     application.add_handler(MessageHandler(filters.VIDEO, handle_video))  # 添加视频处理
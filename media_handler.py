@@ -2,11 +2,21 @@ import os
 import base64
 import logging
 import google.generativeai as genai
-from io import BytesIO
-import tempfile
-import time
 import asyncio
-from video_compressor import compress_video
+from video_compressor import compress_video, run_command, run_command_piped, COMPRESS_TWO_PASS
+from media_workspace import MediaWorkspace
+from downloader import download_file, backoff_delay
+from transcode_pool import PRIORITY_AUDIO
+from storyboard import should_use_storyboard, extract_storyboard, analyze_storyboard_with_gemini, storyboard_memory_bytes
+from media_probe import probe_media
+from gemini_files import gemini_files
+from gemini_stream import generate_content_stream
+from streaming_transfer import download_with_streaming_upload, STREAM_TRANSFER_ENABLED, STREAM_TRANSFER_MIN_BYTES
+from audio_chunker import is_long_audio, chunk_audio, format_timestamp, AUDIO_CHUNK_CONCURRENCY
+from memory_budget import memory_budget
+from overload_control import overload_controller, LEVEL_MEDIA_LITE
+from media_pipeline import try_hold_memory, release_memory, MediaError, DOWNLOAD_FAILED, INVALID_MEDIA, TOO_LARGE, TRANSFORM_FAILED, UNSUPPORTED, ANALYSIS_FAILED, NOT_CONFIGURED, UNAVAILABLE
+from circuit_breaker import CircuitOpenError
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,6 +27,56 @@ GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY", "")
 # 视频大小限制（MB）
 MAX_VIDEO_SIZE_MB = 20
 COMPRESSED_TARGET_SIZE_MB = 19  # 压缩目标略小于限制
+COMPRESS_MAX_WIDTH = 1280  # 压缩后的最大宽度（过载时进一步降低）
+
+# 不超过该大小的音频全程在内存中处理：通过管道转码，并以内联数据发送给Gemini
+PIPE_AUDIO_MAX_BYTES = int(float(os.environ.get("PIPE_AUDIO_MAX_MB", "8")) * 1024 * 1024)
+
+# 可以通过标准输入读取的音频格式（扩展名 -> ffmpeg demuxer）
+# MP4系容器（m4a）的索引可能位于文件末尾，需要可随机访问的文件输入，不在此列
+PIPE_INPUT_FORMATS = {
+    '.mp3': 'mp3',
+    '.wav': 'wav',
+    '.ogg': 'ogg',
+    '.flac': 'flac',
+    '.aac': 'aac',
+}
+
+# Gemini可以直接接受的音频格式（扩展名 -> MIME类型及可接受的编码），这些格式无需转码
+# Telegram语音消息为OGG/Opus，可以原样发送
+GEMINI_AUDIO_FORMATS = {
+    '.mp3': {"mime_type": "audio/mp3", "codecs": None},
+    '.wav': {"mime_type": "audio/wav", "codecs": {"pcm"}},
+    '.ogg': {"mime_type": "audio/ogg", "codecs": {"opus", "vorbis"}},
+    '.flac': {"mime_type": "audio/flac", "codecs": None},
+    '.aac': {"mime_type": "audio/aac", "codecs": None},
+}
+
+# Gemini可以直接接受的视频格式
+GEMINI_VIDEO_FORMATS = {
+    '.mp4': {"mime_type": "video/mp4", "codecs": None},
+    '.mov': {"mime_type": "video/mov", "codecs": None},
+    '.webm': {"mime_type": "video/webm", "codecs": None},
+}
+
+# 以内联数据发送给Gemini时使用的MIME类型
+MEDIA_MIME_TYPES = {ext: fmt["mime_type"] for ext, fmt in {**GEMINI_AUDIO_FORMATS, **GEMINI_VIDEO_FORMATS}.items()}
+MEDIA_MIME_TYPES['.m4a'] = 'audio/mp4'
+
+# 可以边下载边流式上传给Gemini的MIME类型（Telegram消息中声明的类型）
+STREAMABLE_MIME_TYPES = {
+    'video/mp4', 'video/quicktime', 'video/webm',
+    'audio/mpeg', 'audio/mp3', 'audio/ogg', 'audio/wav', 'audio/x-wav', 'audio/flac', 'audio/x-flac', 'audio/aac',
+}
+
+# 需要转码时使用面向语音的低码率单声道MP3（16kHz采样已足够语音识别，体积约为高质量MP3的1/5）
+SPEECH_AUDIO_ARGS = [
+    '-vn',
+    '-ac', '1',
+    '-ar', '16000',
+    '-c:a', 'libmp3lame',
+    '-b:a', '32k',
+]
 
 # 配置Google Gemini API
 if GOOGLE_API_KEY:
@@ -34,113 +94,48 @@ def file_to_base64(file_bytes):
         logging.error(f"转换文件为base64时出错: {e}")
         return None
 
-async def download_file(bot, file_id, max_retries=5, retry_delay=3, initial_wait=5):
+def can_stream_upload(file_size, mime_type):
     """
-    下载Telegram文件，支持重试机制和初始等待
+    判断文件是否适合流式传输（下载的同时上传到Gemini）
     
-    参数:
-        bot: Telegram机器人对象
-        file_id: 文件ID
-        max_retries: 最大重试次数
-        retry_delay: 每次重试间隔的秒数
-        initial_wait: 大文件初始等待时间（秒）
+    只用于无需压缩或转码、会以文件形式上传的媒体：大小在流式传输阈值和大小限制之间，
+    且声明的格式Gemini可以直接接受。
     """
-    # 先获取文件信息
-    try:
-        file_info = None
-        for i in range(3):  # 尝试3次获取文件信息
-            try:
-                file_info = await bot.get_file(file_id)
-                break
-            except Exception as e:
-                logging.warning(f"尝试获取文件信息失败 ({i+1}/3): {e}")
-                await asyncio.sleep(2)
-                
-        if not file_info:
-            logging.error("无法获取文件信息")
-            return None
-            
-        file_size = file_info.file_size
-        logging.info(f"文件大小: {file_size} 字节")
-        
-        # 对于大文件，先等待一段时间确保上传完成
-        if file_size and file_size > 10*1024*1024:  # 大于10MB
-            file_size_mb = file_size / (1024 * 1024)
-            wait_time = initial_wait + int(file_size_mb / 5)  # 每5MB增加1秒等待
-            logging.info(f"大文件 ({file_size_mb:.1f}MB)，等待 {wait_time} 秒确保上传完成")
-            await asyncio.sleep(wait_time)
-    except Exception as e:
-        logging.error(f"获取文件信息时出错: {e}")
-        file_size = None
-    
-    # 下载文件，带重试机制
-    for attempt in range(max_retries):
-        try:
-            # 下载文件
-            if attempt > 0:
-                logging.info(f"重试下载文件 (尝试 {attempt+1}/{max_retries})")
-                
-            # 重新获取文件对象，避免因长时间等待导致的token失效
-            file = await bot.get_file(file_id)
-            file_size = file.file_size
-            
-            # 如果文件太小，可能尚未完全上传，等待一下
-            if file_size is not None and file_size < 1024 and attempt < 2:  # 小于1KB的文件可能未完成上传
-                logging.info(f"文件可能未完全上传，等待 {retry_delay} 秒 (文件大小: {file_size} 字节)")
-                await asyncio.sleep(retry_delay)
-                continue
-                
-            # 下载文件
-            logging.info(f"开始下载文件，大小: {file_size} 字节")
-            file_bytes = await file.download_as_bytearray()
-            
-            # 验证文件是否下载完整
-            if len(file_bytes) != file_size:
-                logging.warning(f"文件下载不完整：期望 {file_size} 字节，实际 {len(file_bytes)} 字节，重试中...")
-                # 对于大文件，增加等待时间
-                if file_size and file_size > 10*1024*1024:
-                    await asyncio.sleep(retry_delay * 2)
-                else:
-                    await asyncio.sleep(retry_delay)
-                continue
-                
-            logging.info(f"文件下载完成: {len(file_bytes)} 字节")
-            return file_bytes
-            
-        except Exception as e:
-            error_msg = str(e)
-            logging.error(f"下载文件时出错 (尝试 {attempt+1}/{max_retries}): {error_msg}")
-            
-            # 对"文件不可访问"错误特殊处理
-            if "file is not accessible" in error_msg.lower() or "wrong file_id" in error_msg.lower():
-                if attempt < max_retries - 1:
-                    wait_time = retry_delay * (attempt + 2)  # 随重试次数增加等待时间
-                    logging.info(f"文件可能尚未完全上传，等待 {wait_time} 秒后重试")
-                    await asyncio.sleep(wait_time)
-                    
-            elif attempt < max_retries - 1:
-                await asyncio.sleep(retry_delay)
-    
-    logging.error(f"经过 {max_retries} 次尝试后无法下载文件")
-    return None
+    return bool(
+        STREAM_TRANSFER_ENABLED and GOOGLE_API_KEY and file_size and mime_type
+        and STREAM_TRANSFER_MIN_BYTES <= file_size <= MAX_VIDEO_SIZE_MB * 1024 * 1024
+        and mime_type.lower() in STREAMABLE_MIME_TYPES
+    )
+
+def is_in_memory(media):
+    """判断媒体是内存中的字节数据还是磁盘上的文件路径"""
+    return isinstance(media, (bytes, bytearray))
 
-async def verify_media_file(file_bytes, file_ext):
+async def verify_media_file(media, file_ext):
     """
     验证媒体文件是否有效
     
     参数:
-        file_bytes: 文件字节数据
+        media: 文件路径或内存中的字节数据
         file_ext: 文件扩展名（.mp4, .mp3, .wav 等）
     
     返回:
         bool: 文件是否有效
     """
-    if not file_bytes:
-        return False
+    if is_in_memory(media):
+        file_size = len(media)
+        file_bytes = bytes(media[:100])
+    else:
+        if not media or not os.path.exists(media):
+            return False
+        file_size = os.path.getsize(media)
+        # 只读取文件头部用于特征检测
+        with open(media, 'rb') as f:
+            file_bytes = f.read(100)
         
     # 检查文件大小
-    if len(file_bytes) < 1024:  # 小于1KB的文件可能无效
-        logging.warning(f"媒体文件过小 ({len(file_bytes)} 字节)，可能无效")
+    if file_size < 1024:  # 小于1KB的文件可能无效
+        logging.warning(f"媒体文件过小 ({file_size} 字节)，可能无效")
         return False
     
     # 视频文件验证
@@ -199,416 +194,497 @@ async def verify_media_file(file_bytes, file_ext):
     # 如果以上检测都通过了，我们认为文件可能是有效的
     return True
 
-async def analyze_media_with_gemini(file_bytes, file_ext, media_type, caption="", max_retries=3):
+async def analyze_media_with_gemini(media, file_ext, media_type, caption="", max_retries=3, prompt=None, on_text=None):
     """
     使用Google Gemini API分析媒体文件内容，支持重试机制
+    
+    磁盘上的文件通过上传管理器只上传一次，并轮询到ACTIVE状态后才开始分析；
+    重试时只重新调用 generate_content，复用同一个远程文件。相同内容的文件在一段时间内
+    再次分析（例如换一个说明重新提问）也会直接复用之前的上传。
+    Gemini 熔断时（包括重试过程中熔断）立即失败，不再等待和重试。
+    上传和生成请求在线程中执行，不阻塞事件循环，多个分析可以真正并发进行；
+    生成结果以流式方式返回，可通过 on_text 渐进显示。
+    
+    参数:
+        media: 媒体文件路径（直接上传），或内存中的字节数据（以内联数据发送，无需上传）
+        file_ext: 文件扩展名
+        media_type: 媒体类型（video 或 audio）
+        caption: 用户说明
+        max_retries: 最大重试次数
+        prompt: 自定义提示，为None时使用默认的描述提示
+        on_text: 流式生成时的回调 on_text(累计文本)，用于渐进显示分析结果
+    
+    返回:
+        分析结果文本；失败时抛出 MediaError
     """
+    media_name = "视频" if media_type == "video" else "音频"
     if not GOOGLE_API_KEY:
-        return "（无法分析媒体：未配置Google API密钥）"
+        raise MediaError(NOT_CONFIGURED, "无法分析媒体：未配置Google API密钥")
     
     # 验证媒体文件
-    if not await verify_media_file(file_bytes, file_ext):
-        return f"（无法分析媒体：文件验证失败，可能是无效的{media_type}文件）"
+    if not await verify_media_file(media, file_ext):
+        raise MediaError(INVALID_MEDIA, f"无法分析媒体：文件验证失败，可能是无效的{media_name}文件")
     
-    temp_path = None
+    # 使用 gemini-2.0-flash 模型
+    model = genai.GenerativeModel('gemini-2.0-flash')
     
-    for attempt in range(max_retries + 1):
-        try:
-            # 每次尝试都创建新的临时文件
-            with tempfile.NamedTemporaryFile(suffix=file_ext, delete=False) as temp_file:
-                temp_file.write(file_bytes)
-                temp_path = temp_file.name
-            
-            logging.info(f"开始使用Gemini分析{media_type}文件 (尝试 {attempt+1}/{max_retries+1})...")
-            
-            # 使用 gemini-2.0-flash 模型
-            model = genai.GenerativeModel('gemini-2.0-flash')
-            
-            # 构建提示根据媒体类型
-            if media_type == "video":
-                prompt = f"请详细描述这个视频的内容。如果用户提供了说明: {caption}，请特别关注相关内容。请用中文回答。"
-            else:  # audio
-                prompt = f"请详细描述这个音频的内容。如果用户提供了说明: {caption}，请特别关注相关内容。请用中文回答。"
-            
-            # 加载多媒体文件，确保文件存在且可访问
-            if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-                logging.error(f"临时文件不存在或为空: {temp_path}")
-                # 为下一次尝试准备新文件
-                await asyncio.sleep(1)
-                continue
-                
-            logging.info(f"上传{media_type}文件到Gemini API...")
-            media_file = genai.upload_file(temp_path)
-            
-            # 确保文件上传成功后再继续
-            await asyncio.sleep(1)
-            
-            # 调用API分析媒体
-            logging.info(f"调用Gemini API分析{media_type}内容...")
-            response = model.generate_content([prompt, media_file])
-            
-            # 清除临时文件
+    # 构建提示根据媒体类型（未提供自定义提示时）
+    if prompt is None:
+        prompt = f"请详细描述这个{media_name}的内容。如果用户提供了说明: {caption}，请特别关注相关内容。请用中文回答。"
+    
+    file_key = None
+    try:
+        for attempt in range(max_retries + 1):
             try:
-                if temp_path and os.path.exists(temp_path):
-                    os.unlink(temp_path)
-                    temp_path = None
+                if is_in_memory(media):
+                    # 小文件以内联数据随请求发送，省去上传和等待文件就绪
+                    media_file = {"mime_type": MEDIA_MIME_TYPES.get(file_ext.lower(), "application/octet-stream"), "data": bytes(media)}
+                elif file_key is None:
+                    # 确保文件存在且可访问
+                    if not os.path.exists(media) or os.path.getsize(media) == 0:
+                        logging.error(f"媒体文件不存在或为空: {media}")
+                        raise MediaError(ANALYSIS_FAILED, f"{media_name}分析失败: 媒体文件不存在或为空")
+                    
+                    logging.info(f"获取{media_type}文件的Gemini远程文件...")
+                    file_key, media_file = await gemini_files.acquire(media)
+                
+                # 调用API分析媒体
+                logging.info(f"调用Gemini API分析{media_type}内容 (尝试 {attempt+1}/{max_retries+1})...")
+                description = await generate_content_stream(model, [prompt, media_file], on_text)
+                
+                logging.info(f"{media_type}分析完成")
+                # 返回分析结果
+                return description
+                
+            except MediaError:
+                raise
+            except CircuitOpenError as e:
+                raise MediaError(UNAVAILABLE, f"{media_name}分析失败: {e}")
             except Exception as e:
-                logging.warning(f"清除临时文件时出错: {e}")
-            
-            logging.info(f"{media_type}分析完成")
-            # 返回分析结果
-            return response.text
-            
-        except Exception as e:
-            error_msg = str(e)
-            logging.error(f"使用Google Gemini API分析{media_type}时出错 (尝试 {attempt+1}/{max_retries+1}): {error_msg}")
-            
-            # 清除临时文件
-            try:
-                if temp_path and os.path.exists(temp_path):
-                    os.unlink(temp_path)
-                    temp_path = None
-            except Exception as file_e:
-                logging.warning(f"清除临时文件时出错: {file_e}")
-            
-            # 针对特定错误进行特殊处理
-            if "is not in an ACTIVE state" in error_msg:
-                logging.warning(f"文件状态不是ACTIVE，等待时间更长后重试")
-                await asyncio.sleep(5)  # 等待更长时间
+                error_msg = str(e)
+                logging.error(f"使用Google Gemini API分析{media_type}时出错 (尝试 {attempt+1}/{max_retries+1}): {error_msg}")
+                
+                # 针对特定错误进行特殊处理
+                if "file too large" in error_msg.lower():
+                    raise MediaError(TOO_LARGE, f"{media_name}文件过大，超出API限制")
+                elif "unsupported file type" in error_msg.lower():
+                    raise MediaError(UNSUPPORTED, f"不支持的{media_name}文件格式")
+                elif file_key and ("not found" in error_msg.lower() or "permission" in error_msg.lower()):
+                    # 远程文件已失效，下次重试时重新上传
+                    logging.warning("远程文件已失效，将重新上传")
+                    gemini_files.release(file_key)
+                    await gemini_files.invalidate(file_key)
+                    file_key = None
                 
-                # 如果是最后一次尝试，尝试改变策略
+                # 如果是最后一次尝试且失败
                 if attempt == max_retries:
-                    logging.info("尝试使用其他方法处理媒体...")
-                    # 这里可以添加一些备用策略
-            elif "file too large" in error_msg.lower():
-                return f"（{media_type}文件过大，超出API限制）"
-            elif "unsupported file type" in error_msg.lower():
-                return f"（不支持的{media_type}文件格式）"
-            else:
-                # 一般错误等待时间
-                await asyncio.sleep(3)
-            
-            # 如果是最后一次尝试且失败
-            if attempt == max_retries:
-                logging.error(f"{media_type}分析失败，已尝试{max_retries+1}次")
-                return f"（{media_type}分析失败: {error_msg}）"
+                    logging.error(f"{media_type}分析失败，已尝试{max_retries+1}次")
+                    raise MediaError(ANALYSIS_FAILED, f"{media_name}分析失败: {error_msg}")
+                
+                await asyncio.sleep(backoff_delay(attempt, 1, 8))
+    finally:
+        if file_key:
+            gemini_files.release(file_key)
 
-async def process_video(bot, file_id, caption="", chat_id=None):
+def transcode_reason(info, media_type):
     """
-    处理视频文件
+    判断媒体是否需要转码后才能交给Gemini
     
     参数:
-        bot: Telegram机器人对象
-        file_id: 文件ID
-        caption: 视频说明
-        chat_id: 聊天ID，用于发送处理状态消息
+        info: probe_media 返回的 MediaInfo
+        media_type: 媒体类型（video 或 audio）
+        
+    返回:
+        需要转码的原因；Gemini可以直接接受时返回 None
     """
+    formats = GEMINI_VIDEO_FORMATS if media_type == "video" else GEMINI_AUDIO_FORMATS
+    if not info.container:
+        return "无法识别的格式"
+    if info.ext not in formats:
+        return f"Gemini不直接支持 {info.container} 格式"
+    if media_type == "audio" and info.has_video:
+        return "音频文件中含有视频流"
+    
+    codecs = formats[info.ext]["codecs"]
+    codec = info.video_codec if media_type == "video" else info.audio_codec
+    if codecs and codec and codec.lower() not in codecs:
+        return f"Gemini不直接支持 {info.container} 中的 {codec} 编码"
+    return None
+
+async def remux_to_mp4(input_path, output_path):
+    """
+    将视频无损转封装为MP4（只复制音视频流，不重新编码）
+    
+    返回:
+        MP4文件路径，编码与MP4不兼容等原因失败时返回 None
+    """
+    cmd = [
+        'ffmpeg', '-i', input_path,
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-c', 'copy',
+        '-movflags', '+faststart',
+        '-y', output_path
+    ]
     try:
-        logging.info(f"开始处理视频文件 (ID: {file_id})")
-        
-        # 下载视频
-        video_bytes = await download_file(bot, file_id)
-        if not video_bytes:
-            return {
-                "description": "下载视频失败，请确保视频文件可以访问，并重新发送",
-                "file_content": None
-            }
+        logging.info(f"开始转封装视频: {' '.join(cmd)}")
+        await run_command(cmd)
+        return output_path
+    except Exception as e:
+        logging.warning(f"转封装视频失败，将使用原始文件继续处理: {e}")
+        return None
+
+async def acquire_video(request):
+    """
+    下载阶段：将视频下载到工作目录
+    
+    无需压缩的视频边下载边上传到Gemini，分析时直接复用已上传的远程文件。
+    """
+    logging.info(f"开始处理视频文件 (ID: {request.file_id})")
+    source_path = request.workspace.path("source.mp4")
+    video_path = None
+    if can_stream_upload(request.file_size, request.mime_type) and not should_use_storyboard(request.duration, request.file_size / (1024 * 1024)):
+        video_path = await download_with_streaming_upload(request.bot, request.file_id, source_path, request.file_size, request.mime_type, request.stage)
+    if not video_path:
+        video_path = await download_file(request.bot, request.file_id, source_path, expected_size=request.file_size, stage=request.stage)
+    if not video_path:
+        raise MediaError(
+            DOWNLOAD_FAILED,
+            "下载视频失败。可能原因：\n1. 文件仍在上传中\n2. 文件格式不兼容\n3. 网络连接问题",
+            "- 稍后重试\n- 压缩后再上传\n- 转换为MP4格式"
+        )
+    request.media = video_path
+
+async def probe_video(request):
+    """
+    探测阶段：读取视频信息并选择分析方式
+    
+    优先由内置解析器读取容器头，必要时回退到一次ffprobe；结果保存在 request.info 供后续阶段使用。
+    """
+    request.size_mb = os.path.getsize(request.media) / (1024 * 1024)
+    logging.info(f"原始视频大小: {request.size_mb:.2f}MB")
+    
+    request.info = await probe_media(request.media, need_video_info=True)
+    logging.info(f"视频信息: {request.info}")
+    
+    # 检查视频是否有效（无法识别的格式仍继续处理，有些视频ffprobe无法识别但ffmpeg仍可处理）
+    if request.info.container and not request.info.has_video and not request.info.duration:
+        logging.warning("视频文件可能无效或格式不受支持")
+        raise MediaError(INVALID_MEDIA, "视频文件格式无效或不受支持，请提供MP4、MOV或AVI格式的视频")
+    request.duration = request.duration or request.info.duration
+    
+    # 长视频或大文件使用关键帧模式，跳过压缩和完整视频上传
+    request.mode = "storyboard" if should_use_storyboard(request.duration, request.size_mb) else "full"
+    if request.mode == "storyboard" and overload_controller.at_least(LEVEL_MEDIA_LITE):
+        overload_controller.record("video_storyboard")
+
+async def transform_video(request):
+    """
+    处理阶段：关键帧模式下抽取关键帧和音轨；完整视频模式下按需压缩或转封装为Gemini接受的格式
+    """
+    bot, chat_id = request.bot, request.chat_id
+    video_path = request.media
+    info = request.info
+    
+    if request.mode == "storyboard":
+        await bot.send_message(chat_id=chat_id, text="🎞️ 视频较长或较大，正在抽取关键帧和音轨进行快速分析...")
+        request.frames = await extract_storyboard(video_path, request.workspace, request.duration, has_audio=info.has_audio or not info.container)
+        if request.frames:
+            return
+        logging.warning("关键帧模式抽帧失败，回退到完整视频分析")
+        request.mode = "full"
+    
+    # 如果视频超过大小限制，进行压缩
+    if request.size_mb > MAX_VIDEO_SIZE_MB:
+        logging.info(f"视频文件过大 ({request.size_mb:.2f}MB > {MAX_VIDEO_SIZE_MB}MB)，尝试压缩...")
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"⚠️ 视频文件过大 ({request.size_mb:.2f}MB)，可能导致处理失败。正在尝试压缩视频..."
+        )
         
-        # 检查视频大小
-        video_size_mb = len(video_bytes) / (1024 * 1024)
-        logging.info(f"原始视频大小: {video_size_mb:.2f}MB")
+        # 过载时降低分辨率并只编码一遍，缩短占用转码槽位的时间
+        degraded = overload_controller.at_least(LEVEL_MEDIA_LITE)
+        if degraded:
+            overload_controller.record("video_lite_encode")
+        compressed_path = await compress_video(
+            video_path,
+            request.workspace.path("compressed.mp4"),
+            target_size_mb=COMPRESSED_TARGET_SIZE_MB,
+            max_width=overload_controller.encode_width(COMPRESS_MAX_WIDTH),
+            two_pass=COMPRESS_TWO_PASS and not degraded,
+            info=info
+        )
+        if not compressed_path:
+            logging.error("视频压缩失败")
+            raise MediaError(TRANSFORM_FAILED, "视频压缩失败，请上传更小的视频或降低视频质量后重试。")
         
-        # 检查视频格式 - 使用临时文件和ffprobe
-        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_file:
-            temp_path = temp_file.name
-            temp_file.write(video_bytes)
+        compressed_size_mb = os.path.getsize(compressed_path) / (1024 * 1024)
+        logging.info(f"视频压缩成功: {request.size_mb:.2f}MB -> {compressed_size_mb:.2f}MB")
+        if compressed_size_mb > MAX_VIDEO_SIZE_MB:
+            logging.warning(f"压缩后视频仍然过大 ({compressed_size_mb:.2f}MB)，无法处理")
+            raise MediaError(TOO_LARGE, f"视频压缩后仍然过大 ({compressed_size_mb:.2f}MB > {MAX_VIDEO_SIZE_MB}MB)，无法处理。请上传更小的视频或降低视频质量后重试。")
         
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"✅ 视频压缩成功: {request.size_mb:.2f}MB -> {compressed_size_mb:.2f}MB"
+        )
+        request.media = compressed_path
+        request.media_ext = '.mp4'
+        return
+    
+    # 支持的格式按实际扩展名原样上传（上传时据此推断MIME类型），其他容器先无损转封装为MP4
+    reason = transcode_reason(info, "video")
+    if not reason:
+        if info.ext != '.mp4':
+            named_path = request.workspace.path(f"source{info.ext}")
+            os.replace(video_path, named_path)
+            video_path = named_path
+    else:
+        logging.info(f"视频需要转封装: {reason}")
+        video_path = await remux_to_mp4(video_path, request.workspace.path("remuxed.mp4")) or video_path
+    request.media = video_path
+    request.media_ext = os.path.splitext(video_path)[1]
+
+async def analyze_video(request):
+    """分析阶段：将关键帧和音轨，或完整视频交给Gemini分析"""
+    if request.frames:
+        frame_paths, audio_path = request.frames
         try:
-            # 使用ffprobe获取视频信息
-            probe_cmd = [
-                'ffprobe', '-v', 'error', '-show_entries', 
-                'format=duration,size:stream=width,height,codec_name', '-of', 
-                'json', temp_path
-            ]
-            
-            from video_compressor import run_command
-            video_info = await run_command(probe_cmd)
-            logging.info(f"视频信息: {video_info}")
-            
-            # 检查视频是否有效
-            if "codec_name" not in video_info and "duration" not in video_info:
-                logging.warning("视频文件可能无效或格式不受支持")
-                return {
-                    "description": "❌ 视频文件格式无效或不受支持，请提供MP4、MOV或AVI格式的视频",
-                    "file_content": None
-                }
+            async with memory_budget.reserve(storyboard_memory_bytes(frame_paths, audio_path), request.stage):
+                request.description = await analyze_storyboard_with_gemini(frame_paths, audio_path, request.caption, request.duration, request.on_text)
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            logging.error(f"获取视频信息失败: {e}")
-            # 继续处理，因为有些视频即使ffprobe无法识别，ffmpeg仍可处理
-        finally:
-            # 清理临时文件
-            try:
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-            except Exception as e:
-                logging.warning(f"清理临时文件失败: {e}")
-        
-        # 如果视频超过大小限制，进行压缩
-        if video_size_mb > MAX_VIDEO_SIZE_MB:
-            logging.info(f"视频文件过大 ({video_size_mb:.2f}MB > {MAX_VIDEO_SIZE_MB}MB)，尝试压缩...")
-            
-            # 发送压缩提示消息给用户
-            if chat_id:
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=f"⚠️ 视频文件过大 ({video_size_mb:.2f}MB)，可能导致处理失败。正在尝试压缩视频..."
-                )
-            
-            # 压缩视频
-            compressed_bytes = await compress_video(
-                video_bytes, 
-                target_size_mb=COMPRESSED_TARGET_SIZE_MB
-            )
-            
-            if compressed_bytes:
-                compressed_size_mb = len(compressed_bytes) / (1024 * 1024)
-                logging.info(f"视频压缩成功: {video_size_mb:.2f}MB -> {compressed_size_mb:.2f}MB")
-                
-                if compressed_size_mb <= MAX_VIDEO_SIZE_MB:
-                    # 使用压缩后的视频
-                    video_bytes = compressed_bytes
-                    
-                    # 告知用户压缩结果
-                    if chat_id:
-                        await bot.send_message(
-                            chat_id=chat_id,
-                            text=f"✅ 视频压缩成功: {video_size_mb:.2f}MB -> {compressed_size_mb:.2f}MB"
-                        )
-                else:
-                    logging.warning(f"压缩后视频仍然过大 ({compressed_size_mb:.2f}MB)，无法处理")
-                    return {
-                        "description": f"❌ 视频压缩后仍然过大 ({compressed_size_mb:.2f}MB > {MAX_VIDEO_SIZE_MB}MB)，无法处理。请上传更小的视频或降低视频质量后重试。",
-                        "file_content": None
-                    }
-            else:
-                logging.error("视频压缩失败")
-                return {
-                    "description": "❌ 视频压缩失败，请上传更小的视频或降低视频质量后重试。",
-                    "file_content": None
-                }
-                
-        # 准备分析前检查视频是否符合Gemini要求
-        # Gemini通常接受MP4、MOV格式，建议视频时长小于2分钟
-        
-        # 分析视频前告知用户
-        if chat_id:
-            await bot.send_message(
-                chat_id=chat_id,
-                text="🔍 正在分析视频，如果分析失败，建议尝试：\n1. 上传更短的视频片段（30秒以内）\n2. 使用MP4格式\n3. 降低视频分辨率"
-            )
-        
-        # 分析视频
-        logging.info(f"视频处理准备完成，开始分析...")
-        description = await analyze_media_with_gemini(video_bytes, ".mp4", "video", caption)
-        
-        # 返回分析结果
-        return {
-            "description": description,
-            "file_content": "视频内容过大，不进行base64编码"
-        }
-    except Exception as e:
-        logging.error(f"处理视频时出错: {e}")
-        return {
-            "description": f"处理视频时出错: {str(e)}",
-            "file_content": None
-        }
+            logging.error(f"使用Gemini分析关键帧时出错: {e}")
+            raise MediaError(ANALYSIS_FAILED, f"视频分析失败: {str(e)}")
+        return
+    
+    # 分析视频前告知用户
+    await request.bot.send_message(
+        chat_id=request.chat_id,
+        text="🔍 正在分析视频，如果分析失败，建议尝试：\n1. 上传更短的视频片段（30秒以内）\n2. 使用MP4格式\n3. 降低视频分辨率"
+    )
+    logging.info(f"视频处理准备完成，开始分析...")
+    request.description = await analyze_media_with_gemini(request.media, request.media_ext, "video", request.caption, on_text=request.on_text)
+
+# 视频处理的各阶段
+VIDEO_STAGES = {
+    "acquire": acquire_video,
+    "probe": probe_video,
+    "transform": transform_video,
+    "analyze": analyze_video,
+}
 
-async def convert_audio_to_mp3(audio_bytes, original_ext, chat_id=None, bot=None):
+async def convert_audio_to_mp3(media, original_ext, workspace):
     """
-    将不同格式的音频转换为MP3格式
+    将Gemini不直接支持的音频转换为面向语音的低码率单声道MP3
+    
+    内存中的音频通过管道转码：输入写入ffmpeg标准输入，输出从标准输出读取，不产生任何临时文件。
+    只有需要随机访问的容器格式（如m4a）才先写入工作目录再由ffmpeg读取。
+    磁盘上的音频直接由ffmpeg读取并写入工作目录。
     
     参数:
-        audio_bytes: 音频文件字节
+        media: 音频文件路径或内存中的字节数据
         original_ext: 原始文件扩展名
-        chat_id: 聊天ID，用于发送状态消息
-        bot: Telegram机器人对象
+        workspace: 任务工作目录（MediaWorkspace）
         
     返回:
-        转换后的MP3格式音频字节，如果转换失败则返回None
+        转换后的MP3（与输入同类型：字节数据或文件路径），如果转换失败则返回None
     """
     # 如果已经是MP3，就不需要转换
     if original_ext.lower() == '.mp3':
-        return audio_bytes
-        
-    # 需要使用ffmpeg转换
-    with tempfile.NamedTemporaryFile(suffix=original_ext, delete=False) as input_file:
-        input_path = input_file.name
-        input_file.write(audio_bytes)
-    
-    # 创建输出临时文件
-    output_fd, output_path = tempfile.mkstemp(suffix='.mp3')
-    os.close(output_fd)
+        return media
     
     try:
-        if chat_id and bot:
-            await bot.send_message(
-                chat_id=chat_id,
-                text=f"🔄 正在转换音频格式为MP3，以提高兼容性..."
-            )
-            
-        # 转换命令
-        cmd = [
-            'ffmpeg', '-i', input_path,
-            '-c:a', 'libmp3lame',
-            '-q:a', '2',  # 高质量MP3
-            '-y', output_path
-        ]
+        output_args = SPEECH_AUDIO_ARGS
         
-        logging.info(f"开始转换音频: {' '.join(cmd)}")
+        if is_in_memory(media):
+            input_format = PIPE_INPUT_FORMATS.get(original_ext.lower())
+            if input_format:
+                cmd = ['ffmpeg', '-f', input_format, '-i', 'pipe:0'] + output_args + ['-f', 'mp3', 'pipe:1']
+                logging.info(f"开始通过管道转换音频: {' '.join(cmd)}")
+                mp3_bytes = await run_command_piped(cmd, input_data=media, priority=PRIORITY_AUDIO, max_output_bytes=PIPE_AUDIO_MAX_BYTES * 4)
+            else:
+                # 该容器格式需要随机访问，回退到文件输入
+                input_path = workspace.path(f"source{original_ext}")
+                with open(input_path, 'wb') as f:
+                    f.write(media)
+                cmd = ['ffmpeg', '-i', input_path] + output_args + ['-f', 'mp3', 'pipe:1']
+                logging.info(f"{original_ext} 格式需要随机访问，使用文件输入转换音频: {' '.join(cmd)}")
+                mp3_bytes = await run_command_piped(cmd, priority=PRIORITY_AUDIO, max_output_bytes=PIPE_AUDIO_MAX_BYTES * 4)
+            
+            logging.info(f"音频转换成功: {len(media)} 字节 -> {len(mp3_bytes)} 字节")
+            return mp3_bytes
         
-        # 执行ffmpeg命令
-        from video_compressor import run_command
-        await run_command(cmd)
+        output_path = workspace.path("converted.mp3")
+        cmd = ['ffmpeg', '-i', media] + output_args + ['-y', output_path]
+        logging.info(f"开始转换音频: {' '.join(cmd)}")
         
-        # 读取转换后的文件
-        with open(output_path, 'rb') as f:
-            mp3_bytes = f.read()
+        # 执行ffmpeg命令（短音频转换优先于视频编码执行）
+        await run_command(cmd, priority=PRIORITY_AUDIO)
             
-        logging.info(f"音频转换成功: {len(audio_bytes)} 字节 -> {len(mp3_bytes)} 字节")
-        return mp3_bytes
+        logging.info(f"音频转换成功: {os.path.getsize(media)} 字节 -> {os.path.getsize(output_path)} 字节")
+        return output_path
         
     except Exception as e:
         logging.error(f"转换音频失败: {e}")
         return None
-    
-    finally:
-        # 清理临时文件
-        try:
-            if os.path.exists(input_path):
-                os.unlink(input_path)
-            if os.path.exists(output_path):
-                os.unlink(output_path)
-        except Exception as e:
-            logging.error(f"清理音频转换临时文件时出错: {e}")
 
-async def process_audio(bot, file_id, caption="", chat_id=None):
+async def analyze_audio_chunks(chunks, duration, caption=""):
     """
-    处理音频文件
+    长音频模式：将在静音处切分好的分段并发交给Gemini分析，再按时间顺序合并
+    
+    每段都已转码为语音MP3（几百KB到一两MB），以内联数据发送，无需上传文件；
+    同时进行的分析请求数不超过 AUDIO_CHUNK_CONCURRENCY。
     
     参数:
-        bot: Telegram机器人对象
-        file_id: 文件ID
-        caption: 音频说明
-        chat_id: 聊天ID，用于发送处理状态消息
-    """
-    try:
-        logging.info(f"开始处理音频文件 (ID: {file_id})")
-        
-        # 下载音频
-        audio_bytes = await download_file(bot, file_id)
-        if not audio_bytes:
-            return {
-                "description": "下载音频失败，请确保音频文件可以访问，并重新发送",
-                "file_content": None
-            }
+        chunks: chunk_audio 返回的分段 [(路径, 开始, 结束)]
+        duration: 音频时长（秒）
+        caption: 用户说明
         
-        # 检查音频大小
-        audio_size_mb = len(audio_bytes) / (1024 * 1024)
-        logging.info(f"原始音频大小: {audio_size_mb:.2f}MB")
-        
-        # 音频文件超过大小限制
-        if audio_size_mb > MAX_VIDEO_SIZE_MB:  # 使用相同的大小限制
-            logging.warning(f"音频文件过大 ({audio_size_mb:.2f}MB > {MAX_VIDEO_SIZE_MB}MB)，无法处理")
-            return {
-                "description": f"❌ 音频文件过大 ({audio_size_mb:.2f}MB > {MAX_VIDEO_SIZE_MB}MB)，无法处理。请上传更小的音频文件。",
-                "file_content": None
-            }
-            
-        # 检查并尝试获取音频格式
-        audio_format = '.mp3'  # 默认格式
-        
-        # 尝试通过ffprobe获取音频信息
-        with tempfile.NamedTemporaryFile(suffix='.audio', delete=False) as temp_file:
-            temp_path = temp_file.name
-            temp_file.write(audio_bytes)
-            
-        try:
-            # 使用ffprobe获取音频信息
-            probe_cmd = [
-                'ffprobe', '-v', 'error', '-show_entries', 
-                'format=format_name,duration:stream=codec_name', '-of', 
-                'json', temp_path
-            ]
-            
-            from video_compressor import run_command
-            audio_info = await run_command(probe_cmd)
-            logging.info(f"音频信息: {audio_info}")
-            
-            # 根据ffprobe结果确定文件格式
-            if 'mp3' in audio_info.lower():
-                audio_format = '.mp3'
-            elif 'wav' in audio_info.lower():
-                audio_format = '.wav'
-            elif 'ogg' in audio_info.lower() or 'vorbis' in audio_info.lower():
-                audio_format = '.ogg'
-            elif 'aac' in audio_info.lower():
-                audio_format = '.aac'
-            elif 'm4a' in audio_info.lower() or 'mp4a' in audio_info.lower():
-                audio_format = '.m4a'
-            elif 'flac' in audio_info.lower():
-                audio_format = '.flac'
-                
-            logging.info(f"检测到音频格式: {audio_format}")
-        except Exception as e:
-            logging.warning(f"无法获取音频格式信息: {e}，使用默认格式.mp3")
-        finally:
-            # 清理临时文件
-            try:
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-            except:
-                pass
-        
-        # 如果不是MP3格式，尝试转换
-        if audio_format.lower() != '.mp3':
-            if chat_id:
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=f"检测到音频格式为 {audio_format}，尝试转换为MP3以提高兼容性..."
-                )
-            
-            converted_bytes = await convert_audio_to_mp3(audio_bytes, audio_format, chat_id, bot)
-            if converted_bytes:
-                audio_bytes = converted_bytes
-                audio_format = '.mp3'
-                logging.info("音频已成功转换为MP3格式")
-                
-                if chat_id:
-                    await bot.send_message(
-                        chat_id=chat_id,
-                        text="✅ 音频格式转换成功"
-                    )
-            else:
-                logging.warning("音频转换失败，将使用原始格式继续处理")
-                
-                if chat_id:
-                    await bot.send_message(
-                        chat_id=chat_id,
-                        text="⚠️ 音频格式转换失败，将尝试直接处理，但可能会遇到兼容性问题"
-                    )
-        
-        # 分析音频
-        logging.info(f"音频处理准备完成，开始分析...")
-        description = await analyze_media_with_gemini(audio_bytes, audio_format, "audio", caption)
+    返回:
+        合并后的分析结果文本
+    """
+    logging.info(f"长音频共 {len(chunks)} 段，开始并发分析 (并发上限 {AUDIO_CHUNK_CONCURRENCY})")
+    semaphore = asyncio.Semaphore(AUDIO_CHUNK_CONCURRENCY)
+    
+    async def analyze_chunk(index, chunk_path, start, end):
+        # 分段数据在内联发送时还有一份副本，按两倍大小预留
+        async with semaphore, memory_budget.reserve(os.path.getsize(chunk_path) * 2, "analyze"):
+            with open(chunk_path, 'rb') as f:
+                chunk_bytes = f.read()
+            prompt = (
+                f"这是一段长音频的第{index + 1}/{len(chunks)}部分（{format_timestamp(start)} - {format_timestamp(end)}）。"
+                f"请详细转述这一部分的内容，包括说话人讲述的要点和重要细节。"
+                f"如果用户提供了说明: {caption}，请特别关注相关内容。请用中文回答。"
+            )
+            return await analyze_media_with_gemini(chunk_bytes, '.mp3', "audio", caption, prompt=prompt)
+    
+    results = await asyncio.gather(*(
+        analyze_chunk(index, chunk_path, start, end)
+        for index, (chunk_path, start, end) in enumerate(chunks)
+    ), return_exceptions=True)
+    
+    # 按时间顺序合并各段结果；失败的分段保留占位，不影响其他分段
+    parts = []
+    failed = 0
+    for (_, start, end), result in zip(chunks, results):
+        if isinstance(result, Exception):
+            failed += 1
+            logging.warning(f"分段 {format_timestamp(start)} - {format_timestamp(end)} 分析失败: {result}")
+            result = "（该部分未能分析）"
+        parts.append(f"【{format_timestamp(start)} - {format_timestamp(end)}】\n{result}")
+    
+    if failed == len(chunks):
+        # Gemini熔断导致全部失败时给出熔断的说明
+        for result in results:
+            if isinstance(result, MediaError) and result.code == UNAVAILABLE:
+                raise result
+        raise MediaError(ANALYSIS_FAILED, f"音频分析失败: 全部 {len(chunks)} 个分段均未能分析")
+    
+    logging.info(f"长音频分析完成: {len(chunks) - failed}/{len(chunks)} 段成功")
+    header = f"（长音频，总时长 {format_timestamp(duration)}，分为 {len(chunks)} 段分析，以下按时间顺序排列）"
+    return header + "\n\n" + "\n\n".join(parts)
+
+async def acquire_audio(request):
+    """
+    下载阶段：小音频（如语音消息）下载到内存，全程不落盘；大音频下载到工作目录
+    
+    较大的音频边下载边上传到Gemini，分析时直接复用已上传的远程文件。
+    """
+    logging.info(f"开始处理音频文件 (ID: {request.file_id})")
+    in_memory = request.file_size is not None and request.file_size <= PIPE_AUDIO_MAX_BYTES
+    # 内存中的音频在转码和内联发送时各有一份副本，按两倍大小一次性预留；预算不足时改用磁盘处理，不排队等待
+    if in_memory and not try_hold_memory(request, request.file_size * 2):
+        logging.info(f"内存预算不足，音频改为下载到磁盘处理 ({request.file_size} 字节)")
+        memory_budget.record_spill(request.stage)
+        in_memory = False
+    source_path = request.workspace.path("source.audio")
+    audio = None
+    if not in_memory and can_stream_upload(request.file_size, request.mime_type) and not is_long_audio(request.duration):
+        audio = await download_with_streaming_upload(request.bot, request.file_id, source_path, request.file_size, request.mime_type, request.stage)
+    if not audio:
+        audio = await download_file(request.bot, request.file_id, None if in_memory else source_path, expected_size=request.file_size, stage=request.stage)
+    if not audio:
+        raise MediaError(DOWNLOAD_FAILED, "下载音频失败，请确保音频文件可以访问，并重新发送")
+    request.media = audio
+
+async def probe_audio(request):
+    """
+    探测阶段：根据容器头识别音频格式和时长，并选择分析方式
+    
+    无法识别时按MP3处理；长音频或超过大小限制的音频分段并发分析，超过大小限制但无法确定时长的音频直接拒绝。
+    """
+    audio = request.media
+    in_memory = is_in_memory(audio)
+    request.size_mb = (len(audio) if in_memory else os.path.getsize(audio)) / (1024 * 1024)
+    logging.info(f"原始音频大小: {request.size_mb:.2f}MB ({'内存' if in_memory else '磁盘'}处理)")
+    
+    request.info = await probe_media(audio, need_duration=not request.duration)
+    request.media_ext = request.info.ext or '.mp3'
+    request.duration = request.duration or request.info.duration
+    logging.info(f"检测到音频格式: {request.media_ext} ({request.info})")
+    
+    if not in_memory:
+        # 为源文件加上正确的扩展名（同目录重命名，不复制数据），上传时据此推断MIME类型
+        named_path = request.workspace.path(f"source{request.media_ext}")
+        os.replace(audio, named_path)
+        request.media = named_path
+    
+    if request.size_mb > MAX_VIDEO_SIZE_MB and not request.duration:
+        # 分段需要时长；无法确定时长的大文件不能整体上传
+        raise MediaError(TOO_LARGE, f"音频文件过大 ({request.size_mb:.2f}MB > {MAX_VIDEO_SIZE_MB}MB) 且无法识别时长，无法处理。请转换为MP3等常见格式或上传更短的音频后重试。")
+    if request.duration and (is_long_audio(request.duration) or request.size_mb > MAX_VIDEO_SIZE_MB):
+        request.mode = "long_audio"
+
+async def transform_audio(request):
+    """
+    处理阶段：长音频在静音处切分为转码后的分段；其他音频只有Gemini不直接支持的格式才转码
+    """
+    if request.mode == "long_audio":
+        audio = request.media
+        if is_in_memory(audio):
+            audio_path = request.workspace.path(f"source{request.media_ext}")
+            with open(audio_path, 'wb') as f:
+                f.write(audio)
+            request.media = audio_path
+            # 之后只从磁盘读取分段，提前归还内存预算
+            release_memory(request)
         
-        # 返回分析结果
-        return {
-            "description": description,
-            "file_content": "音频内容过大，不进行base64编码"
-        }
-    except Exception as e:
-        logging.error(f"处理音频时出错: {e}")
-        return {
-            "description": f"处理音频时出错: {str(e)}",
-            "file_content": None
-        } 
\ No newline at end of file
+        chunk_dir = request.workspace.path("chunks")
+        os.makedirs(chunk_dir, exist_ok=True)
+        request.chunks = await chunk_audio(request.media, chunk_dir, request.duration, SPEECH_AUDIO_ARGS)
+        if not request.chunks:
+            raise MediaError(TRANSFORM_FAILED, "音频分析失败: 音频切分失败")
+        return
+    
+    # 语音消息（OGG/Opus）等Gemini可直接接受的格式原样发送
+    reason = transcode_reason(request.info, "audio")
+    if not reason:
+        logging.info(f"Gemini可直接接受 {request.media_ext} 格式，跳过转码")
+        return
+    
+    logging.info(f"音频需要转码: {reason}")
+    converted = await convert_audio_to_mp3(request.media, request.media_ext, request.workspace)
+    if converted:
+        request.media = converted
+        request.media_ext = '.mp3'
+        logging.info("音频已成功转换为MP3格式")
+    else:
+        logging.warning("音频转换失败，将使用原始格式继续处理")
+
+async def analyze_audio(request):
+    """分析阶段：长音频分段并发分析后按顺序合并，其他音频一次交给Gemini分析"""
+    if request.chunks:
+        request.description = await analyze_audio_chunks(request.chunks, request.duration, request.caption)
+        return
+    
+    logging.info(f"音频处理准备完成，开始分析...")
+    request.description = await analyze_media_with_gemini(request.media, request.media_ext, "audio", request.caption, on_text=request.on_text)
+
+# 音频处理的各阶段
+AUDIO_STAGES = {
+    "acquire": acquire_audio,
+    "probe": probe_audio,
+    "transform": transform_audio,
+    "analyze": analyze_audio,
+}
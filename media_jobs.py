@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from collections import deque
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 任务记录持久化在数据目录中，容器重启后据此恢复
+DATA_DIR = "data"
+JOBS_FILE = os.path.join(DATA_DIR, "media_jobs.json")
+
+# 同时执行的媒体任务数（通用工作协程，按任务类型的优先级取任务）
+MEDIA_JOB_WORKERS = int(os.environ.get("MEDIA_JOB_WORKERS", "2"))
+
+# 只处理音频任务的专用工作协程数：通用工作协程都在压缩长视频时，语音消息也不必等待
+MEDIA_AUDIO_JOB_WORKERS = int(os.environ.get("MEDIA_AUDIO_JOB_WORKERS", "1"))
+
+# 单个任务最多执行的次数（包括重启后的恢复执行），超过后不再重试
+MEDIA_JOB_MAX_ATTEMPTS = int(os.environ.get("MEDIA_JOB_MAX_ATTEMPTS", "2"))
+
+# 重启时超过该时长（秒）的未完成任务不再恢复，直接标记为失败
+MEDIA_JOB_MAX_AGE = float(os.environ.get("MEDIA_JOB_MAX_AGE", "3600"))
+
+# 任务状态
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+
+class JobProgress:
+    """
+    任务的进度消息
+
+    只保存 chat_id 和 message_id，重启后也能继续编辑同一条进度消息；
+    提供与 telegram.Message 相同的 edit_text 接口。
+    """
+
+    def __init__(self, bot, chat_id, message_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def edit_text(self, text, **kwargs):
+        return await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+
+class MediaJobQueue:
+    """
+    后台媒体任务队列
+
+    处理程序只登记任务并立即返回，由固定数量的工作协程执行。
+    每种任务类型有自己的队列（通道）：通用工作协程优先取优先级高（数值小）的通道中的任务，
+    各类型还可以有只处理该类型的专用工作协程，避免短任务排在长任务后面。
+    未完成的任务记录写入 JOBS_FILE：重启后排队中和执行中断的任务重新入队，
+    已达到最大执行次数或过旧的任务标记为失败并通知用户。
+
+    用法:
+        media_jobs.register("audio", run_audio_job, priority=0, reserved_workers=MEDIA_AUDIO_JOB_WORKERS)
+        media_jobs.register("video", run_video_job, priority=1)   # run_video_job(job, bot, progress)
+        await media_jobs.start(bot)
+        position = await media_jobs.submit("video", chat_id, progress_message_id, {...})
+    """
+
+    def __init__(self, path=JOBS_FILE, workers=MEDIA_JOB_WORKERS):
+        self.path = path
+        self.workers = workers
+        self.bot = None
+        self._runners = {}  # 任务类型 -> 执行函数
+        self._priorities = {}  # 任务类型 -> 优先级（数值小的先执行）
+        self._reserved = {}  # 任务类型 -> 专用工作协程数
+        self._lanes = {}  # 任务类型 -> 排队中的任务ID
+        self._jobs = {}  # 任务ID -> 任务记录（只保存未完成的任务）
+        self._available = None  # 在 start 中创建，绑定到机器人运行的事件循环；有任务入队时通知工作协程
+        self._tasks = []
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "recovered": 0,
+            "abandoned": 0,
+            "wait_seconds": 0.0,
+            "run_seconds": 0.0,
+        }
+
+    def register(self, kind, runner, priority=0, reserved_workers=0):
+        """
+        注册任务类型的执行函数
+
+        参数:
+            kind: 任务类型，如 "video"、"audio"
+            runner: 异步函数 runner(job, bot, progress)，progress 为 JobProgress；
+                可返回带 ok/error 属性的结果（如 PipelineResult），ok 为 False 时计为失败（由 runner 负责通知用户）
+            priority: 通用工作协程取任务的优先级，数值小的先执行
+            reserved_workers: 只处理该类型任务的专用工作协程数
+        """
+        self._runners[kind] = runner
+        self._priorities[kind] = priority
+        self._reserved[kind] = reserved_workers
+        self._lanes.setdefault(kind, deque())
+
+    async def _enqueue(self, job_id, kind):
+        async with self._available:
+            self._lanes[kind].append(job_id)
+            self._available.notify_all()
+
+    async def _next_job(self, kinds):
+        """等待并取出 kinds 中优先级最高且非空的通道中最早的任务"""
+        kinds = sorted(kinds, key=lambda kind: self._priorities[kind])
+        async with self._available:
+            await self._available.wait_for(lambda: any(self._lanes[kind] for kind in kinds))
+            for kind in kinds:
+                if self._lanes[kind]:
+                    return self._lanes[kind].popleft()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"加载媒体任务记录时出错: {e}")
+            return {}
+
+    def _save(self):
+        """写入临时文件后替换，避免写到一半时崩溃损坏记录"""
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(self._jobs, f, indent=2, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logging.error(f"保存媒体任务记录时出错: {e}")
+
+    async def start(self, bot):
+        """恢复上次未完成的任务并启动工作协程"""
+        self.bot = bot
+        self._available = asyncio.Condition()
+        now = time.time()
+
+        for job_id, job in sorted(self._load().items(), key=lambda item: item[1]["created"]):
+            progress = JobProgress(bot, job["chat_id"], job["progress_message_id"])
+            if job["attempts"] >= MEDIA_JOB_MAX_ATTEMPTS or now - job["created"] > MEDIA_JOB_MAX_AGE:
+                self.stats["abandoned"] += 1
+                logging.warning(f"媒体任务 {job_id} 在重启前未完成，不再恢复 (已执行 {job['attempts']} 次)")
+                await self._notify(progress, "❌ 处理过程中机器人重启，该任务已取消。请重新发送文件。")
+                continue
+
+            if job["kind"] not in self._runners:
+                self.stats["abandoned"] += 1
+                logging.warning(f"媒体任务 {job_id} 的类型 {job['kind']} 未注册，不再恢复")
+                await self._notify(progress, "❌ 处理过程中机器人重启，该任务已取消。请重新发送文件。")
+                continue
+
+            job["status"] = STATUS_QUEUED
+            self._jobs[job_id] = job
+            self._lanes[job["kind"]].append(job_id)
+            self.stats["recovered"] += 1
+            logging.info(f"已恢复媒体任务 {job_id} ({job['kind']})")
+            await self._notify(progress, "🔄 机器人已重启，正在重新处理您的文件...")
+
+        self._save()
+        self._tasks = [asyncio.create_task(self._worker(index, list(self._runners))) for index in range(self.workers)]
+        for kind, count in self._reserved.items():
+            self._tasks += [asyncio.create_task(self._worker(f"{kind}-{index}", [kind])) for index in range(count)]
+        reserved = ", ".join(f"{kind} 专用 {count} 个" for kind, count in self._reserved.items() if count)
+        logging.info(f"媒体任务队列已启动: {self.workers} 个通用工作协程{', ' + reserved if reserved else ''}, 恢复 {len(self._jobs)} 个任务")
+
+    async def stop(self):
+        """停止工作协程；执行中的任务保留在记录中，下次启动时恢复"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, kind, chat_id, progress_message_id, payload):
+        """
+        登记一个媒体任务
+
+        参数:
+            kind: 任务类型
+            chat_id: 聊天ID
+            progress_message_id: 进度消息ID，任务执行过程中编辑该消息
+            payload: 执行任务所需的参数（需可JSON序列化）
+
+        返回:
+            同一通道中排在它前面的任务数
+        """
+        if kind not in self._runners:
+            raise ValueError(f"未注册的媒体任务类型: {kind}")
+
+        position = len(self._lanes[kind])
+        job_id = uuid.uuid4().hex[:12]
+        self._jobs[job_id] = {
+            "job_id": job_id,
+            "kind": kind,
+            "chat_id": chat_id,
+            "progress_message_id": progress_message_id,
+            "payload": payload,
+            "status": STATUS_QUEUED,
+            "attempts": 0,
+            "created": time.time(),
+        }
+        self._save()
+        await self._enqueue(job_id, kind)
+        self.stats["submitted"] += 1
+        logging.info(f"已登记媒体任务 {job_id} ({kind})，{kind} 通道中前面还有 {position} 个任务")
+        return position
+
+    async def _notify(self, progress, text):
+        try:
+            await progress.edit_text(text)
+        except Exception as e:
+            logging.warning(f"更新媒体任务进度消息失败: {e}")
+
+    async def _worker(self, index, kinds):
+        while True:
+            job_id = await self._next_job(kinds)
+            job = self._jobs.get(job_id)
+            if job is None:
+                continue
+
+            job["status"] = STATUS_RUNNING
+            job["attempts"] += 1
+            self._save()
+
+            start_time = time.time()
+            self.stats["wait_seconds"] += start_time - job["created"]
+            progress = JobProgress(self.bot, job["chat_id"], job["progress_message_id"])
+
+            try:
+                result = await self._runners[job["kind"]](job, self.bot, progress)
+                if result is not None and not result.ok:
+                    # 执行函数已向用户报告失败原因，这里只计数
+                    self.stats["failed"] += 1
+                    logging.warning(f"媒体任务 {job_id} 处理失败: {result.error} (工作协程 {index})")
+                else:
+                    self.stats["completed"] += 1
+                    logging.info(f"媒体任务 {job_id} 已完成 (工作协程 {index}, 耗时 {time.time() - start_time:.2f} 秒)")
+            except asyncio.CancelledError:
+                # 停止时保留记录，下次启动时恢复
+                raise
+            except Exception as e:
+                self.stats["failed"] += 1
+                logging.error(f"媒体任务 {job_id} 执行失败: {e}")
+                await self._notify(progress, f"❌ 处理文件时出错: {str(e)}")
+
+            self.stats["run_seconds"] += time.time() - start_time
+            self._jobs.pop(job_id, None)
+            self._save()
+
+    def get_stats(self):
+        """返回队列统计（包括当前排队和执行中的任务数，以及各通道的排队数）"""
+        running = sum(1 for job in self._jobs.values() if job["status"] == STATUS_RUNNING)
+        started = self.stats["completed"] + self.stats["failed"]
+        return {
+            **self.stats,
+            "workers": self.workers + sum(self._reserved.values()),
+            "reserved_workers": dict(self._reserved),
+            "lanes": {kind: len(lane) for kind, lane in self._lanes.items()},
+            "queued": len(self._jobs) - running,
+            "running": running,
+            "avg_wait_seconds": self.stats["wait_seconds"] / started if started else 0.0,
+            "avg_run_seconds": self.stats["run_seconds"] / started if started else 0.0,
+        }
+
+# 创建全局实例
+media_jobs = MediaJobQueue()
@@ -0,0 +1,316 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from media_workspace import MediaWorkspace, WORKSPACE_RESERVE_FACTOR
+from memory_budget import memory_budget
+from circuit_breaker import CircuitOpenError
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 媒体处理的阶段（按执行顺序）；各媒体类型只需为用到的阶段提供处理函数
+STAGES = ("acquire", "probe", "transform", "analyze", "prompt", "respond")
+
+# 各阶段同时执行的任务数上限（所有媒体类型共享），0表示不限制
+# 例如 PIPELINE_STAGE_LIMITS="acquire=2,analyze=3" 可分别限制同时下载数和同时调用Gemini的数量
+DEFAULT_STAGE_LIMITS = {
+    "acquire": 4,
+    "analyze": 4,
+}
+
+def parse_stage_limits(value):
+    """解析 "阶段=上限,..." 格式的配置，未配置的阶段使用默认值"""
+    limits = dict(DEFAULT_STAGE_LIMITS)
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        name, limit = item.split('=', 1)
+        name = name.strip()
+        if name not in STAGES:
+            logging.warning(f"PIPELINE_STAGE_LIMITS 中的未知阶段: {name}")
+            continue
+        limits[name] = int(limit)
+    return limits
+
+STAGE_LIMITS = parse_stage_limits(os.environ.get("PIPELINE_STAGE_LIMITS", ""))
+
+# 错误类型
+DOWNLOAD_FAILED = "download_failed"
+INVALID_MEDIA = "invalid_media"
+TOO_LARGE = "too_large"
+TRANSFORM_FAILED = "transform_failed"
+UNSUPPORTED = "unsupported"
+ANALYSIS_FAILED = "analysis_failed"
+NOT_CONFIGURED = "not_configured"
+UNAVAILABLE = "unavailable"  # 依赖的外部服务已熔断
+INTERNAL = "internal"
+
+class MediaError(Exception):
+    """
+    媒体处理中的失败
+
+    code 为错误类型（如 DOWNLOAD_FAILED），message 为给用户看的说明，
+    hint 为可选的处理建议；stage 由流水线在失败时填写。
+    """
+
+    def __init__(self, code, message, hint=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.hint = hint
+        self.stage = None
+
+    def user_text(self):
+        """给用户看的错误消息"""
+        text = f"❌ {self.message}"
+        if self.hint:
+            text += f"\n\n建议：\n{self.hint}"
+        return text
+
+class MediaRequest:
+    """
+    一次媒体请求在各阶段之间传递的状态
+
+    构造时给出的是请求参数，其余字段由各阶段依次填写。
+    """
+
+    def __init__(self, kind, bot, chat_id, user_id, caption="", media_name=None, progress=None,
+                 file_id=None, file_ids=None, file_size=None, duration=None, mime_type=None):
+        # 请求参数
+        self.kind = kind  # 媒体类型：photo、video、audio
+        self.bot = bot
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.caption = caption
+        self.media_name = media_name or kind  # 给用户看的名称，如"视频"、"语音"
+        self.progress = progress  # 进度消息（带 edit_text 方法）
+        self.on_text = None  # 渐进显示分析结果的回调
+        self.file_id = file_id
+        self.file_ids = file_ids or ([file_id] if file_id else [])
+        self.file_size = file_size  # 消息中声明的文件大小（字节）
+        self.duration = duration  # 消息中声明的时长（秒），探测后补全
+        self.mime_type = mime_type
+        self.stage = None  # 当前执行的阶段
+        self.reservations = []  # 持有到流水线结束的内存预留
+
+        # 各阶段的产出
+        self.workspace = None  # MediaWorkspace
+        self.media = None  # acquire/transform：文件路径或内存中的字节数据
+        self.media_ext = None  # transform：交给分析阶段的文件扩展名
+        self.info = None  # probe：MediaInfo
+        self.size_mb = 0.0  # probe：下载后的实际大小（MB）
+        self.mode = None  # probe/transform：分析方式（如 storyboard、long_audio）
+        self.images = []  # acquire：图片字节数据列表
+        self.attachments = []  # transform：Poe附件（图片直接发送模式）
+        self.frames = None  # transform：关键帧模式的 (关键帧路径列表, 音轨路径)
+        self.chunks = None  # transform：长音频分段 [(路径, 开始, 结束)]
+        self.description = ""  # analyze：分析结果
+        self.message = None  # prompt：发送给Poe的 fp.ProtocolMessage
+        self.bot_name = None  # prompt：回复使用的Poe机器人
+
+class PipelineResult:
+    """流水线执行结果"""
+
+    def __init__(self, request, error=None, timings=None):
+        self.request = request
+        self.error = error  # MediaError，成功时为None
+        self.timings = timings or {}  # 阶段 -> 耗时（秒）
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def description(self):
+        return self.request.description
+
+    def to_dict(self):
+        return {
+            "ok": self.ok,
+            "description": self.request.description,
+            "error": {"code": self.error.code, "stage": self.error.stage, "message": self.error.message} if self.error else None,
+            "timings": self.timings,
+            "workspace_bytes": self.request.workspace.peak_bytes if self.request.workspace else 0,
+        }
+
+class StageLimiter:
+    """各阶段的并发上限和统计（所有流水线共享）"""
+
+    def __init__(self, limits=STAGE_LIMITS):
+        self.limits = limits
+        self._semaphores = {}  # 首次使用时创建，绑定到机器人运行的事件循环
+        self.stats = {name: {"runs": 0, "failures": 0, "active": 0, "waiting": 0, "run_seconds": 0.0, "wait_seconds": 0.0} for name in STAGES}
+
+    @asynccontextmanager
+    async def slot(self, name):
+        """占用一个阶段槽位，返回时记录排队时间"""
+        stats = self.stats[name]
+        limit = self.limits.get(name, 0)
+        semaphore = self._semaphores.setdefault(name, asyncio.Semaphore(limit)) if limit > 0 else None
+        start_time = time.time()
+        stats["waiting"] += 1
+        try:
+            if semaphore:
+                await semaphore.acquire()
+        finally:
+            stats["waiting"] -= 1
+        stats["wait_seconds"] += time.time() - start_time
+        stats["active"] += 1
+        try:
+            yield
+        finally:
+            stats["active"] -= 1
+            if semaphore:
+                semaphore.release()
+
+    def record(self, name, seconds, failed=False):
+        stats = self.stats[name]
+        stats["runs"] += 1
+        stats["run_seconds"] += seconds
+        if failed:
+            stats["failures"] += 1
+
+    def get_stats(self):
+        """返回各阶段的统计（包括并发上限和平均耗时）"""
+        result = {}
+        for name in STAGES:
+            stats = self.stats[name]
+            runs = stats["runs"]
+            result[name] = {
+                **stats,
+                "limit": self.limits.get(name, 0),
+                "avg_run_seconds": stats["run_seconds"] / runs if runs else 0.0,
+                "avg_wait_seconds": stats["wait_seconds"] / runs if runs else 0.0,
+            }
+        return result
+
+async def hold_memory(request, nbytes):
+    """
+    为请求预留内存，直到流水线结束或调用 release_memory（如下载到内存中的媒体数据）
+
+    请求持有预留后不应再等待新的预留，后续阶段需要的内存应在这里一次性预留。
+    """
+    reservation = await memory_budget.acquire(nbytes, request.stage)
+    request.reservations.append(reservation)
+    return reservation
+
+def try_hold_memory(request, nbytes):
+    """与 hold_memory 相同但不等待；预算不足时返回 None，调用方应改用磁盘"""
+    reservation = memory_budget.try_acquire(nbytes, request.stage)
+    if reservation:
+        request.reservations.append(reservation)
+    return reservation
+
+def release_memory(request):
+    """释放请求持有的全部内存预留"""
+    for reservation in request.reservations:
+        reservation.release()
+    request.reservations = []
+
+async def report_progress(request, text):
+    """更新请求的进度消息；编辑失败只记录日志"""
+    if request.progress is None:
+        return
+    try:
+        await request.progress.edit_text(text)
+    except Exception as e:
+        logging.warning(f"更新进度消息失败: {e}")
+
+class MediaPipeline:
+    """
+    媒体处理流水线
+
+    按 STAGES 的顺序执行该媒体类型配置的阶段，每个阶段是一个异步函数 stage(request)，
+    通过修改 request 传递结果，通过抛出 MediaError 报告失败。流水线负责工作目录和内存预留的生命周期、
+    各阶段的并发上限、耗时统计和进度消息，以及将熔断和意外异常包装为 MediaError。
+
+    参数:
+        kind: 媒体类型
+        stages: 阶段名 -> 处理函数
+        progress: 阶段名 -> 进入该阶段时显示的进度文字（可选，{media_name} 会替换为媒体名称）
+        hints: 错误类型 -> 默认的处理建议（错误本身没有建议时使用）
+        use_workspace: 是否为请求创建工作目录（受磁盘配额限制）
+    """
+
+    def __init__(self, kind, stages, progress=None, hints=None, use_workspace=True):
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            raise ValueError(f"未知的流水线阶段: {', '.join(sorted(unknown))}")
+        self.kind = kind
+        self.stages = stages
+        self.progress = progress or {}
+        self.hints = hints or {}
+        self.use_workspace = use_workspace
+
+    async def _report(self, request, name):
+        text = self.progress.get(name)
+        if text:
+            await report_progress(request, text.format(media_name=request.media_name))
+
+    async def _run_stages(self, request, timings):
+        for name in STAGES:
+            stage = self.stages.get(name)
+            if stage is None:
+                continue
+
+            request.stage = name
+            await self._report(request, name)
+            async with stage_limiter.slot(name):
+                start_time = time.time()
+                failed = True
+                try:
+                    await stage(request)
+                    failed = False
+                except MediaError as e:
+                    e.stage = name
+                    raise
+                except CircuitOpenError as e:
+                    error = MediaError(UNAVAILABLE, str(e))
+                    error.stage = name
+                    raise error from e
+                except Exception as e:
+                    logging.error(f"{self.kind} 流水线的 {name} 阶段出错: {e}")
+                    error = MediaError(INTERNAL, f"处理{request.media_name}时出错: {str(e)}")
+                    error.stage = name
+                    raise error from e
+                finally:
+                    timings[name] = time.time() - start_time
+                    stage_limiter.record(name, timings[name], failed)
+                    if request.workspace:
+                        request.workspace.usage()
+
+    async def run(self, request):
+        """
+        执行流水线
+
+        返回:
+            PipelineResult
+        """
+        timings = {}
+        error = None
+        try:
+            if self.use_workspace:
+                # 按源文件大小预估磁盘占用，配额不足时在这里排队
+                async with MediaWorkspace(self.kind, expected_bytes=(request.file_size or 0) * WORKSPACE_RESERVE_FACTOR) as workspace:
+                    request.workspace = workspace
+                    await self._run_stages(request, timings)
+            else:
+                await self._run_stages(request, timings)
+        except MediaError as e:
+            error = e
+            if not error.hint:
+                error.hint = self.hints.get(error.code)
+            logging.warning(f"{self.kind} 流水线在 {error.stage} 阶段失败 ({error.code}): {error.message}")
+        finally:
+            release_memory(request)
+
+        timing_text = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+        if request.workspace:
+            timing_text += f", 工作目录写入 {request.workspace.peak_bytes / 1024 / 1024:.2f}MB"
+        logging.info(f"{self.kind} 流水线{'完成' if error is None else '结束'}: {timing_text}")
+        return PipelineResult(request, error, timings)
+
+# 创建全局实例
+stage_limiter = StageLimiter()
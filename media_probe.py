@@ -0,0 +1,606 @@
+import io
+import os
+import json
+import struct
+import asyncio
+import hashlib
+import logging
+import subprocess
+from collections import OrderedDict
+from transcode_pool import TRANSCODE_TIMEOUT
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# ffprobe结果缓存的条目上限（按内容哈希）
+PROBE_CACHE_SIZE = 256
+
+# 容器格式对应的文件扩展名
+CONTAINER_EXTENSIONS = {
+    'mp4': '.mp4',
+    'mov': '.mov',
+    'm4a': '.m4a',
+    'ogg': '.ogg',
+    'wav': '.wav',
+    'flac': '.flac',
+    'mp3': '.mp3',
+    'aac': '.aac',
+    'matroska': '.mkv',
+    'webm': '.webm',
+}
+
+# MPEG音频的比特率表（kbps），按 [版本][层][索引] 组织，版本 0 为MPEG-1，1 为MPEG-2/2.5
+MPEG_BITRATES = {
+    (0, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (0, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (0, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (1, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (1, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (1, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MPEG_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+class MediaInfo:
+    """
+    媒体文件的格式、时长和音视频流信息
+
+    由 probe_media 生成后在处理流程中传递，后续阶段不再重复探测。
+    无法确定的字段为 None（has_video/has_audio 为 False）。
+    """
+
+    def __init__(self, container=None, duration=None, has_video=False, has_audio=False,
+                 width=None, height=None, fps=None, video_codec=None, audio_codec=None, source=None):
+        self.container = container
+        self.duration = duration
+        self.has_video = has_video
+        self.has_audio = has_audio
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        self.source = source  # 信息来源: sniff（内置解析）或 ffprobe
+
+    @property
+    def ext(self):
+        """容器格式对应的文件扩展名，未知时为 None"""
+        return CONTAINER_EXTENSIONS.get(self.container)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{key}={value!r}" for key, value in self.__dict__.items() if value not in (None, False))
+        return f"MediaInfo({fields})"
+
+def parse_frame_rate(rate):
+    """
+    解析ffprobe的帧率字符串（如 "30000/1001"）
+    """
+    try:
+        if '/' in rate:
+            num, den = rate.split('/')
+            return float(num) / float(den) if float(den) else 0.0
+        return float(rate)
+    except (TypeError, ValueError):
+        return 0.0
+
+def open_media(media):
+    """将文件路径或字节数据打开为可随机访问的文件对象，返回 (文件对象, 大小)"""
+    if isinstance(media, (bytes, bytearray)):
+        return io.BytesIO(media), len(media)
+    return open(media, 'rb'), os.path.getsize(media)
+
+# ---------------- MP4 / MOV ----------------
+
+def iter_boxes(f, start, end):
+    """遍历 [start, end) 范围内的MP4 box，返回 (类型, 内容起点, 内容终点)"""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield box_type, offset + header_size, min(offset + size, end)
+        offset += size
+
+def find_box(f, start, end, box_type):
+    for child_type, child_start, child_end in iter_boxes(f, start, end):
+        if child_type == box_type:
+            return child_start, child_end
+    return None
+
+def parse_mp4_track(f, start, end, info):
+    """解析trak box，补充音视频流信息"""
+    mdia = find_box(f, start, end, b'mdia')
+    if not mdia:
+        return
+
+    handler = None
+    hdlr = find_box(f, *mdia, b'hdlr')
+    if hdlr:
+        f.seek(hdlr[0] + 8)
+        handler = f.read(4)
+
+    timescale = None
+    mdhd = find_box(f, *mdia, b'mdhd')
+    if mdhd:
+        f.seek(mdhd[0])
+        version = f.read(1)[0]
+        f.seek(mdhd[0] + (20 if version == 1 else 12))
+        timescale = struct.unpack('>I', f.read(4))[0]
+
+    codec = None
+    stbl = None
+    minf = find_box(f, *mdia, b'minf')
+    if minf:
+        stbl = find_box(f, *minf, b'stbl')
+    if stbl:
+        stsd = find_box(f, *stbl, b'stsd')
+        if stsd:
+            f.seek(stsd[0] + 12)
+            codec = f.read(4).decode('latin-1').strip()
+
+    if handler == b'vide':
+        info.has_video = True
+        info.video_codec = codec
+        tkhd = find_box(f, start, end, b'tkhd')
+        if tkhd:
+            # 宽高位于tkhd末尾，为16.16定点数
+            f.seek(tkhd[1] - 8)
+            width, height = struct.unpack('>II', f.read(8))
+            info.width, info.height = width >> 16, height >> 16
+        if stbl and timescale:
+            stts = find_box(f, *stbl, b'stts')
+            if stts:
+                f.seek(stts[0] + 4)
+                entry_count = struct.unpack('>I', f.read(4))[0]
+                sample_count = total_delta = 0
+                for _ in range(min(entry_count, 100000)):
+                    count, delta = struct.unpack('>II', f.read(8))
+                    sample_count += count
+                    total_delta += count * delta
+                if total_delta:
+                    info.fps = sample_count * timescale / total_delta
+    elif handler == b'soun':
+        info.has_audio = True
+        info.audio_codec = codec
+
+def sniff_mp4(f, size):
+    f.seek(0)
+    header = f.read(12)
+    if header[4:8] != b'ftyp':
+        return None
+
+    major_brand = header[8:12]
+    info = MediaInfo(container='mov' if major_brand == b'qt  ' else 'mp4', source='sniff')
+
+    moov = find_box(f, 0, size, b'moov')
+    if not moov:
+        return info
+
+    mvhd = find_box(f, *moov, b'mvhd')
+    if mvhd:
+        f.seek(mvhd[0])
+        version = f.read(1)[0]
+        if version == 1:
+            f.seek(mvhd[0] + 20)
+            timescale, duration = struct.unpack('>IQ', f.read(12))
+        else:
+            f.seek(mvhd[0] + 12)
+            timescale, duration = struct.unpack('>II', f.read(8))
+        if timescale:
+            info.duration = duration / timescale
+
+    for box_type, start, end in iter_boxes(f, *moov):
+        if box_type == b'trak':
+            parse_mp4_track(f, start, end, info)
+
+    if info.container == 'mp4' and (major_brand in (b'M4A ', b'M4B ') or (info.has_audio and not info.has_video)):
+        info.container = 'm4a'
+    return info
+
+# ---------------- OGG ----------------
+
+def sniff_ogg(f, size):
+    f.seek(0)
+    header = f.read(512)
+    if header[:4] != b'OggS':
+        return None
+
+    info = MediaInfo(container='ogg', has_audio=True, source='sniff')
+    segment_count = header[26]
+    payload = header[27 + segment_count:]
+
+    sample_rate = None
+    pre_skip = 0
+    if payload.startswith(b'OpusHead'):
+        info.audio_codec = 'opus'
+        pre_skip = struct.unpack('<H', payload[10:12])[0]
+        sample_rate = 48000  # Opus的granule位置固定以48kHz计
+    elif payload.startswith(b'\x01vorbis'):
+        info.audio_codec = 'vorbis'
+        sample_rate = struct.unpack('<I', payload[12:16])[0]
+    elif payload.startswith(b'\x7fFLAC'):
+        info.audio_codec = 'flac'
+    elif payload.startswith(b'\x80theora'):
+        info.has_video = True
+        info.video_codec = 'theora'
+
+    # 最后一页的granule位置即总采样数
+    if sample_rate:
+        tail_size = min(size, 65536)
+        f.seek(size - tail_size)
+        tail = f.read(tail_size)
+        last_page = tail.rfind(b'OggS')
+        if last_page >= 0 and last_page + 14 <= len(tail):
+            granule = struct.unpack('<q', tail[last_page + 6:last_page + 14])[0]
+            if granule > 0:
+                info.duration = max(0, granule - pre_skip) / sample_rate
+    return info
+
+# ---------------- WAV ----------------
+
+def sniff_wav(f, size):
+    f.seek(0)
+    header = f.read(12)
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+
+    info = MediaInfo(container='wav', has_audio=True, source='sniff')
+    byte_rate = None
+    offset = 12
+    while offset + 8 <= size:
+        f.seek(offset)
+        chunk_id, chunk_size = struct.unpack('<4sI', f.read(8))
+        if chunk_id == b'fmt ':
+            fmt = f.read(16)
+            audio_format, channels, sample_rate, byte_rate = struct.unpack('<HHII', fmt[:12])
+            info.audio_codec = 'pcm' if audio_format == 1 else f'wav_{audio_format}'
+        elif chunk_id == b'data':
+            if byte_rate:
+                info.duration = min(chunk_size, size - offset - 8) / byte_rate
+            break
+        offset += 8 + chunk_size + (chunk_size & 1)
+    return info
+
+# ---------------- FLAC ----------------
+
+def sniff_flac(f, size):
+    f.seek(0)
+    header = f.read(42)
+    if header[:4] != b'fLaC':
+        return None
+
+    info = MediaInfo(container='flac', has_audio=True, audio_codec='flac', source='sniff')
+    # 第一个元数据块必须是STREAMINFO
+    if len(header) >= 42 and header[4] & 0x7F == 0:
+        streaminfo = header[8:42]
+        packed = int.from_bytes(streaminfo[10:18], 'big')
+        sample_rate = packed >> 44
+        total_samples = packed & 0xFFFFFFFFF
+        if sample_rate and total_samples:
+            info.duration = total_samples / sample_rate
+    return info
+
+# ---------------- MP3 / AAC (ADTS) ----------------
+
+def parse_mpeg_frame_header(data, pos):
+    """
+    解析 pos 处的MPEG音频或ADTS帧头
+
+    返回:
+        (格式, 帧长度, 帧头字段) ；不是有效帧头时返回 None
+        格式为 'aac' 时字段为空；为 'mp3' 时字段为 (version_bits, layer, bitrate, sample_rate)
+    """
+    if pos + 7 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+        return None
+
+    version_bits = (data[pos + 1] >> 3) & 0x03
+    layer_bits = (data[pos + 1] >> 1) & 0x03
+
+    # ADTS封装的AAC：同步字12位全1，layer位为0，帧长度（含帧头）为13位字段
+    if (data[pos + 1] & 0xF0) == 0xF0 and layer_bits == 0:
+        frame_length = ((data[pos + 3] & 0x03) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+        if (data[pos + 2] >> 2) & 0x0F > 12 or frame_length < 7:
+            return None
+        return 'aac', frame_length, ()
+
+    if version_bits == 1 or layer_bits == 0:
+        return None
+    bitrate_index = data[pos + 2] >> 4
+    sample_rate_index = (data[pos + 2] >> 2) & 0x03
+    if bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    layer = 4 - layer_bits
+    table_version = 0 if version_bits == 3 else 1
+    bitrate = MPEG_BITRATES[(table_version, layer)][bitrate_index]
+    sample_rate = MPEG_SAMPLE_RATES[version_bits][sample_rate_index]
+    padding = (data[pos + 2] >> 1) & 0x01
+    if layer == 1:
+        frame_length = (12 * bitrate * 1000 // sample_rate + padding) * 4
+    elif layer == 3 and version_bits != 3:
+        frame_length = 72 * bitrate * 1000 // sample_rate + padding
+    else:
+        frame_length = 144 * bitrate * 1000 // sample_rate + padding
+    return 'mp3', frame_length, (version_bits, layer, bitrate, sample_rate)
+
+def sniff_mpeg_audio(f, size):
+    f.seek(0)
+    header = f.read(10)
+    offset = 0
+
+    # 跳过ID3v2标签（大小为syncsafe整数）
+    if header[:3] == b'ID3' and len(header) == 10:
+        tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        offset = 10 + tag_size
+
+    # 帧同步必须紧接在文件开头（或ID3标签之后），并且按帧长度找到的下一帧同样有效，
+    # 否则交给ffprobe判断（随机数据中 0xFFE 同步字很常见）
+    f.seek(offset)
+    data = f.read(16384)
+    first = parse_mpeg_frame_header(data, 0)
+    if first is None:
+        return None
+    kind, frame_length, fields = first
+    if offset + frame_length != size:
+        second = parse_mpeg_frame_header(data, frame_length)
+        if second is None or second[0] != kind or (kind == 'mp3' and second[2][:2] != fields[:2]):
+            return None
+
+    if kind == 'aac':
+        return MediaInfo(container='aac', has_audio=True, audio_codec='aac', source='sniff')
+
+    version_bits, layer, bitrate, sample_rate = fields
+    info = MediaInfo(container='mp3', has_audio=True, audio_codec=f'mp{layer}', source='sniff')
+
+    # 优先使用Xing/Info头中的总帧数（VBR），否则按固定码率估算
+    frame = data[:200]
+    samples_per_frame = 1152 if layer != 1 else 384
+    if layer == 3 and version_bits != 3:
+        samples_per_frame = 576
+    for tag in (b'Xing', b'Info'):
+        tag_pos = frame.find(tag)
+        if tag_pos >= 0 and len(frame) >= tag_pos + 12 and frame[tag_pos + 7] & 0x01:
+            frame_count = struct.unpack('>I', frame[tag_pos + 8:tag_pos + 12])[0]
+            info.duration = frame_count * samples_per_frame / sample_rate
+            break
+    else:
+        info.duration = (size - offset) * 8 / (bitrate * 1000)
+    return info
+
+# ---------------- Matroska / WebM ----------------
+
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+
+def read_ebml_vint(data, pos, keep_marker=False):
+    """读取EBML变长整数，返回 (值, 新位置)"""
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8 or pos + length > len(data):
+        raise ValueError("无效的EBML变长整数")
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    return value, pos + length
+
+def iter_ebml(data, start, end):
+    """遍历 [start, end) 范围内的EBML元素，返回 (ID, 内容起点, 内容终点)"""
+    pos = start
+    while pos < end:
+        try:
+            element_id, pos = read_ebml_vint(data, pos, keep_marker=True)
+            size, pos = read_ebml_vint(data, pos)
+        except (ValueError, IndexError):
+            return
+        content_end = min(pos + size, end) if size < (1 << 56) - 1 else end
+        yield element_id, pos, content_end
+        pos = content_end
+
+def sniff_matroska(f, size):
+    f.seek(0)
+    data = f.read(min(size, 256 * 1024))
+    if not data.startswith(EBML_MAGIC):
+        return None
+
+    info = MediaInfo(container='matroska', source='sniff')
+    timecode_scale = 1000000
+    duration = None
+
+    for element_id, start, end in iter_ebml(data, 0, len(data)):
+        if element_id == 0x1A45DFA3:  # EBML头
+            for child_id, child_start, child_end in iter_ebml(data, start, end):
+                if child_id == 0x4282 and data[child_start:child_end] == b'webm':  # DocType
+                    info.container = 'webm'
+        elif element_id == 0x18538067:  # Segment
+            for child_id, child_start, child_end in iter_ebml(data, start, end):
+                if child_id == 0x1549A966:  # Info
+                    for field_id, field_start, field_end in iter_ebml(data, child_start, child_end):
+                        if field_id == 0x2AD7B1:  # TimecodeScale
+                            timecode_scale = int.from_bytes(data[field_start:field_end], 'big')
+                        elif field_id == 0x4489:  # Duration
+                            raw = data[field_start:field_end]
+                            duration = struct.unpack('>f' if len(raw) == 4 else '>d', raw)[0]
+                elif child_id == 0x1654AE6B:  # Tracks
+                    for entry_id, entry_start, entry_end in iter_ebml(data, child_start, child_end):
+                        if entry_id != 0xAE:  # TrackEntry
+                            continue
+                        track_type = codec = None
+                        width = height = None
+                        for field_id, field_start, field_end in iter_ebml(data, entry_start, entry_end):
+                            if field_id == 0x83:
+                                track_type = int.from_bytes(data[field_start:field_end], 'big')
+                            elif field_id == 0x86:
+                                codec = data[field_start:field_end].decode('latin-1')
+                            elif field_id == 0xE0:  # Video
+                                for video_id, video_start, video_end in iter_ebml(data, field_start, field_end):
+                                    if video_id == 0xB0:
+                                        width = int.from_bytes(data[video_start:video_end], 'big')
+                                    elif video_id == 0xBA:
+                                        height = int.from_bytes(data[video_start:video_end], 'big')
+                        if track_type == 1:
+                            info.has_video = True
+                            info.video_codec = codec
+                            info.width, info.height = width, height
+                        elif track_type == 2:
+                            info.has_audio = True
+                            info.audio_codec = codec
+
+    if duration:
+        info.duration = duration * timecode_scale / 1e9
+    return info
+
+SNIFFERS = [sniff_mp4, sniff_matroska, sniff_ogg, sniff_wav, sniff_flac, sniff_mpeg_audio]
+
+def sniff_media(media):
+    """
+    使用纯Python解析文件头识别容器格式，并尽可能提取时长和音视频流信息
+
+    返回:
+        MediaInfo，无法识别时返回 None
+    """
+    try:
+        f, size = open_media(media)
+    except OSError as e:
+        logging.warning(f"无法读取媒体文件: {e}")
+        return None
+
+    with f:
+        for sniffer in SNIFFERS:
+            try:
+                info = sniffer(f, size)
+            except (struct.error, IndexError, ValueError) as e:
+                logging.warning(f"{sniffer.__name__} 解析失败: {e}")
+                continue
+            if info:
+                return info
+    return None
+
+# ---------------- ffprobe 回退 ----------------
+
+probe_cache = OrderedDict()
+
+def _hash_media(media):
+    digest = hashlib.sha256()
+    if isinstance(media, (bytes, bytearray)):
+        digest.update(media)
+    else:
+        with open(media, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+async def content_hash(media):
+    """计算媒体内容的SHA-256（在线程中执行，不阻塞事件循环）"""
+    return await asyncio.to_thread(_hash_media, media)
+
+def parse_ffprobe_result(result):
+    """将ffprobe的JSON输出转换为MediaInfo"""
+    info = MediaInfo(source='ffprobe')
+    format_info = result.get("format", {})
+    format_name = format_info.get("format_name", "")
+
+    try:
+        info.duration = float(format_info.get("duration")) if format_info.get("duration") else None
+    except ValueError:
+        pass
+
+    for stream in result.get("streams", []):
+        if stream.get("codec_type") == "video" and not info.has_video:
+            # 封面图片以视频流形式出现，不算作视频
+            if stream.get("disposition", {}).get("attached_pic"):
+                continue
+            info.has_video = True
+            info.video_codec = stream.get("codec_name")
+            info.width = stream.get("width")
+            info.height = stream.get("height")
+            info.fps = parse_frame_rate(stream.get("avg_frame_rate", "0")) or None
+        elif stream.get("codec_type") == "audio" and not info.has_audio:
+            info.has_audio = True
+            info.audio_codec = stream.get("codec_name")
+
+    names = format_name.split(',')
+    if 'mp4' in names or 'mov' in names:
+        info.container = 'mp4' if info.has_video else 'm4a'
+    elif 'matroska' in names:
+        info.container = 'webm' if info.video_codec in (None, 'vp8', 'vp9', 'av1') and info.audio_codec in (None, 'opus', 'vorbis') else 'matroska'
+    elif names and names[0] in CONTAINER_EXTENSIONS:
+        info.container = names[0]
+    return info
+
+async def run_ffprobe(media):
+    """对文件路径或字节数据（通过标准输入）执行一次ffprobe，返回解析后的JSON"""
+    in_memory = isinstance(media, (bytes, bytearray))
+    cmd = ['ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json', 'pipe:0' if in_memory else media]
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=subprocess.PIPE if in_memory else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(bytes(media) if in_memory else None), TRANSCODE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.error(f"ffprobe执行超过 {TRANSCODE_TIMEOUT:g} 秒，正在终止")
+        process.kill()
+        await process.wait()
+        raise Exception(f"ffprobe执行超时 ({TRANSCODE_TIMEOUT:g} 秒)")
+    if process.returncode != 0:
+        raise Exception(f"ffprobe执行失败: {stderr.decode('utf-8', errors='replace')}")
+    return json.loads(stdout.decode('utf-8', errors='replace'))
+
+async def probe_media(media, need_duration=True, need_video_info=False):
+    """
+    获取媒体信息：先用内置解析器识别，信息不足时回退到一次ffprobe调用
+
+    ffprobe结果按内容哈希缓存，同一内容（如重新发送的同一个文件）不会被重复探测。
+
+    参数:
+        media: 文件路径或字节数据
+        need_duration: 是否必须获得时长
+        need_video_info: 是否必须获得视频分辨率和帧率
+
+    返回:
+        MediaInfo（所有方法都失败时 container 为 None）
+    """
+    info = sniff_media(media)
+    if info:
+        missing_duration = need_duration and not info.duration
+        missing_video = need_video_info and info.has_video and not (info.width and info.fps)
+        if not missing_duration and not missing_video:
+            logging.info(f"内置解析获得媒体信息: {info}")
+            return info
+
+    try:
+        key = await content_hash(media)
+        if key in probe_cache:
+            probe_cache.move_to_end(key)
+            logging.info(f"命中ffprobe缓存: {probe_cache[key]}")
+            return probe_cache[key]
+
+        ffprobe_info = parse_ffprobe_result(await run_ffprobe(media))
+        # 内置解析已识别出的容器格式更可靠（ffprobe的mov/mp4/m4a是同一个格式名）
+        if info and info.container:
+            ffprobe_info.container = info.container
+        probe_cache[key] = ffprobe_info
+        if len(probe_cache) > PROBE_CACHE_SIZE:
+            probe_cache.popitem(last=False)
+        logging.info(f"ffprobe获得媒体信息: {ffprobe_info}")
+        return ffprobe_info
+    except Exception as e:
+        logging.warning(f"ffprobe探测失败: {e}")
+        return info or MediaInfo()
@@ -0,0 +1,298 @@
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+import tempfile
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 媒体工作目录根路径，默认位于系统临时目录下；可指向tmpfs挂载点（如 /media-work）以加快中间文件读写
+WORKSPACE_ROOT = os.environ.get("MEDIA_WORKSPACE_DIR") or os.path.join(tempfile.gettempdir(), "poe-bot-media")
+
+# 所有工作目录合计的磁盘占用上限（MB），0表示不限制；超出时新任务等待已有任务结束
+WORKSPACE_QUOTA_MB = float(os.environ.get("WORKSPACE_QUOTA_MB", "2048"))
+WORKSPACE_QUOTA_BYTES = int(WORKSPACE_QUOTA_MB * 1024 * 1024)
+
+# 新任务按源文件大小的倍数预估磁盘占用：源文件、压缩或转码结果以及切分片段等中间文件
+WORKSPACE_RESERVE_FACTOR = 3
+
+# 巡检间隔（秒）：清理不属于任何进行中任务的遗留目录，并采样各任务的磁盘占用
+WORKSPACE_JANITOR_INTERVAL = float(os.environ.get("WORKSPACE_JANITOR_INTERVAL", "300"))
+
+# 遗留目录至少闲置该时长（秒）才会被巡检清理；启动时的清理不受此限制
+WORKSPACE_ORPHAN_MIN_AGE = 60
+
+# 排队等待磁盘配额时重新检查的间隔（秒），任务中途删除中间文件也可能腾出空间
+WORKSPACE_RECHECK_INTERVAL = 5
+
+def directory_size(path):
+    """统计目录中所有文件的总大小（字节）"""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+class MediaWorkspace:
+    """
+    单个媒体任务的工作目录
+
+    下载、探测、压缩、上传等各阶段只在目录内传递文件路径，不在内存中复制文件内容。
+    工作目录由创建它的一方持有，退出上下文时整个目录（包括所有中间文件）一并删除；
+    进程崩溃遗留的目录由 WorkspaceManager 的巡检清理。
+
+    使用 async with 时先等待磁盘配额（按 expected_bytes 预估），再创建目录。
+    写入量按目录占用的峰值统计（各阶段结束、巡检和清理前采样）。
+
+    用法:
+        async with MediaWorkspace("video", expected_bytes=file_size * WORKSPACE_RESERVE_FACTOR) as workspace:
+            source_path = workspace.path("source.mp4")
+    """
+
+    def __init__(self, prefix="job", expected_bytes=0, manager=None):
+        self.prefix = prefix
+        self.job_id = f"{prefix}-{uuid.uuid4().hex[:12]}"
+        self.manager = manager or workspace_manager
+        self.root = os.path.join(self.manager.root, self.job_id)
+        self.expected_bytes = int(expected_bytes or 0)
+        self.current_bytes = 0
+        self.peak_bytes = 0
+        self.created = time.time()
+        self.closed = False
+
+    def __enter__(self):
+        self.manager.register(self)
+        os.makedirs(self.root, exist_ok=True)
+        logging.info(f"已创建媒体工作目录: {self.root}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
+
+    async def __aenter__(self):
+        await self.manager.admit(self)
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
+
+    def path(self, name):
+        """返回工作目录内指定文件名的路径"""
+        return os.path.join(self.root, name)
+
+    def usage(self):
+        """采样目录当前的磁盘占用（字节），同时更新峰值"""
+        self.current_bytes = directory_size(self.root)
+        self.peak_bytes = max(self.peak_bytes, self.current_bytes)
+        return self.current_bytes
+
+    def cleanup(self):
+        """删除工作目录及其中的所有文件"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.usage()
+            shutil.rmtree(self.root, ignore_errors=True)
+            logging.info(f"已清理媒体工作目录: {self.root} (写入 {self.peak_bytes / 1024 / 1024:.2f}MB, 用时 {time.time() - self.created:.1f} 秒)")
+        except Exception as e:
+            logging.error(f"清理媒体工作目录时出错: {e}")
+        finally:
+            self.manager.release(self)
+
+class WorkspaceManager:
+    """
+    管理 WORKSPACE_ROOT 下的全部工作目录
+
+    - 磁盘配额：进行中任务的占用（取预估和实际采样中的较大者）加上新任务的预估超过
+      WORKSPACE_QUOTA_BYTES，或根目录所在磁盘的剩余空间不足时，新任务按先来先服务的顺序等待。
+      没有进行中的任务时总是放行，单个超过配额的任务也能执行。
+    - 巡检：启动时清理上次运行遗留的全部目录，之后定期清理不属于任何进行中任务的目录。
+
+    用法:
+        await workspace_manager.start()   # 启动时清理并开始定期巡检
+        await workspace_manager.stop()
+    """
+
+    def __init__(self, root=WORKSPACE_ROOT, quota_bytes=WORKSPACE_QUOTA_BYTES):
+        self.root = root
+        self.quota = quota_bytes
+        self._live = {}  # 目录名 -> 进行中的 MediaWorkspace
+        self._waiters = []  # 等待配额的 MediaWorkspace（按到达顺序）
+        self._wakeup = None  # 有任务结束时完成的future，用于唤醒等待者
+        self._janitor_task = None
+        self.peak_used = 0
+        self.stats = {
+            "jobs": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "bytes_written": 0,
+            "max_job_bytes": 0,
+            "orphans_removed": 0,
+            "orphan_bytes": 0,
+        }
+
+    def used_bytes(self):
+        """进行中任务的磁盘占用（字节），尚未写满预估的任务按预估计算"""
+        return sum(max(workspace.expected_bytes, workspace.current_bytes) for workspace in self._live.values())
+
+    def _sample(self):
+        for workspace in list(self._live.values()):
+            workspace.usage()
+        self.peak_used = max(self.peak_used, sum(workspace.current_bytes for workspace in self._live.values()))
+
+    def _has_room(self, workspace):
+        if not self._live:
+            return True
+        self._sample()
+        if self.quota > 0 and self.used_bytes() + workspace.expected_bytes > self.quota:
+            return False
+        try:
+            # 已放行任务尚未写入的部分也会占用剩余空间
+            pending = sum(max(0, ws.expected_bytes - ws.current_bytes) for ws in self._live.values())
+            if shutil.disk_usage(self.root).free < pending + workspace.expected_bytes:
+                return False
+        except OSError:
+            pass
+        return True
+
+    def _notify(self):
+        if self._wakeup and not self._wakeup.done():
+            self._wakeup.set_result(None)
+        self._wakeup = None
+
+    async def admit(self, workspace):
+        """等待磁盘配额允许该工作目录开始使用"""
+        if not self._waiters and self._has_room(workspace):
+            return
+
+        start_time = time.time()
+        self.stats["waits"] += 1
+        self._waiters.append(workspace)
+        logging.info(
+            f"工作目录磁盘配额不足，{workspace.job_id} 等待中 (预估 {workspace.expected_bytes / 1024 / 1024:.1f}MB, "
+            f"已占用 {self.used_bytes() / 1024 / 1024:.1f}MB)"
+        )
+        try:
+            while self._waiters[0] is not workspace or not self._has_room(workspace):
+                if self._wakeup is None:
+                    self._wakeup = asyncio.get_running_loop().create_future()
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._wakeup), WORKSPACE_RECHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._waiters.remove(workspace)
+            self.stats["wait_seconds"] += time.time() - start_time
+            # 下一个等待者可能已经放得下
+            self._notify()
+
+    def register(self, workspace):
+        self._live[workspace.job_id] = workspace
+        self.stats["jobs"] += 1
+
+    def release(self, workspace):
+        if self._live.pop(workspace.job_id, None) is None:
+            return
+        self.stats["bytes_written"] += workspace.peak_bytes
+        self.stats["max_job_bytes"] = max(self.stats["max_job_bytes"], workspace.peak_bytes)
+        self.peak_used = max(self.peak_used, workspace.peak_bytes)
+        self._notify()
+
+    def reclaim_orphans(self, min_age=WORKSPACE_ORPHAN_MIN_AGE):
+        """
+        清理根目录下不属于任何进行中任务的目录和文件
+
+        参数:
+            min_age: 只清理最后修改时间早于该时长（秒）的条目，启动时传0清理全部遗留
+
+        返回:
+            (清理的条目数, 释放的字节数)
+        """
+        if not os.path.isdir(self.root):
+            return 0, 0
+
+        removed = 0
+        freed = 0
+        now = time.time()
+        for name in os.listdir(self.root):
+            if name in self._live:
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                if now - os.lstat(path).st_mtime < min_age:
+                    continue
+                if os.path.isdir(path) and not os.path.islink(path):
+                    size = directory_size(path)
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    size = os.lstat(path).st_size
+                    os.unlink(path)
+            except OSError as e:
+                logging.warning(f"清理遗留工作目录 {path} 时出错: {e}")
+                continue
+            removed += 1
+            freed += size
+
+        if removed:
+            self.stats["orphans_removed"] += removed
+            self.stats["orphan_bytes"] += freed
+            logging.info(f"已清理 {removed} 个遗留工作目录，释放 {freed / 1024 / 1024:.2f}MB")
+            self._notify()
+        return removed, freed
+
+    async def _janitor(self):
+        while True:
+            await asyncio.sleep(WORKSPACE_JANITOR_INTERVAL)
+            try:
+                self.reclaim_orphans()
+                self._sample()
+            except Exception as e:
+                logging.error(f"工作目录巡检时出错: {e}")
+
+    async def start(self):
+        """创建根目录，清理上次运行遗留的工作目录，并开始定期巡检"""
+        os.makedirs(self.root, exist_ok=True)
+        self.reclaim_orphans(min_age=0)
+        self._janitor_task = asyncio.create_task(self._janitor())
+        quota = f"{self.quota / 1024 / 1024:.0f}MB" if self.quota else "不限"
+        logging.info(f"媒体工作目录: {self.root} (磁盘配额 {quota}, 巡检间隔 {WORKSPACE_JANITOR_INTERVAL:.0f} 秒)")
+
+    async def stop(self):
+        """停止定期巡检"""
+        if self._janitor_task:
+            self._janitor_task.cancel()
+            await asyncio.gather(self._janitor_task, return_exceptions=True)
+            self._janitor_task = None
+
+    def get_stats(self):
+        """返回工作目录统计（包括当前占用、配额和剩余磁盘空间）"""
+        self._sample()
+        try:
+            free = shutil.disk_usage(self.root).free
+        except OSError:
+            free = None
+        jobs_done = self.stats["jobs"] - len(self._live)
+        return {
+            **self.stats,
+            "root": self.root,
+            "quota": self.quota,
+            "active": len(self._live),
+            "waiting": len(self._waiters),
+            "used": sum(workspace.current_bytes for workspace in self._live.values()),
+            "reserved": self.used_bytes(),
+            "peak_used": self.peak_used,
+            "free": free,
+            "avg_job_bytes": self.stats["bytes_written"] / jobs_done if jobs_done else 0.0,
+        }
+
+# 创建全局实例
+workspace_manager = WorkspaceManager()
@@ -0,0 +1,165 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 同时保存在进程内存中的媒体数据总量上限（MB），0表示只统计不限制
+# 下载、转换、内联发送给Gemini的数据都需要先预留，预算用尽时后续任务排队等待
+MEDIA_MEMORY_BUDGET_MB = float(os.environ.get("MEDIA_MEMORY_BUDGET_MB", "256"))
+MEDIA_MEMORY_BUDGET_BYTES = int(MEDIA_MEMORY_BUDGET_MB * 1024 * 1024)
+
+class MemoryReservation:
+    """一次内存预留，release 可以重复调用"""
+
+    def __init__(self, budget, nbytes, stage):
+        self.budget = budget
+        self.nbytes = nbytes
+        self.stage = stage
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.budget._release(self)
+
+class MemoryBudget:
+    """
+    按字节计量的异步信号量，限制媒体数据占用的内存总量
+
+    预留按先来先服务的顺序满足：排在前面的大预留不会被后来的小预留插队而饿死。
+    单次预留超过总预算时按总预算计算（等到其他预留全部释放后单独执行）。
+    同一请求在持有预留时不应再等待新的预留（否则可能互相等待），
+    需要更多内存时应一次性预留，或使用 try_acquire 并在失败时改用磁盘。
+
+    用法:
+        async with memory_budget.reserve(file_size, "acquire"):
+            ...  # 下载等临时占用
+        reservation = memory_budget.try_acquire(size, "acquire")  # 失败返回None，调用方改用磁盘
+    """
+
+    def __init__(self, limit_bytes=MEDIA_MEMORY_BUDGET_BYTES):
+        self.limit = limit_bytes
+        self.in_use = 0
+        self.peak = 0
+        self._waiters = deque()  # [字节数, 阶段, future, 开始等待时间]
+        self.stages = {}  # 阶段 -> 统计
+        self.stats = {
+            "reservations": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "spills": 0,
+        }
+
+    def _stage_stats(self, stage):
+        return self.stages.setdefault(stage, {"in_use": 0, "peak": 0, "reservations": 0, "waits": 0, "spills": 0})
+
+    def _clamp(self, nbytes):
+        nbytes = max(0, int(nbytes or 0))
+        return min(nbytes, self.limit) if self.limit > 0 else nbytes
+
+    def _fits(self, nbytes):
+        return self.limit <= 0 or self.in_use + nbytes <= self.limit
+
+    def _grant(self, nbytes, stage):
+        self.in_use += nbytes
+        self.peak = max(self.peak, self.in_use)
+        self.stats["reservations"] += 1
+        stats = self._stage_stats(stage)
+        stats["in_use"] += nbytes
+        stats["peak"] = max(stats["peak"], stats["in_use"])
+        stats["reservations"] += 1
+        return MemoryReservation(self, nbytes, stage)
+
+    def _release(self, reservation):
+        self.in_use -= reservation.nbytes
+        self._stage_stats(reservation.stage)["in_use"] -= reservation.nbytes
+        self._wake()
+
+    def _wake(self):
+        """按顺序满足排队中的预留，直到队首的预留放不下为止"""
+        while self._waiters:
+            nbytes, stage, future, start_time = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if not self._fits(nbytes):
+                break
+            self._waiters.popleft()
+            self.stats["wait_seconds"] += time.time() - start_time
+            future.set_result(self._grant(nbytes, stage))
+
+    def try_acquire(self, nbytes, stage="other"):
+        """
+        不等待地预留内存
+
+        返回:
+            MemoryReservation，预算不足（或已有任务在排队）时返回 None
+        """
+        nbytes = self._clamp(nbytes)
+        if self._waiters or not self._fits(nbytes):
+            return None
+        return self._grant(nbytes, stage)
+
+    async def acquire(self, nbytes, stage="other"):
+        """
+        预留内存，预算不足时排队等待
+
+        参数:
+            nbytes: 预留的字节数
+            stage: 占用内存的处理阶段（用于统计）
+
+        返回:
+            MemoryReservation，用完后调用 release
+        """
+        reservation = self.try_acquire(nbytes, stage)
+        if reservation:
+            return reservation
+
+        nbytes = self._clamp(nbytes)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append([nbytes, stage, future, time.time()])
+        self.stats["waits"] += 1
+        self._stage_stats(stage)["waits"] += 1
+        logging.info(f"内存预算不足，{stage} 阶段等待预留 {nbytes / 1024 / 1024:.1f}MB (使用中 {self.in_use / 1024 / 1024:.1f}MB)")
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已经分配但调用方被取消，归还预留
+                future.result().release()
+            else:
+                self._wake()
+            raise
+
+    @asynccontextmanager
+    async def reserve(self, nbytes, stage="other"):
+        """在 async with 块内临时占用内存"""
+        reservation = await self.acquire(nbytes, stage)
+        try:
+            yield reservation
+        finally:
+            reservation.release()
+
+    def record_spill(self, stage="other"):
+        """记录一次因预算不足而改用磁盘的处理"""
+        self.stats["spills"] += 1
+        self._stage_stats(stage)["spills"] += 1
+
+    def get_stats(self):
+        """返回内存预算统计（包括各阶段的当前占用和峰值）"""
+        return {
+            **self.stats,
+            "limit": self.limit,
+            "in_use": self.in_use,
+            "peak": self.peak,
+            "waiting": sum(1 for _, _, future, _ in self._waiters if not future.done()),
+            "stages": {stage: dict(stats) for stage, stats in self.stages.items()},
+        }
+
+# 创建全局实例
+memory_budget = MemoryBudget()
@@ -0,0 +1,162 @@
+import os
+import logging
+from poe_stream import poe_streamer
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 自动模式下可选的模型（bot_names中的键），按优先顺序排列；都满足延迟目标时选排在前面的
+ROUTER_MODELS = os.environ.get("ROUTER_MODELS", "claude3,gpt4,claude35")
+
+# 各请求类型的首字节延迟目标（秒），按最近的P90首字节耗时判断模型是否满足
+ROUTER_SLOS = os.environ.get("ROUTER_SLOS", "short=4,long=10,media=8")
+
+# 发送的上下文超过这么多字符时按长上下文请求处理
+ROUTER_LONG_CONTEXT_CHARS = int(os.environ.get("ROUTER_LONG_CONTEXT_CHARS", "6000"))
+
+# 只根据最近这段时间（秒）内的真实请求判断模型表现
+ROUTER_WINDOW_SECONDS = float(os.environ.get("ROUTER_WINDOW_SECONDS", "1800"))
+
+# 窗口内样本少于这么多时认为模型满足目标（没有数据的模型也有机会被选中并积累样本）
+ROUTER_MIN_SAMPLES = 3
+
+# 对话中已选用的模型P90首字节耗时超过延迟目标的这个倍数才换模型，避免在目标附近来回切换
+ROUTER_STICKY_TOLERANCE = 1.5
+
+# 所有模型都不满足目标时，按首字节耗时加上输出这么多字符的时间估算总耗时，选最快的
+EXPECTED_REPLY_CHARS = 1500
+
+# 请求类型
+CLASS_SHORT = "short"
+CLASS_LONG = "long"
+CLASS_MEDIA = "media"
+
+CLASS_NAMES = {
+    CLASS_SHORT: "短文本",
+    CLASS_LONG: "长上下文",
+    CLASS_MEDIA: "媒体追问",
+}
+
+def parse_slos(value):
+    """解析 "short=4,long=10" 形式的延迟目标，未配置的类型使用默认值"""
+    slos = {CLASS_SHORT: 4.0, CLASS_LONG: 10.0, CLASS_MEDIA: 8.0}
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        key, setting = (part.strip() for part in item.split('=', 1))
+        if key not in slos:
+            logging.warning(f"未知的请求类型: {key}（可用: {', '.join(slos)}）")
+            continue
+        slos[key] = float(setting)
+    return slos
+
+class ModelRouter:
+    """
+    自动模式的模型选择
+
+    按请求类型（短文本、长上下文、媒体追问）的首字节延迟目标，从 ROUTER_MODELS 中选择模型。
+    模型表现取自 poe_streamer 根据真实请求记录的首字节耗时和输出速度。
+    同一对话中优先沿用上次选择的模型，只有它明显超出目标时才换。
+
+    用法:
+        model_router.configure(bot_names)
+        request_class = model_router.classify(messages, media=False)
+        bot_name = model_router.choose(request_class, sticky=previous_bot)
+    """
+
+    def __init__(self, streamer=poe_streamer):
+        self.streamer = streamer
+        self.models = []
+        self.slos = parse_slos(ROUTER_SLOS)
+        self.decisions = {}  # 请求类型 -> {机器人: 次数}
+        self.stats = {
+            "routed": 0,
+            "sticky": 0,
+            "switches": 0,
+            "slo_misses": 0,
+        }
+
+    def configure(self, bot_names):
+        """根据 bot_names 加载可选的模型"""
+        self.models = []
+        for key in ROUTER_MODELS.split(','):
+            key = key.strip()
+            if key not in bot_names:
+                if key:
+                    logging.warning(f"未知的模型: {key}（可用: {', '.join(bot_names)}）")
+                continue
+            self.models.append(bot_names[key])
+        if not self.models:
+            self.models = list(bot_names.values())
+        logging.info(f"自动模式可选模型: {', '.join(self.models)}")
+
+    def classify(self, messages, media=False):
+        """
+        判断请求类型
+
+        参数:
+            messages: 将要发送的消息列表
+            media: 对话是否基于图片、视频或音频的分析结果
+        """
+        if media:
+            return CLASS_MEDIA
+        if sum(len(message.content or "") for message in messages) > ROUTER_LONG_CONTEXT_CHARS:
+            return CLASS_LONG
+        return CLASS_SHORT
+
+    def _meets(self, performance, slo):
+        return performance["samples"] < ROUTER_MIN_SAMPLES or performance["ttft_p90"] <= slo
+
+    def _estimate(self, performance, default_throughput):
+        """估算一次回复的总耗时（秒），没有输出速度样本时按 default_throughput 计算"""
+        throughput = performance["throughput"] or default_throughput
+        estimate = performance["ttft_p50"]
+        if throughput > 0:
+            estimate += EXPECTED_REPLY_CHARS / throughput
+        return estimate
+
+    def choose(self, request_class, sticky=None):
+        """
+        选择模型
+
+        参数:
+            request_class: classify 返回的请求类型
+            sticky: 对话中上次选择的模型，为None表示新对话
+
+        返回:
+            Poe机器人名称
+        """
+        slo = self.slos[request_class]
+        performances = {name: self.streamer.performance(name, ROUTER_WINDOW_SECONDS) for name in self.models}
+
+        if sticky in performances and self._meets(performances[sticky], slo * ROUTER_STICKY_TOLERANCE):
+            bot_name = sticky
+            self.stats["sticky"] += 1
+        else:
+            bot_name = next((name for name in self.models if self._meets(performances[name], slo)), None)
+            if bot_name is None:
+                # 都不满足目标时选估算总耗时最短的；没有输出速度样本的模型按已知最慢的速度估算
+                known = [performance["throughput"] for performance in performances.values() if performance["throughput"] > 0]
+                default_throughput = min(known) if known else 0.0
+                bot_name = min(self.models, key=lambda name: self._estimate(performances[name], default_throughput))
+                self.stats["slo_misses"] += 1
+            if sticky is not None and bot_name != sticky:
+                self.stats["switches"] += 1
+                logging.info(f"自动模式换用 {bot_name}（{sticky} 最近P90首字节耗时超出{CLASS_NAMES[request_class]}目标 {slo:.1f} 秒）")
+
+        self.stats["routed"] += 1
+        counts = self.decisions.setdefault(request_class, {})
+        counts[bot_name] = counts.get(bot_name, 0) + 1
+        return bot_name
+
+    def get_stats(self):
+        """返回模型选择统计（包括各类型的延迟目标、选择次数和各模型最近的表现）"""
+        return {
+            **self.stats,
+            "slos": dict(self.slos),
+            "decisions": {request_class: dict(counts) for request_class, counts in self.decisions.items()},
+            "models": {name: self.streamer.performance(name, ROUTER_WINDOW_SECONDS) for name in self.models},
+        }
+
+# 创建全局实例
+model_router = ModelRouter()
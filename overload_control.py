@@ -0,0 +1,217 @@
+import os
+import time
+import asyncio
+import logging
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 是否根据负载自动降级（设为0时只采样和统计，始终按正常级别处理）
+OVERLOAD_CONTROL = os.environ.get("OVERLOAD_CONTROL", "1").lower() not in ("0", "false", "no")
+
+# 采样间隔（秒），同时用于测量事件循环延迟
+OVERLOAD_CHECK_INTERVAL = float(os.environ.get("OVERLOAD_CHECK_INTERVAL", "2"))
+
+def parse_levels(value):
+    """解析 "4,8,16" 形式的阈值列表"""
+    return [float(item) for item in value.split(",") if item.strip()]
+
+# 进入各降级级别的阈值（逗号分隔，依次对应级别1、2、3）
+OVERLOAD_QUEUE_LEVELS = parse_levels(os.environ.get("OVERLOAD_QUEUE_LEVELS", "4,8,16"))  # 排队中的媒体任务/转码任务数
+OVERLOAD_INFLIGHT_LEVELS = parse_levels(os.environ.get("OVERLOAD_INFLIGHT_LEVELS", "10,20,40"))  # 进行中的Poe请求和媒体任务数
+OVERLOAD_LAG_LEVELS = [ms / 1000 for ms in parse_levels(os.environ.get("OVERLOAD_LAG_LEVELS_MS", "250,1000,3000"))]  # 事件循环延迟（秒）
+
+# 迟滞：指标连续 OVERLOAD_RAISE_SAMPLES 次采样达到更高级别才升级；
+# 在当前级别停留至少 OVERLOAD_HOLD_SECONDS 秒，且所有指标都降到当前级别阈值的 OVERLOAD_EXIT_RATIO 倍以下才降一级
+OVERLOAD_RAISE_SAMPLES = 2
+OVERLOAD_HOLD_SECONDS = float(os.environ.get("OVERLOAD_HOLD_SECONDS", "60"))
+OVERLOAD_EXIT_RATIO = 0.6
+
+# 降级级别
+LEVEL_NORMAL = 0
+LEVEL_MEDIA_LITE = 1  # 视频改用关键帧模式，压缩降低分辨率并关闭两遍编码
+LEVEL_FAST_TEXT = 2  # 另外将文本请求路由到更快的模型，并缩短发送的上下文
+LEVEL_SHED = 3  # 另外拒绝新的图片、视频和音频
+
+LEVEL_NAMES = {
+    LEVEL_NORMAL: "正常",
+    LEVEL_MEDIA_LITE: "轻度过载（媒体降级）",
+    LEVEL_FAST_TEXT: "中度过载（媒体和文本降级）",
+    LEVEL_SHED: "严重过载（暂停接收新媒体）",
+}
+
+# 降级时视频压缩的最大宽度（像素）
+OVERLOAD_ENCODE_WIDTH = 854
+
+# 中度过载时发送给Poe的最近消息条数（完整上下文仍保留）
+OVERLOAD_CONTEXT_MESSAGES = int(os.environ.get("OVERLOAD_CONTEXT_MESSAGES", "6"))
+
+def level_for(value, thresholds):
+    """返回该指标值达到的最高级别"""
+    return sum(1 for threshold in thresholds[:LEVEL_SHED] if value >= threshold)
+
+class OverloadController:
+    """
+    过载控制器
+
+    定期采样事件循环延迟和各模块注册的指标（队列深度、进行中的请求数等），
+    按阈值在 LEVEL_NORMAL ~ LEVEL_SHED 之间切换降级级别；升级需要连续多次采样确认，
+    降级需要在当前级别停留足够长并且所有指标明显回落，避免在阈值附近反复切换。
+    各处理环节根据当前级别自行降级，并通过 record 记录降级次数。
+
+    用法:
+        overload_controller.register_signal("media_queue", lambda: media_jobs.get_stats()["queued"], OVERLOAD_QUEUE_LEVELS)
+        overload_controller.on_change(notify_admins)   # async notify_admins(old_level, new_level, values)
+        await overload_controller.start()
+        if overload_controller.at_least(LEVEL_SHED): ...
+    """
+
+    def __init__(self, interval=OVERLOAD_CHECK_INTERVAL, enabled=OVERLOAD_CONTROL):
+        self.interval = interval
+        self.enabled = enabled
+        self.level = LEVEL_NORMAL
+        self.since = time.time()
+        self._signals = {"loop_lag": (None, OVERLOAD_LAG_LEVELS)}  # 名称 -> (采样函数, 阈值)
+        self._listeners = []
+        self._raise_samples = 0
+        self._task = None
+        self.values = {"loop_lag": 0.0}
+        self.max_lag = 0.0
+        self.level_seconds = {level: 0.0 for level in LEVEL_NAMES}
+        self.actions = {}  # 降级或拒绝的处理 -> 次数
+        self.stats = {
+            "samples": 0,
+            "transitions": 0,
+            "max_level": LEVEL_NORMAL,
+        }
+
+    def register_signal(self, name, probe, thresholds):
+        """
+        注册一个负载指标
+
+        参数:
+            name: 指标名称
+            probe: 无参函数，返回当前指标值
+            thresholds: 进入级别1、2、3的阈值
+        """
+        self._signals[name] = (probe, thresholds)
+
+    def on_change(self, listener):
+        """注册级别变化时调用的异步函数 listener(old_level, new_level, values)"""
+        self._listeners.append(listener)
+
+    def at_least(self, level):
+        """当前是否处于该降级级别或更高级别"""
+        return self.level >= level
+
+    def encode_width(self, max_width):
+        """降级时返回更低的压缩最大宽度"""
+        if self.at_least(LEVEL_MEDIA_LITE):
+            return min(max_width, OVERLOAD_ENCODE_WIDTH)
+        return max_width
+
+    def record(self, action):
+        """记录一次因过载而降级或拒绝的处理"""
+        self.actions[action] = self.actions.get(action, 0) + 1
+
+    def sample(self, lag=0.0):
+        """采样所有指标并更新降级级别"""
+        values = {"loop_lag": lag}
+        for name, (probe, _) in self._signals.items():
+            if probe is None:
+                continue
+            try:
+                values[name] = probe()
+            except Exception as e:
+                logging.warning(f"采样负载指标 {name} 时出错: {e}")
+                values[name] = 0
+        self.values = values
+        self.max_lag = max(self.max_lag, lag)
+        self.stats["samples"] += 1
+        if self.enabled:
+            self._evaluate(values)
+
+    def _evaluate(self, values):
+        target = max(level_for(values[name], thresholds) for name, (_, thresholds) in self._signals.items())
+        if target > self.level:
+            self._raise_samples += 1
+            if self._raise_samples >= OVERLOAD_RAISE_SAMPLES:
+                self._set_level(target, values)
+            return
+        self._raise_samples = 0
+
+        if self.level == LEVEL_NORMAL or time.time() - self.since < OVERLOAD_HOLD_SECONDS:
+            return
+        # 所有指标都降到当前级别进入阈值的 OVERLOAD_EXIT_RATIO 倍以下才降一级
+        for name, (_, thresholds) in self._signals.items():
+            if len(thresholds) >= self.level and values[name] >= thresholds[self.level - 1] * OVERLOAD_EXIT_RATIO:
+                return
+        self._set_level(self.level - 1, values)
+
+    def _set_level(self, level, values):
+        now = time.time()
+        old_level = self.level
+        self.level_seconds[old_level] += now - self.since
+        self.level = level
+        self.since = now
+        self._raise_samples = 0
+        self.stats["transitions"] += 1
+        self.stats["max_level"] = max(self.stats["max_level"], level)
+
+        details = ", ".join(f"{name}={value:.2f}" if isinstance(value, float) else f"{name}={value}" for name, value in values.items())
+        log = logging.warning if level > old_level else logging.info
+        log(f"负载级别变化: {LEVEL_NAMES[old_level]} -> {LEVEL_NAMES[level]} ({details})")
+        for listener in self._listeners:
+            asyncio.create_task(self._notify(listener, old_level, level, dict(values)))
+
+    async def _notify(self, listener, old_level, level, values):
+        try:
+            await listener(old_level, level, values)
+        except Exception as e:
+            logging.warning(f"通知负载级别变化时出错: {e}")
+
+    async def _monitor(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start_time = loop.time()
+            await asyncio.sleep(self.interval)
+            # 实际醒来时间比预期晚多少，即事件循环被阻塞或积压的程度
+            lag = max(0.0, loop.time() - start_time - self.interval)
+            try:
+                self.sample(lag)
+            except Exception as e:
+                logging.error(f"过载控制采样时出错: {e}")
+
+    async def start(self):
+        """开始定期采样"""
+        self._task = asyncio.create_task(self._monitor())
+        state = "已启用" if self.enabled else "只统计不降级"
+        logging.info(f"过载控制{state}: 采样间隔 {self.interval:.1f} 秒, 指标 {', '.join(self._signals)}")
+
+    async def stop(self):
+        """停止定期采样"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def get_stats(self):
+        """返回过载控制统计（包括当前级别、各指标最近一次的值和各级别停留时间）"""
+        now = time.time()
+        level_seconds = dict(self.level_seconds)
+        level_seconds[self.level] += now - self.since
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "level": self.level,
+            "level_name": LEVEL_NAMES[self.level],
+            "level_for_seconds": now - self.since,
+            "values": dict(self.values),
+            "thresholds": {name: thresholds for name, (_, thresholds) in self._signals.items()},
+            "max_lag": self.max_lag,
+            "level_seconds": level_seconds,
+            "actions": dict(self.actions),
+        }
+
+# 创建全局实例
+overload_controller = OverloadController()
@@ -0,0 +1,297 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+import fastapi_poe as fp
+from circuit_breaker import poe_breaker, CircuitOpenError
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 首字节截止时间（秒）：主请求在此时间内没有返回任何片段时发起对冲请求；默认0，不对冲
+# 对冲请求同样按消息计费，需要显式开启；POE_TTFT_DEADLINES 按 bot_names 中的键单独配置，如 "claude3=10,gpt4=10,claude35=6"
+POE_TTFT_DEADLINE = float(os.environ.get("POE_TTFT_DEADLINE", "0"))
+
+# 对冲或备用请求发送给哪个机器人（bot_names中的键），如 "claude3=claude35"
+# 设置了截止时间但没有配置时对冲到同一个机器人；只配置备用机器人而不设截止时间时，只在主请求出错时改用备用机器人
+POE_HEDGE_BOTS = os.environ.get("POE_HEDGE_BOTS", "")
+
+# 每个机器人保留的最近首字节耗时和输出速度样本数，用于计算分位数、调整截止时间和选择模型
+TTFT_SAMPLES = 200
+
+# 回复至少有这么多字符才统计输出速度（过短的回复主要反映首字节耗时）
+THROUGHPUT_MIN_CHARS = 200
+
+def parse_bot_map(value, bot_names):
+    """
+    解析 "键=值,..." 格式的配置，键为 bot_names 中的键
+
+    返回:
+        Poe机器人名称 -> 值（字符串）
+    """
+    result = {}
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        key, setting = (part.strip() for part in item.split('=', 1))
+        if key not in bot_names:
+            logging.warning(f"未知的模型: {key}（可用: {', '.join(bot_names)}）")
+            continue
+        result[bot_names[key]] = setting
+    return result
+
+def recent_values(samples, window=None):
+    """返回 (时间, 值) 样本中最近 window 秒内的值，window 为None时返回全部"""
+    if window is None:
+        return [value for _, value in samples]
+    cutoff = time.time() - window
+    return [value for timestamp, value in samples if timestamp >= cutoff]
+
+def percentile(samples, fraction):
+    """返回样本的分位数，没有样本时返回 0"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class _Leg:
+    """
+    一路Poe流式请求：在后台任务中读取片段放入队列，收到首个片段或结束时设置 first
+
+    结束（包括被取消）时把首字节耗时和输出速度记录到 streamer。
+    """
+
+    def __init__(self, streamer, messages, bot_name, api_key, hedge=False):
+        self.streamer = streamer
+        self.bot_name = bot_name
+        self.hedge = hedge
+        self.started = time.time()
+        self.first_at = None  # 收到首个片段的时间
+        self.completed_at = None  # 回复完整结束的时间
+        self.chars = 0
+        self.error = None
+        self.first = asyncio.Event()
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run(messages, api_key))
+
+    @property
+    def produced(self):
+        return self.first_at is not None
+
+    @property
+    def failed(self):
+        return self.first.is_set() and not self.produced
+
+    async def _run(self, messages, api_key):
+        try:
+            async with poe_breaker.guard() as call:
+                async for chunk in fp.get_bot_response(messages=messages, bot_name=self.bot_name, api_key=api_key):
+                    call.mark()
+                    if self.first_at is None:
+                        self.first_at = time.time()
+                    self.chars += len(chunk.text)
+                    self.queue.put_nowait(("text", chunk.text))
+                    self.first.set()
+            self.completed_at = time.time()
+            self.queue.put_nowait(("done", None))
+        except Exception as e:
+            self.error = e
+            self.queue.put_nowait(("error", e))
+        finally:
+            self.streamer._record_leg(self)
+            self.first.set()
+
+    def cancel(self):
+        self.task.cancel()
+
+async def _wait_first(legs, timeout=None):
+    """等待任意一路请求收到首个片段或结束"""
+    waiters = [asyncio.ensure_future(leg.first.wait()) for leg in legs]
+    try:
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+class PoeStreamer:
+    """
+    带首字节截止时间的Poe流式请求
+
+    设置了截止时间时，主请求在截止时间内没有返回任何片段就向同一个或指定的备用机器人发起对冲请求，
+    采用先返回片段的一路，立即取消另一路；设置了截止时间或备用机器人时，主请求在返回任何片段之前失败会立即改用备用机器人。
+    对冲请求胜出时记录它自发起到首个片段的耗时（主请求在这段时间内仍没有返回，实际耗时只会更长）。
+
+    用法:
+        poe_streamer.configure(bot_names)
+        async for text in poe_streamer.stream(messages, bot_name, api_key):
+            ...
+    """
+
+    def __init__(self, default_deadline=POE_TTFT_DEADLINE):
+        self.default_deadline = default_deadline
+        self.deadlines = {}  # Poe机器人名称 -> 首字节截止时间（秒）
+        self.hedge_bots = {}  # Poe机器人名称 -> 对冲请求使用的机器人
+        self.bots = {}  # 请求的机器人 -> 统计
+        self.ttft = {}  # 实际发出请求的机器人 -> 最近的 (时间, 首字节耗时秒数)
+        self.throughput = {}  # 实际发出请求的机器人 -> 最近的 (时间, 每秒输出字符数)
+
+    def configure(self, bot_names):
+        """根据环境变量和 bot_names 加载各机器人的截止时间和对冲目标"""
+        self.deadlines = {name: float(value) for name, value in parse_bot_map(os.environ.get("POE_TTFT_DEADLINES", ""), bot_names).items()}
+        self.hedge_bots = {name: bot_names.get(value, name) for name, value in parse_bot_map(POE_HEDGE_BOTS, bot_names).items()}
+        for name in set(self.deadlines) | set(self.hedge_bots):
+            if self.deadline_for(name) > 0:
+                logging.info(f"{name} 超过首字节截止时间 {self.deadline_for(name):.1f} 秒时对冲到 {self.hedge_bot_for(name)}")
+            else:
+                logging.info(f"{name} 出错时改用 {self.hedge_bot_for(name)}")
+
+    def deadline_for(self, bot_name):
+        return self.deadlines.get(bot_name, self.default_deadline)
+
+    def fallback_enabled(self, bot_name):
+        """主请求在返回片段之前出错时是否改用备用机器人（设置了截止时间或备用机器人时开启）"""
+        return self.deadline_for(bot_name) > 0 or bot_name in self.hedge_bots
+
+    def hedge_bot_for(self, bot_name):
+        return self.hedge_bots.get(bot_name, bot_name)
+
+    def _bot_stats(self, bot_name):
+        return self.bots.setdefault(bot_name, {
+            "requests": 0,
+            "answered": 0,
+            "failures": 0,
+            "hedges": 0,
+            "fallbacks": 0,
+            "hedge_wins": 0,
+            "primary_wins": 0,
+            "win_seconds": 0.0,
+            "win_samples": 0,
+            "ttft_seconds": 0.0,
+        })
+
+    def _record_leg(self, leg):
+        """
+        记录一路请求的首字节耗时和输出速度
+
+        没有返回片段就被取消的请求（对冲中落后的一路），如果已等待超过截止时间，
+        按已等待的时间记为首字节耗时（实际耗时的下限），慢的机器人不会因此显得没有样本。
+        """
+        now = time.time()
+        deadline = self.deadline_for(leg.bot_name)
+        if leg.produced:
+            ttft = leg.first_at - leg.started
+        elif leg.error is None and deadline > 0 and now - leg.started >= deadline:
+            ttft = now - leg.started
+        else:
+            return
+        self.ttft.setdefault(leg.bot_name, deque(maxlen=TTFT_SAMPLES)).append((now, ttft))
+        if leg.completed_at and leg.chars >= THROUGHPUT_MIN_CHARS and leg.completed_at > leg.first_at:
+            speed = leg.chars / (leg.completed_at - leg.first_at)
+            self.throughput.setdefault(leg.bot_name, deque(maxlen=TTFT_SAMPLES)).append((now, speed))
+
+    def performance(self, bot_name, window=None):
+        """
+        机器人最近的表现
+
+        参数:
+            bot_name: Poe机器人名称
+            window: 只统计最近这么多秒内的样本，为None时统计全部保留的样本
+
+        返回:
+            {"samples": 首字节样本数, "ttft_p50", "ttft_p90": 秒, "throughput": 每秒输出字符数的中位数（没有样本时为0）}
+        """
+        ttft = recent_values(self.ttft.get(bot_name, ()), window)
+        throughput = recent_values(self.throughput.get(bot_name, ()), window)
+        return {
+            "samples": len(ttft),
+            "ttft_p50": percentile(ttft, 0.5),
+            "ttft_p90": percentile(ttft, 0.9),
+            "throughput": percentile(throughput, 0.5),
+        }
+
+    async def stream(self, messages, bot_name, api_key, hedge=True):
+        """
+        流式获取Poe机器人的回复
+
+        参数:
+            messages: fp.ProtocolMessage 列表
+            bot_name: 首选的Poe机器人
+            api_key: Poe API密钥
+            hedge: 是否允许对冲和备用请求；为False时只请求 bot_name（如对比各模型时）
+
+        返回:
+            异步生成器，依次产生回复文本片段；两路请求都失败时抛出主请求的异常
+        """
+        stats = self._bot_stats(bot_name)
+        stats["requests"] += 1
+        start_time = time.time()
+        primary = _Leg(self, messages, bot_name, api_key)
+        legs = [primary]
+        try:
+            deadline = self.deadline_for(bot_name) if hedge else 0
+            await _wait_first(legs, deadline if deadline > 0 else None)
+
+            # 主请求超过截止时间仍没有片段，或在返回片段之前失败（熔断除外）时，发起对冲请求
+            timed_out = not primary.first.is_set()
+            failed_early = primary.failed and not isinstance(primary.error, CircuitOpenError) and self.fallback_enabled(bot_name)
+            if hedge and (timed_out or failed_early):
+                hedge_name = self.hedge_bot_for(bot_name)
+                stats_key = "hedges" if timed_out else "fallbacks"
+                stats[stats_key] += 1
+                reason = f"{deadline:.1f} 秒内没有返回内容" if timed_out else "请求失败"
+                logging.warning(f"{bot_name} {reason}，向 {hedge_name} 发起{'对冲' if timed_out else '备用'}请求")
+                legs.append(_Leg(self, messages, hedge_name, api_key, hedge=True))
+                while not any(leg.produced for leg in legs) and not all(leg.first.is_set() for leg in legs):
+                    await _wait_first([leg for leg in legs if not leg.first.is_set()])
+
+            producing = [leg for leg in legs if leg.produced]
+            winner = min(producing, key=lambda leg: leg.first_at) if producing else primary
+            if len(legs) > 1 and producing:
+                stats["hedge_wins" if winner.hedge else "primary_wins"] += 1
+                if winner.hedge:
+                    # 不再等待落后的主请求，按对冲请求自身的首字节耗时记录（主请求至少同样慢）
+                    stats["win_seconds"] += winner.first_at - winner.started
+                    stats["win_samples"] += 1
+                    logging.info(f"{'对冲' if stats_key == 'hedges' else '备用'}请求 {winner.bot_name} 先返回内容 (首字节 {winner.first_at - start_time:.2f} 秒)")
+            # 立即取消落后的一路，不为测量而保留第二个计费的流
+            for leg in legs:
+                if leg is not winner:
+                    leg.cancel()
+            if winner.produced:
+                stats["answered"] += 1
+                stats["ttft_seconds"] += winner.first_at - start_time
+
+            while True:
+                kind, value = await winner.queue.get()
+                if kind == "text":
+                    yield value
+                elif kind == "done":
+                    break
+                else:
+                    stats["failures"] += 1
+                    raise value
+        finally:
+            # 调用方提前结束（如被取消）时停止仍在进行的请求
+            for leg in legs:
+                leg.cancel()
+
+    def get_stats(self):
+        """返回各机器人的请求、对冲统计、首字节耗时分位数和输出速度"""
+        result = {}
+        # 只作为对冲目标使用过的机器人也列出其首字节耗时
+        for bot_name in list(self.bots) + [name for name in self.ttft if name not in self.bots]:
+            stats = self._bot_stats(bot_name)
+            answered = stats["answered"]
+            result[bot_name] = {
+                **stats,
+                **self.performance(bot_name),
+                "deadline": self.deadline_for(bot_name),
+                "hedge_bot": self.hedge_bot_for(bot_name),
+                "avg_ttft": stats["ttft_seconds"] / answered if answered else 0.0,
+                "avg_win_seconds": stats["win_seconds"] / stats["win_samples"] if stats["win_samples"] else 0.0,
+            }
+        return result
+
+# 创建全局实例
+poe_streamer = PoeStreamer()
@@ -0,0 +1,189 @@
+import os
+import glob
+import logging
+import google.generativeai as genai
+from PIL import Image
+from video_compressor import run_command
+from transcode_pool import PRIORITY_AUDIO, PRIORITY_FRAMES
+from gemini_stream import generate_content_stream
+from overload_control import overload_controller, LEVEL_MEDIA_LITE
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 视频分析模式: auto（按时长和大小自动选择）、full（上传完整视频）、storyboard（关键帧+音轨）
+VIDEO_ANALYSIS_MODE = os.environ.get("VIDEO_ANALYSIS_MODE", "auto").lower()
+
+# 自动模式下，时长或大小超过以下阈值的视频使用关键帧模式
+STORYBOARD_MIN_DURATION = int(os.environ.get("STORYBOARD_MIN_DURATION", "90"))  # 秒
+STORYBOARD_MIN_SIZE_MB = float(os.environ.get("STORYBOARD_MIN_SIZE_MB", "20"))  # 超过即需要压缩
+
+STORYBOARD_MAX_FRAMES = 12  # 发送给Gemini的关键帧数量上限
+STORYBOARD_FRAME_WIDTH = 640  # 关键帧宽度（像素）
+SCENE_THRESHOLD = 0.3  # ffmpeg场景变化阈值，越小抽取的帧越多
+
+def should_use_storyboard(duration, size_mb):
+    """
+    根据分析模式、视频时长和大小决定是否使用关键帧模式（自动模式下过载时总是使用关键帧模式）
+    """
+    if VIDEO_ANALYSIS_MODE == "storyboard":
+        return True
+    if VIDEO_ANALYSIS_MODE == "full":
+        return False
+    # 过载时所有视频都使用关键帧模式，省去压缩和完整视频上传
+    if overload_controller.at_least(LEVEL_MEDIA_LITE):
+        return True
+    return bool(duration and duration >= STORYBOARD_MIN_DURATION) or size_mb > STORYBOARD_MIN_SIZE_MB
+
+def pick_evenly(items, count):
+    """从列表中均匀选取 count 个元素（保持原有顺序）"""
+    if len(items) <= count:
+        return items
+    step = len(items) / count
+    return [items[int(i * step)] for i in range(count)]
+
+async def extract_keyframes(video_path, output_dir, duration=None, max_frames=STORYBOARD_MAX_FRAMES):
+    """
+    使用ffmpeg场景检测从视频中抽取代表性关键帧
+
+    只解码关键帧（-skip_frame nokey）并在其中按场景变化筛选，速度远快于完整解码；
+    场景变化过少（如固定机位）时改为按时长均匀抽帧。
+
+    参数:
+        video_path: 视频文件路径
+        output_dir: 关键帧输出目录
+        duration: 视频时长（秒），用于均匀抽帧
+        max_frames: 关键帧数量上限
+
+    返回:
+        按时间顺序排列的关键帧文件路径列表
+    """
+    scene_pattern = os.path.join(output_dir, "scene_%04d.jpg")
+    cmd = [
+        'ffmpeg', '-skip_frame', 'nokey', '-i', video_path,
+        '-vf', f"select='eq(n,0)+gt(scene,{SCENE_THRESHOLD})',scale={STORYBOARD_FRAME_WIDTH}:-2",
+        '-vsync', 'vfr',
+        '-frames:v', str(max_frames * 4),  # 先多抽一些，再均匀挑选，避免只覆盖视频开头
+        '-q:v', '4',
+        '-y', scene_pattern
+    ]
+    logging.info(f"开始抽取场景关键帧: {' '.join(cmd)}")
+    await run_command(cmd, priority=PRIORITY_FRAMES)
+    frames = sorted(glob.glob(os.path.join(output_dir, "scene_*.jpg")))
+
+    if len(frames) < max_frames // 2 and duration:
+        # 场景变化太少，按时长均匀抽帧
+        uniform_pattern = os.path.join(output_dir, "uniform_%04d.jpg")
+        cmd = [
+            'ffmpeg', '-i', video_path,
+            '-vf', f"fps={max_frames / duration:.6f},scale={STORYBOARD_FRAME_WIDTH}:-2",
+            '-frames:v', str(max_frames),
+            '-q:v', '4',
+            '-y', uniform_pattern
+        ]
+        logging.info(f"场景关键帧过少 ({len(frames)} 张)，改为均匀抽帧: {' '.join(cmd)}")
+        await run_command(cmd, priority=PRIORITY_FRAMES)
+        frames = sorted(glob.glob(os.path.join(output_dir, "uniform_*.jpg"))) or frames
+
+    frames = pick_evenly(frames, max_frames)
+    logging.info(f"共抽取 {len(frames)} 张关键帧")
+    return frames
+
+async def extract_audio_track(video_path, output_path):
+    """
+    抽取低码率单声道音轨（语音可懂度足够，体积只有几百KB）
+
+    返回:
+        音轨文件路径，视频没有音轨或抽取失败时返回 None
+    """
+    cmd = [
+        'ffmpeg', '-i', video_path,
+        '-vn',
+        '-ac', '1',
+        '-ar', '16000',
+        '-c:a', 'libmp3lame',
+        '-b:a', '32k',
+        '-y', output_path
+    ]
+    try:
+        logging.info(f"开始抽取音轨: {' '.join(cmd)}")
+        await run_command(cmd, priority=PRIORITY_AUDIO)
+        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            return output_path
+    except Exception as e:
+        logging.warning(f"抽取音轨失败（视频可能没有音轨）: {e}")
+    return None
+
+def storyboard_memory_bytes(frame_paths, audio_path):
+    """
+    估算关键帧分析请求占用的内存：解码后的关键帧像素，加上音轨数据及其内联发送时的副本
+
+    只读取图片文件头获取尺寸，不解码像素。
+    """
+    total = 0
+    for frame_path in frame_paths:
+        with Image.open(frame_path) as image:
+            total += image.width * image.height * len(image.getbands())
+    if audio_path:
+        total += os.path.getsize(audio_path) * 2
+    return total
+
+async def analyze_storyboard_with_gemini(frame_paths, audio_path, caption="", duration=None, on_text=None):
+    """
+    将关键帧和音轨在一次请求中发送给Gemini分析
+
+    关键帧和音轨都以内联数据发送，不需要先上传文件再等待其变为ACTIVE状态；
+    结果以流式方式生成，可通过 on_text 渐进显示。
+    """
+    model = genai.GenerativeModel('gemini-2.0-flash')
+
+    duration_text = f"时长约{int(duration)}秒的" if duration else ""
+    prompt = f"以下是从一个{duration_text}视频中按场景变化抽取的{len(frame_paths)}张关键帧（按时间顺序排列）"
+    prompt += "，以及该视频的音轨。" if audio_path else "。该视频没有音轨。"
+    prompt += "请结合画面和声音，详细描述这个视频的内容和情节发展。"
+    if caption:
+        prompt += f"如果用户提供了说明: {caption}，请特别关注相关内容。"
+    prompt += "请用中文回答。"
+
+    contents = [prompt]
+    for frame_path in frame_paths:
+        with Image.open(frame_path) as image:
+            image.load()
+            contents.append(image.copy())
+    if audio_path:
+        with open(audio_path, 'rb') as f:
+            contents.append({"mime_type": "audio/mp3", "data": f.read()})
+
+    return await generate_content_stream(model, contents, on_text)
+
+async def extract_storyboard(video_path, workspace, duration=None, has_audio=True):
+    """
+    关键帧模式的素材准备：抽取关键帧和低码率音轨，之后作为一个紧凑的多图+音频请求发送给Gemini
+
+    参数:
+        video_path: 视频文件路径
+        workspace: 任务工作目录（MediaWorkspace）
+        duration: 视频时长（秒）
+        has_audio: 视频是否含音轨（探测结果表明没有音轨时跳过音轨抽取）
+
+    返回:
+        (关键帧路径列表, 音轨路径或None)，抽帧失败时返回 None（调用方应回退到完整视频模式）
+    """
+    frames_dir = workspace.path("frames")
+    os.makedirs(frames_dir, exist_ok=True)
+
+    try:
+        frame_paths = await extract_keyframes(video_path, frames_dir, duration)
+    except Exception as e:
+        logging.error(f"抽取关键帧失败: {e}")
+        return None
+
+    if not frame_paths:
+        logging.warning("未能抽取到任何关键帧")
+        return None
+
+    audio_path = await extract_audio_track(video_path, workspace.path("storyboard_audio.mp3")) if has_audio else None
+
+    payload_kb = sum(os.path.getsize(p) for p in frame_paths + ([audio_path] if audio_path else [])) / 1024
+    logging.info(f"关键帧模式请求大小: {payload_kb:.0f}KB ({len(frame_paths)} 张关键帧, 音轨: {'有' if audio_path else '无'})")
+    return frame_paths, audio_path
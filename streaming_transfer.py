@@ -0,0 +1,212 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import httpx
+import google.generativeai as genai
+from gemini_files import gemini_files
+from memory_budget import memory_budget
+from circuit_breaker import gemini_breaker
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 流式传输：边从Telegram下载边写入Gemini可续传上传会话，两段传输时间重叠
+STREAM_TRANSFER_ENABLED = os.environ.get("STREAM_TRANSFER", "1") == "1"
+STREAM_TRANSFER_MIN_BYTES = int(float(os.environ.get("STREAM_TRANSFER_MIN_MB", "5")) * 1024 * 1024)
+
+# 下载与上传之间的缓冲上限：队列中最多 STREAM_BUFFER_CHUNKS 个下载分块
+STREAM_BUFFER_CHUNKS = int(os.environ.get("STREAM_BUFFER_CHUNKS", "16"))
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# 每次上传请求的数据量，会向上取整为服务端要求的分块粒度的整数倍
+UPLOAD_CHUNK_SIZE = int(float(os.environ.get("STREAM_UPLOAD_CHUNK_MB", "2")) * 1024 * 1024)
+DEFAULT_UPLOAD_GRANULARITY = 256 * 1024
+
+# 一次流式传输最多占用的内存：队列中的下载分块，加上上传缓冲及发送时的副本
+STREAM_MEMORY_BYTES = STREAM_BUFFER_CHUNKS * DOWNLOAD_CHUNK_SIZE + 2 * UPLOAD_CHUNK_SIZE
+
+# Gemini文件上传接口（可替换为本地替身服务器用于测试）
+GEMINI_UPLOAD_URL = os.environ.get("GEMINI_UPLOAD_URL", "https://generativelanguage.googleapis.com/upload/v1beta/files")
+GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY", "")
+
+TRANSFER_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+async def start_upload_session(client, total_size, mime_type, display_name, api_key=GOOGLE_API_KEY):
+    """
+    创建Gemini可续传上传会话
+
+    返回:
+        (上传地址, 分块粒度字节数)
+    """
+    response = await client.post(
+        GEMINI_UPLOAD_URL,
+        params={"key": api_key},
+        headers={
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(total_size),
+            "X-Goog-Upload-Header-Content-Type": mime_type,
+        },
+        json={"file": {"display_name": display_name}},
+    )
+    response.raise_for_status()
+    upload_url = response.headers.get("X-Goog-Upload-URL")
+    if not upload_url:
+        raise Exception("上传会话创建失败：响应中没有上传地址")
+    granularity = int(response.headers.get("X-Goog-Upload-Chunk-Granularity") or DEFAULT_UPLOAD_GRANULARITY)
+    return upload_url, granularity
+
+async def stream_transfer(download_url, total_size, mime_type, display_name, tee_path=None,
+                          client=None, api_key=GOOGLE_API_KEY):
+    """
+    将文件从下载地址流式传输到Gemini可续传上传会话
+
+    下载和上传并发进行，中间通过有界队列传递分块：上传跟不上时下载会被阻塞，
+    内存中最多保留 STREAM_BUFFER_CHUNKS 个下载分块加一个上传分块。
+    同时计算内容的SHA-256，并可将数据同步写入本地文件（tee_path）供后续处理使用（在线程中写入，不阻塞事件循环）。
+    只有上传会话的调用受 Gemini 熔断器保护，下载失败或数据不完整不计为 Gemini 的失败。
+
+    参数:
+        download_url: 文件下载地址
+        total_size: 文件大小（字节），上传会话需要预先声明
+        mime_type: 文件MIME类型
+        display_name: 远程文件显示名称
+        tee_path: 同步保存的本地文件路径，为None时不落盘
+        client: httpx.AsyncClient，为None时创建临时客户端
+        api_key: Gemini API密钥
+
+    返回:
+        dict: {"file": 远程文件信息, "sha256", "download_seconds", "total_seconds"}
+    """
+    own_client = client is None
+    if own_client:
+        client = httpx.AsyncClient(timeout=TRANSFER_TIMEOUT)
+
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    queue = asyncio.Queue(maxsize=STREAM_BUFFER_CHUNKS)
+    digest = hashlib.sha256()
+    timings = {}
+
+    async def download():
+        received = 0
+        tee_file = await asyncio.to_thread(open, tee_path, 'wb') if tee_path else None
+        try:
+            async with client.stream("GET", download_url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    if tee_file:
+                        await asyncio.to_thread(tee_file.write, chunk)
+                    received += len(chunk)
+                    await queue.put(chunk)
+        finally:
+            if tee_file:
+                await asyncio.to_thread(tee_file.close)
+        if received != total_size:
+            raise Exception(f"下载不完整：期望 {total_size} 字节，实际 {received} 字节")
+        timings["download_seconds"] = loop.time() - start_time
+        await queue.put(None)
+
+    async def upload():
+        # 下载失败时上传任务被取消，熔断器不计入结果
+        async with gemini_breaker.guard(timed=False):
+            return await upload_session()
+
+    async def upload_session():
+        upload_url, granularity = await start_upload_session(client, total_size, mime_type, display_name, api_key)
+        chunk_size = max(granularity, -(-UPLOAD_CHUNK_SIZE // granularity) * granularity)
+        buffer = bytearray()
+        offset = 0
+        finished = False
+
+        while not finished:
+            chunk = await queue.get()
+            if chunk is None:
+                finished = True
+            else:
+                buffer.extend(chunk)
+                if len(buffer) < chunk_size:
+                    continue
+
+            # 非最后一块必须是分块粒度的整数倍，余下部分留到下一次发送
+            send_size = len(buffer) if finished else len(buffer) // granularity * granularity
+            response = await client.post(
+                upload_url,
+                headers={
+                    "X-Goog-Upload-Command": "upload, finalize" if finished else "upload",
+                    "X-Goog-Upload-Offset": str(offset),
+                },
+                content=bytes(buffer[:send_size]),
+            )
+            response.raise_for_status()
+            offset += send_size
+            del buffer[:send_size]
+
+        if response.headers.get("X-Goog-Upload-Status", "final") != "final":
+            raise Exception("上传未完成：服务端未确认最终分块")
+        return response.json()["file"]
+
+    tasks = [asyncio.ensure_future(download()), asyncio.ensure_future(upload())]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception():
+                raise task.exception()
+        remote_file = tasks[1].result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if own_client:
+            await client.aclose()
+
+    total_seconds = loop.time() - start_time
+    logging.info(
+        f"流式传输完成: {total_size} 字节, 下载 {timings['download_seconds']:.2f} 秒, "
+        f"下载+上传共 {total_seconds:.2f} 秒"
+    )
+    return {
+        "file": remote_file,
+        "sha256": digest.hexdigest(),
+        "download_seconds": timings["download_seconds"],
+        "total_seconds": total_seconds,
+    }
+
+async def download_with_streaming_upload(bot, file_id, dest_path, expected_size, mime_type, stage="acquire"):
+    """
+    下载Telegram文件到 dest_path，同时流式上传到Gemini
+
+    上传完成的远程文件会按内容哈希登记到上传管理器，之后对 dest_path 的分析直接复用，
+    不会再次上传。任何一步失败都返回 None，调用方应回退到普通下载。
+    传输期间按 STREAM_MEMORY_BYTES 预留内存预算（记录在 stage 阶段）。
+
+    返回:
+        下载完成的文件路径，失败返回 None
+    """
+    try:
+        file = await bot.get_file(file_id)
+        download_url = file.file_path
+        total_size = file.file_size or expected_size
+        # 本地Bot API服务器返回的是本地路径，无需流式下载
+        if not download_url or not download_url.startswith("http") or not total_size:
+            return None
+
+        # Gemini熔断时直接回退到普通下载（上传会话本身在 stream_transfer 中受熔断器保护）
+        if not gemini_breaker.allow():
+            logging.info("Gemini已熔断，跳过流式传输")
+            return None
+        async with memory_budget.reserve(min(STREAM_MEMORY_BYTES, total_size), stage):
+            result = await stream_transfer(download_url, total_size, mime_type, os.path.basename(dest_path), dest_path)
+        remote_file = await asyncio.to_thread(genai.get_file, result["file"]["name"])
+        await gemini_files.register(result["sha256"], remote_file, streamed=True)
+        return dest_path
+    except Exception as e:
+        # 错误信息中可能包含带令牌的下载地址，只记录异常类型和状态
+        logging.warning(f"流式传输失败，回退到普通下载: {type(e).__name__}: {str(e).split('https://')[0]}")
+        if os.path.exists(dest_path):
+            os.unlink(dest_path)
+        return None
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 压缩结果缓存目录，默认放在数据目录中（容器重启后仍然有效）
+TRANSCODE_CACHE_DIR = os.environ.get("TRANSCODE_CACHE_DIR") or os.path.join("data", "transcode_cache")
+
+# 缓存文件总大小上限（MB），超出时淘汰最久未使用的结果；0表示关闭缓存
+TRANSCODE_CACHE_MB = float(os.environ.get("TRANSCODE_CACHE_MB", "1024"))
+TRANSCODE_CACHE_BYTES = int(TRANSCODE_CACHE_MB * 1024 * 1024)
+
+INDEX_FILE = "index.json"
+
+class TranscodeCache:
+    """
+    视频压缩结果的磁盘缓存
+
+    以 (源文件内容哈希, 目标大小, 最大宽度, 编码配置) 为键，同一个视频换一个说明再次发送时
+    直接取出之前的压缩结果，不再重复编码。缓存按文件总大小做LRU淘汰，索引写入 INDEX_FILE。
+    取出的结果以硬链接放入任务工作目录（跨文件系统时复制），之后被淘汰也不影响正在使用的任务。
+
+    用法:
+        key = transcode_cache.key_for(source_hash, 19, 1280, "x264-1pass-v1")
+        if await transcode_cache.fetch(key, output_path):
+            ...  # 命中
+        await transcode_cache.store(key, output_path, cpu_seconds)
+    """
+
+    def __init__(self, root=TRANSCODE_CACHE_DIR, max_bytes=TRANSCODE_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._entries = None  # 键 -> 条目，按最近使用排序；首次使用时从索引加载
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "cpu_seconds_saved": 0.0,
+        }
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key_for(source_hash, target_size_mb, max_width, profile):
+        """由源文件哈希和编码参数生成缓存键"""
+        return hashlib.sha256(f"{source_hash}|{target_size_mb}|{max_width}|{profile}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.mp4")
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = OrderedDict()
+        index_path = os.path.join(self.root, INDEX_FILE)
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    entries = json.load(f)
+                # 按最后使用时间恢复LRU顺序，丢弃文件已不存在的条目
+                for key, entry in sorted(entries.items(), key=lambda item: item[1]["last_used"]):
+                    if os.path.exists(self._path(key)):
+                        self._entries[key] = entry
+            except Exception as e:
+                logging.error(f"加载转码缓存索引时出错: {e}")
+
+        # 删除不在索引中的文件（如写入索引前崩溃留下的）
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                if name != INDEX_FILE and name[:-len(".mp4")] not in self._entries:
+                    try:
+                        os.unlink(os.path.join(self.root, name))
+                    except OSError:
+                        pass
+
+    def _save(self):
+        """写入临时文件后替换，避免写到一半时崩溃损坏索引"""
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            index_path = os.path.join(self.root, INDEX_FILE)
+            temp_path = f"{index_path}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(self._entries, f, indent=2)
+            os.replace(temp_path, index_path)
+        except Exception as e:
+            logging.error(f"保存转码缓存索引时出错: {e}")
+
+    def total_bytes(self):
+        self._load()
+        return sum(entry["size"] for entry in self._entries.values())
+
+    async def fetch(self, key, dest_path):
+        """
+        查找缓存的压缩结果并放到 dest_path
+
+        返回:
+            命中时返回 True
+        """
+        if not self.enabled:
+            return False
+        self._load()
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return False
+
+        try:
+            await asyncio.to_thread(_link_or_copy, self._path(key), dest_path)
+        except OSError as e:
+            logging.warning(f"读取转码缓存失败，将重新编码: {e}")
+            self._entries.pop(key, None)
+            self._save()
+            self.stats["misses"] += 1
+            return False
+
+        self._entries.move_to_end(key)
+        entry["last_used"] = time.time()
+        entry["hits"] += 1
+        self._save()
+        self.stats["hits"] += 1
+        self.stats["cpu_seconds_saved"] += entry["cpu_seconds"]
+        logging.info(f"转码缓存命中: {entry['size'] / 1024 / 1024:.2f}MB, 节省约 {entry['cpu_seconds']:.1f} CPU秒")
+        return True
+
+    async def store(self, key, path, cpu_seconds):
+        """
+        缓存一次成功编码的结果，必要时淘汰最久未使用的条目
+
+        参数:
+            key: key_for 生成的缓存键
+            path: 编码结果文件路径（文件本身保留在原处）
+            cpu_seconds: 这次编码消耗的CPU时间，命中时计为节省的时间
+        """
+        if not self.enabled:
+            return
+        self._load()
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return
+
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            temp_path = self._path(key) + ".tmp"
+            await asyncio.to_thread(shutil.copyfile, path, temp_path)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            logging.warning(f"写入转码缓存失败: {e}")
+            return
+
+        now = time.time()
+        self._entries[key] = {"size": size, "cpu_seconds": cpu_seconds, "created": now, "last_used": now, "hits": 0}
+        self._entries.move_to_end(key)
+        self.stats["stores"] += 1
+
+        total = self.total_bytes()
+        while total > self.max_bytes and len(self._entries) > 1:
+            old_key, old_entry = self._entries.popitem(last=False)
+            try:
+                os.unlink(self._path(old_key))
+            except OSError:
+                pass
+            total -= old_entry["size"]
+            self.stats["evictions"] += 1
+            logging.info(f"转码缓存已满，淘汰最久未使用的结果 ({old_entry['size'] / 1024 / 1024:.2f}MB)")
+        self._save()
+
+    def get_stats(self):
+        """返回缓存统计（包括命中率和当前占用）"""
+        self._load()
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+        }
+
+def _link_or_copy(source, dest):
+    """优先创建硬链接（不复制数据），跨文件系统时复制"""
+    if os.path.exists(dest):
+        os.unlink(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copyfile(source, dest)
+
+# 创建全局实例
+transcode_cache = TranscodeCache()
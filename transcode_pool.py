@@ -0,0 +1,338 @@
+import os
+import re
+import time
+import heapq
+import asyncio
+import itertools
+import contextvars
+import logging
+import subprocess
+from contextlib import contextmanager
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+CPU_COUNT = os.cpu_count() or 2
+
+# 同时运行的ffmpeg进程数，默认约为CPU核数的一半
+TRANSCODE_SLOTS = int(os.environ.get("TRANSCODE_SLOTS", "0")) or max(1, CPU_COUNT // 2)
+
+# 单个ffmpeg任务的默认超时时间（秒）
+TRANSCODE_TIMEOUT = float(os.environ.get("TRANSCODE_TIMEOUT", "900"))
+
+# 任务优先级：数值越小越先执行，短音频转换插队到长视频编码之前
+PRIORITY_AUDIO = 0
+PRIORITY_FRAMES = 1
+PRIORITY_VIDEO = 2
+
+# 终止ffmpeg时等待其自行退出的时间（秒），超时后强制kill
+TERMINATE_GRACE_PERIOD = 5
+
+# 管道读写的分块大小（字节）
+PIPE_CHUNK_SIZE = 64 * 1024
+
+# ffmpeg -benchmark 在结束时输出的CPU时间
+BENCHMARK_PATTERN = re.compile(rb"bench: utime=([\d.]+)s stime=([\d.]+)s")
+
+# 当前任务的CPU时间计量（见 measure_cpu），并发的子任务共享同一个计量
+_cpu_meter = contextvars.ContextVar("cpu_meter", default=None)
+
+class CpuMeter:
+    """累计一段处理中所有ffmpeg进程的CPU时间（秒）"""
+
+    def __init__(self):
+        self.seconds = 0.0
+
+@contextmanager
+def measure_cpu():
+    """
+    统计 with 块内（包括其中创建的并发任务）通过执行器运行的ffmpeg进程的CPU时间
+
+    用法:
+        with measure_cpu() as meter:
+            await compress(...)
+        print(meter.seconds)
+    """
+    meter = CpuMeter()
+    token = _cpu_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _cpu_meter.reset(token)
+
+class TranscodeExecutor:
+    """
+    有界的ffmpeg执行器
+
+    最多同时运行 slots 个ffmpeg进程，排队的任务按优先级出队；
+    每个任务的线程数为 CPU核数/slots，避免多个编码互相争抢CPU。
+    任务被取消或超时时会终止对应的ffmpeg进程。
+    """
+
+    def __init__(self, slots=TRANSCODE_SLOTS):
+        self.slots = slots
+        self.threads_per_job = max(1, CPU_COUNT // slots)
+        self._running = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self.stats = {
+            "completed": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "timeouts": 0,
+            "queue_seconds": 0.0,
+            "run_seconds": 0.0,
+            "cpu_seconds": 0.0,
+        }
+
+    @property
+    def queue_depth(self):
+        """当前排队中的任务数"""
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    @property
+    def running(self):
+        """当前正在运行的任务数"""
+        return self._running
+
+    async def _acquire(self, priority):
+        """按优先级获取一个执行槽位"""
+        if self._running < self.slots and not self.queue_depth:
+            self._running += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 槽位已经移交给本任务但任务被取消，需要把槽位让给下一个任务
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        """释放槽位，优先直接移交给排队中优先级最高的任务"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._running -= 1
+
+    def _apply_thread_limit(self, cmd):
+        """为ffmpeg命令设置线程数（作为输出选项放在输出文件之前）"""
+        if cmd[0] != 'ffmpeg' or '-threads' in cmd:
+            return cmd
+        return cmd[:-1] + ['-threads', str(self.threads_per_job), cmd[-1]]
+
+    def _record_cpu(self, stderr, run_seconds):
+        """
+        记录ffmpeg进程的CPU时间（用户态+内核态），计入当前的 measure_cpu 计量
+
+        输出中没有 -benchmark 信息时按 执行时间×线程数 估计。
+        """
+        match = BENCHMARK_PATTERN.search(stderr or b"")
+        cpu_seconds = float(match.group(1)) + float(match.group(2)) if match else run_seconds * self.threads_per_job
+        self.stats["cpu_seconds"] += cpu_seconds
+        meter = _cpu_meter.get()
+        if meter:
+            meter.seconds += cpu_seconds
+
+    async def _terminate(self, process):
+        """终止ffmpeg进程，超过宽限时间后强制kill"""
+        if process.returncode is not None:
+            return
+        try:
+            process.terminate()
+            await asyncio.wait_for(process.wait(), TERMINATE_GRACE_PERIOD)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+        except ProcessLookupError:
+            pass
+
+    async def run(self, cmd, priority=PRIORITY_VIDEO, timeout=TRANSCODE_TIMEOUT, input_data=None):
+        """
+        排队执行ffmpeg命令
+
+        参数:
+            cmd: 命令参数列表
+            priority: 优先级（PRIORITY_AUDIO / PRIORITY_FRAMES / PRIORITY_VIDEO）
+            timeout: 执行超时时间（秒，不含排队时间）
+            input_data: 写入进程标准输入的数据
+
+        返回:
+            (returncode, stdout, stderr)
+        """
+        loop = asyncio.get_running_loop()
+        enqueue_time = loop.time()
+        await self._acquire(priority)
+        start_time = loop.time()
+        queue_seconds = start_time - enqueue_time
+        self.stats["queue_seconds"] += queue_seconds
+
+        process = None
+        try:
+            cmd = self._apply_thread_limit(cmd)
+            if cmd[0] == 'ffmpeg' and '-benchmark' not in cmd:
+                cmd = [cmd[0], '-benchmark'] + cmd[1:]
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=subprocess.PIPE if input_data is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            stdout, stderr = await asyncio.wait_for(process.communicate(input_data), timeout)
+
+            run_seconds = loop.time() - start_time
+            self.stats["run_seconds"] += run_seconds
+            self.stats["completed" if process.returncode == 0 else "failed"] += 1
+            self._record_cpu(stderr, run_seconds)
+            logging.info(f"{cmd[0]} 任务完成: 排队 {queue_seconds:.2f} 秒, 执行 {run_seconds:.2f} 秒 (优先级 {priority})")
+            return process.returncode, stdout, stderr
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            logging.error(f"{cmd[0]} 任务执行超过 {timeout} 秒，正在终止")
+            await self._terminate(process)
+            raise Exception(f"命令执行超时 ({timeout} 秒)")
+        except asyncio.CancelledError:
+            self.stats["cancelled"] += 1
+            if process is not None:
+                logging.info(f"{cmd[0]} 任务已取消，正在终止进程")
+                await self._terminate(process)
+            raise
+        except Exception:
+            self.stats["failed"] += 1
+            if process is not None:
+                await self._terminate(process)
+            raise
+        finally:
+            self._release()
+
+    async def run_piped(self, cmd, input_data=None, input_path=None, output_path=None,
+                        priority=PRIORITY_AUDIO, timeout=TRANSCODE_TIMEOUT, max_output_bytes=None):
+        """
+        通过管道排队执行ffmpeg命令：并发写入标准输入、读取标准输出，不经过临时文件
+
+        写入和读取都按固定大小分块进行，进程管道本身也有缓冲上限，
+        因此无论输入输出多大，内存中只保留有限的数据。
+
+        参数:
+            cmd: 命令参数列表（输入应为 pipe:0，输出应为 pipe:1）
+            input_data: 写入标准输入的字节数据
+            input_path: 分块读取并写入标准输入的文件路径（与 input_data 二选一）
+            output_path: 标准输出分块写入的文件路径；为None时收集为字节数据返回
+            priority: 优先级
+            timeout: 执行超时时间（秒，不含排队时间）
+            max_output_bytes: 收集标准输出的上限，超出时终止进程
+
+        返回:
+            (returncode, stdout字节数据或None, stderr)
+        """
+        loop = asyncio.get_running_loop()
+        enqueue_time = loop.time()
+        await self._acquire(priority)
+        start_time = loop.time()
+        queue_seconds = start_time - enqueue_time
+        self.stats["queue_seconds"] += queue_seconds
+
+        has_input = input_data is not None or input_path is not None
+        process = None
+        output_file = open(output_path, 'wb') if output_path else None
+        output_buffer = bytearray()
+        stderr_tail = bytearray()
+
+        async def feed_stdin():
+            try:
+                if input_data is not None:
+                    view = memoryview(input_data)
+                    for offset in range(0, len(view), PIPE_CHUNK_SIZE):
+                        process.stdin.write(view[offset:offset + PIPE_CHUNK_SIZE])
+                        await process.stdin.drain()
+                elif input_path is not None:
+                    with open(input_path, 'rb') as f:
+                        while chunk := f.read(PIPE_CHUNK_SIZE):
+                            process.stdin.write(chunk)
+                            await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # ffmpeg 可能在读完所需数据后提前关闭输入
+                pass
+            finally:
+                if process.stdin and not process.stdin.is_closing():
+                    process.stdin.close()
+
+        async def read_stdout():
+            while chunk := await process.stdout.read(PIPE_CHUNK_SIZE):
+                if output_file:
+                    output_file.write(chunk)
+                else:
+                    output_buffer.extend(chunk)
+                    if max_output_bytes and len(output_buffer) > max_output_bytes:
+                        raise Exception(f"输出超过上限 {max_output_bytes} 字节")
+
+        async def read_stderr():
+            while chunk := await process.stderr.read(PIPE_CHUNK_SIZE):
+                # 只保留最后一部分错误输出，避免ffmpeg日志占用过多内存
+                stderr_tail.extend(chunk)
+                del stderr_tail[:-PIPE_CHUNK_SIZE]
+
+        try:
+            cmd = self._apply_thread_limit(cmd)
+            if cmd[0] == 'ffmpeg' and '-benchmark' not in cmd:
+                cmd = [cmd[0], '-benchmark'] + cmd[1:]
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=subprocess.PIPE if has_input else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            tasks = [read_stdout(), read_stderr()]
+            if has_input:
+                tasks.append(feed_stdin())
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+            await process.wait()
+
+            run_seconds = loop.time() - start_time
+            self.stats["run_seconds"] += run_seconds
+            self.stats["completed" if process.returncode == 0 else "failed"] += 1
+            # -benchmark 的输出在最后，保留的错误输出末尾中一定包含
+            self._record_cpu(bytes(stderr_tail), run_seconds)
+            logging.info(f"{cmd[0]} 管道任务完成: 排队 {queue_seconds:.2f} 秒, 执行 {run_seconds:.2f} 秒 (优先级 {priority})")
+            return process.returncode, None if output_file else bytes(output_buffer), bytes(stderr_tail)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            logging.error(f"{cmd[0]} 管道任务执行超过 {timeout} 秒，正在终止")
+            await self._terminate(process)
+            raise Exception(f"命令执行超时 ({timeout} 秒)")
+        except asyncio.CancelledError:
+            self.stats["cancelled"] += 1
+            if process is not None:
+                logging.info(f"{cmd[0]} 管道任务已取消，正在终止进程")
+                await self._terminate(process)
+            raise
+        except Exception:
+            self.stats["failed"] += 1
+            if process is not None:
+                await self._terminate(process)
+            raise
+        finally:
+            if output_file:
+                output_file.close()
+            self._release()
+
+    def get_stats(self):
+        """返回执行器统计数据（包括平均排队时间和平均执行时间）"""
+        finished = self.stats["completed"] + self.stats["failed"]
+        return {
+            **self.stats,
+            "slots": self.slots,
+            "threads_per_job": self.threads_per_job,
+            "running": self.running,
+            "queued": self.queue_depth,
+            "avg_queue_seconds": self.stats["queue_seconds"] / finished if finished else 0.0,
+            "avg_run_seconds": self.stats["run_seconds"] / finished if finished else 0.0,
+        }
+
+# 创建全局实例
+transcode_executor = TranscodeExecutor()
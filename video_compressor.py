@@ -1,37 +1,386 @@
 import os
+import glob
+import math
+import shutil
 import logging
-import tempfile
 import subprocess
 import asyncio
 from pathlib import Path
+from transcode_pool import transcode_executor, measure_cpu, PRIORITY_AUDIO, PRIORITY_VIDEO, TRANSCODE_TIMEOUT
+from transcode_cache import transcode_cache
+from media_probe import probe_media, content_hash
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-async def compress_video(video_bytes, target_size_mb=19, max_width=1280, quality=23):
+# 是否使用两遍编码（码率更精确，但编码时间约为单遍的1.5-2倍）
+COMPRESS_TWO_PASS = os.environ.get("COMPRESS_TWO_PASS", "").lower() in ("1", "true", "yes")
+
+# 编码配置的版本号，修改编码参数（码率方案、x264选项等）后递增，使旧的缓存结果失效
+COMPRESS_PROFILE_VERSION = 1
+
+# 分辨率/帧率阶梯：按码率预算从高到低选择第一个每像素比特数足够的档位
+RESOLUTION_LADDER = [(1280, 30), (854, 30), (640, 24), (480, 20), (320, 15)]
+MIN_BITS_PER_PIXEL = 0.04  # libx264 在此以下画面明显劣化
+MIN_VIDEO_BITRATE_KBPS = 100  # 视频码率下限，低于此值时截短视频
+MAX_VIDEO_BITRATE_KBPS = 4000  # 视频码率上限，短视频无需用满预算，输出越小上传越快
+CONTAINER_OVERHEAD = 0.96  # 为MP4封装开销预留约4%
+SIZE_TOLERANCE = 1.0  # 输出允许达到目标大小的倍数
+
+# 大于该大小的视频切分为多个片段并发编码
+SEGMENT_MIN_SIZE_MB = float(os.environ.get("SEGMENT_MIN_SIZE_MB", "100"))
+SEGMENT_MIN_SECONDS = 10  # 单个片段的最短时长（秒），过短的片段会降低码率控制精度
+
+def plan_compression(info, target_size_mb, max_width=1280):
+    """
+    根据目标大小和视频时长计算压缩方案
+    
+    先由目标大小和时长得到总码率预算，扣除音频码率后得到视频码率，
+    再按每像素比特数从分辨率阶梯中选出能承受该码率的最高分辨率和帧率。
+    
+    参数:
+        info: probe_media 返回的 MediaInfo
+        target_size_mb: 目标大小（MB）
+        max_width: 最大宽度（像素）
+        
+    返回:
+        dict: 视频码率、音频码率/声道、输出宽度、帧率，以及必要时的截取时长
+    """
+    duration = info.duration
+    target_kbits = target_size_mb * 1024 * 1024 * 8 / 1000 * CONTAINER_OVERHEAD
+    budget_kbps = target_kbits / duration
+    
+    # 音频码率随总预算降低
+    if not info.has_audio:
+        audio_kbps, audio_channels = 0, 0
+    elif budget_kbps >= 1000:
+        audio_kbps, audio_channels = 96, 2
+    elif budget_kbps >= 400:
+        audio_kbps, audio_channels = 64, 1
+    else:
+        audio_kbps, audio_channels = 48, 1
+    
+    video_kbps = min(budget_kbps - audio_kbps, MAX_VIDEO_BITRATE_KBPS)
+    duration_limit = None
+    
+    # 预算不足以支撑最低视频码率时，只能截取前一段视频
+    if video_kbps < MIN_VIDEO_BITRATE_KBPS:
+        video_kbps = MIN_VIDEO_BITRATE_KBPS
+        duration_limit = int(target_kbits / (video_kbps + audio_kbps))
+        logging.warning(f"视频时长 {duration:.1f} 秒超出码率预算，将截取前 {duration_limit} 秒")
+    
+    src_width = info.width or max_width
+    src_height = info.height or int(src_width * 9 / 16)
+    src_fps = info.fps or 30
+    
+    # 选择每像素比特数足够的最高档位
+    ladder = [(w, fps) for w, fps in RESOLUTION_LADDER if w <= max_width] or [RESOLUTION_LADDER[-1]]
+    width, fps = ladder[-1]
+    for ladder_width, ladder_fps in ladder:
+        out_width = min(ladder_width, src_width)
+        out_height = src_height * out_width / src_width
+        out_fps = min(ladder_fps, src_fps)
+        bits_per_pixel = video_kbps * 1000 / (out_width * out_height * out_fps)
+        if bits_per_pixel >= MIN_BITS_PER_PIXEL:
+            width, fps = ladder_width, ladder_fps
+            break
+    
+    return {
+        "video_bitrate_kbps": int(video_kbps),
+        "audio_bitrate_kbps": audio_kbps,
+        "audio_channels": audio_channels,
+        "width": min(width, src_width) // 2 * 2,  # libx264 要求宽度为偶数
+        "fps": min(fps, round(src_fps)) if src_fps else fps,
+        "duration_limit": duration_limit,
+    }
+
+def build_encode_command(input_path, output_path, plan, pass_number=None, passlog_prefix=None):
+    """
+    根据压缩方案生成ffmpeg命令
+    
+    参数:
+        pass_number: 两遍编码时的遍数（1或2），单遍编码为None
+        passlog_prefix: 两遍编码的统计文件前缀
+    """
+    video_kbps = plan["video_bitrate_kbps"]
+    cmd = ['ffmpeg', '-i', input_path]
+    
+    if plan["duration_limit"]:
+        cmd += ['-t', str(plan["duration_limit"])]
+    
+    # 使用目标码率并限制峰值码率，使单遍编码的输出大小贴近预算
+    cmd += [
+        '-c:v', 'libx264',
+        '-b:v', f'{video_kbps}k',
+        '-maxrate', f'{int(video_kbps * 1.5)}k',
+        '-bufsize', f'{video_kbps * 2}k',
+        '-preset', 'fast',
+        '-tune', 'fastdecode',  # 针对解码速度优化
+        '-pix_fmt', 'yuv420p',  # 使用标准像素格式
+        '-r', str(plan["fps"]),
+        '-vf', f'scale={plan["width"]}:-2',  # 按比例缩放，保持宽高比
+        '-profile:v', 'baseline',  # 使用基线配置文件，提高兼容性
+    ]
+    
+    if pass_number:
+        cmd += ['-pass', str(pass_number), '-passlogfile', passlog_prefix]
+    
+    if pass_number == 1:
+        # 第一遍只收集统计信息，不输出文件
+        cmd += ['-an', '-f', 'null', '-y', os.devnull]
+        return cmd
+    
+    if plan["audio_channels"]:
+        cmd += ['-c:a', 'aac', '-b:a', f'{plan["audio_bitrate_kbps"]}k', '-ac', str(plan["audio_channels"])]
+    else:
+        cmd += ['-an']
+    
+    cmd += ['-movflags', '+faststart', '-y', output_path]  # 优化流式处理
+    return cmd
+
+async def encode_with_plan(input_path, output_path, plan, two_pass=False, passlog_prefix=None):
+    """
+    按压缩方案对单个文件执行一次（或两遍）编码
+    """
+    if two_pass:
+        cmd1 = build_encode_command(input_path, output_path, plan, 1, passlog_prefix)
+        logging.info(f"开始第一遍编码: {' '.join(cmd1)}")
+        await run_command(cmd1)
+        cmd = build_encode_command(input_path, output_path, plan, 2, passlog_prefix)
+    else:
+        cmd = build_encode_command(input_path, output_path, plan)
+    
+    logging.info(f"开始压缩视频: {' '.join(cmd)}")
+    await run_command(cmd)
+
+async def split_at_keyframes(input_path, segment_dir, segment_seconds, duration_limit=None):
+    """
+    在关键帧处将视频切分为若干片段（流复制，不重新编码）
+    
+    返回:
+        [(片段路径, 片段时长秒), ...]，按时间顺序排列
+    """
+    cmd = ['ffmpeg', '-i', input_path]
+    if duration_limit:
+        cmd += ['-t', str(duration_limit)]
+    cmd += [
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-c', 'copy',
+        '-f', 'segment',
+        '-segment_time', str(segment_seconds),
+        '-reset_timestamps', '1',
+        '-y', os.path.join(segment_dir, "segment_%03d.mp4")
+    ]
+    logging.info(f"开始切分视频: {' '.join(cmd)}")
+    await run_command(cmd)
+    
+    segments = []
+    for segment_path in sorted(glob.glob(os.path.join(segment_dir, "segment_*.mp4"))):
+        segment_info = await probe_media(segment_path)
+        segments.append((segment_path, segment_info.duration or 0.0))
+    return segments
+
+def allocate_segment_plans(plan, segments):
+    """
+    为每个片段分配码率，使拼接后的总大小仍符合目标
+    
+    整体预算按时长占比和源片段大小占比各一半分配：源码率高（画面复杂）的片段
+    获得更多比特，静态片段少分一些，同时避免任何片段的码率被压得过低。
+    """
+    total_duration = sum(duration for _, duration in segments) or 1
+    total_source_bytes = sum(os.path.getsize(path) for path, _ in segments) or 1
+    total_kbits = plan["video_bitrate_kbps"] * total_duration
+    
+    segment_plans = []
+    for path, duration in segments:
+        weight = 0.5 * duration / total_duration + 0.5 * os.path.getsize(path) / total_source_bytes
+        segment_plan = dict(plan)
+        if duration:
+            segment_kbps = total_kbits * weight / duration
+            segment_plan["video_bitrate_kbps"] = int(min(max(segment_kbps, MIN_VIDEO_BITRATE_KBPS // 2), MAX_VIDEO_BITRATE_KBPS))
+        segment_plan["duration_limit"] = None  # 截取已在切分时完成
+        segment_plans.append(segment_plan)
+    return segment_plans
+
+async def encode_segmented(segments, output_path, plan, two_pass=False):
+    """
+    并发编码所有片段后使用concat demuxer无损拼接
+    
+    各片段作为独立的ffmpeg任务提交给转码执行器，并发度由执行器槽位数决定。
+    """
+    segment_plans = allocate_segment_plans(plan, segments)
+    encoded_paths = [path.replace("segment_", "encoded_") for path, _ in segments]
+    
+    await asyncio.gather(*(
+        encode_with_plan(path, encoded_path, segment_plan, two_pass, path + ".passlog")
+        for (path, _), encoded_path, segment_plan in zip(segments, encoded_paths, segment_plans)
+    ))
+    
+    # 生成concat列表并拼接
+    list_path = os.path.join(os.path.dirname(encoded_paths[0]), "concat.txt")
+    with open(list_path, 'w') as f:
+        for encoded_path in encoded_paths:
+            f.write(f"file '{encoded_path}'\n")
+    
+    cmd = [
+        'ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_path,
+        '-c', 'copy',
+        '-movflags', '+faststart',
+        '-y', output_path
+    ]
+    logging.info(f"开始拼接 {len(encoded_paths)} 个片段: {' '.join(cmd)}")
+    await run_command(cmd)
+
+def compression_profile(two_pass):
+    """压缩结果缓存键中的编码配置"""
+    return f"x264-{'2pass' if two_pass else '1pass'}-v{COMPRESS_PROFILE_VERSION}"
+
+async def compress_video(input_path, output_path, target_size_mb=19, max_width=1280, two_pass=COMPRESS_TWO_PASS, info=None):
     """
     使用ffmpeg压缩视频文件到指定大小以下，并确保与Gemini API兼容
     
+    编码前先按源文件内容和编码参数查找转码缓存，命中时直接使用之前的压缩结果；
+    编码成功后将结果和消耗的CPU时间写入缓存。
+    
     参数:
-        video_bytes: 原始视频数据
+        input_path: 原始视频文件路径
+        output_path: 压缩结果文件路径（中间文件也写在同一目录下）
         target_size_mb: 目标大小（MB）
         max_width: 最大宽度（像素）
-        quality: 质量参数（CRF值，越小质量越高，范围通常是18-28）
+        two_pass: 是否使用两遍编码
+        info: 调用方已获得的 MediaInfo，为None时在此探测
         
     返回:
-        compressed_bytes: 压缩后的视频数据
+        压缩后的视频文件路径；如果原视频已小于目标大小则直接返回 input_path；失败返回 None
     """
-    if not video_bytes:
+    if not input_path or not os.path.exists(input_path):
         return None
     
-    # 创建输入临时文件
-    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as input_file:
-        input_path = input_file.name
-        input_file.write(video_bytes)
+    original_size_mb = os.path.getsize(input_path) / (1024 * 1024)
+    if original_size_mb <= target_size_mb:
+        logging.info(f"视频已经小于目标大小({target_size_mb}MB)，不需要压缩")
+        return input_path
+    
+    cache_key = None
+    if transcode_cache.enabled:
+        source_hash = await content_hash(input_path)
+        cache_key = transcode_cache.key_for(source_hash, target_size_mb, max_width, compression_profile(two_pass))
+        if await transcode_cache.fetch(cache_key, output_path):
+            return output_path
     
-    # 创建输出临时文件
-    output_fd, output_path = tempfile.mkstemp(suffix='.mp4')
-    os.close(output_fd)
+    with measure_cpu() as meter:
+        result = await encode_to_target(input_path, output_path, target_size_mb, max_width, two_pass, info)
+    logging.info(f"视频压缩消耗 {meter.seconds:.1f} CPU秒")
+    
+    if result and cache_key:
+        await transcode_cache.store(cache_key, result, meter.seconds)
+    return result
+
+async def encode_to_target(input_path, output_path, target_size_mb, max_width, two_pass, info=None):
+    """
+    编码视频使其不超过目标大小
+    
+    由目标大小和视频时长直接计算码率，通常一次编码即可得到符合大小的文件；
+    two_pass=True 时使用两遍编码以获得更准确的大小。只有输出仍超出目标时，
+    才按实际超出比例修正码率再编码一次。
+    大视频会先在关键帧处切分，各片段并发编码后再拼接，编码耗时随CPU核数缩短。
+    
+    参数:
+        input_path: 原始视频文件路径
+        output_path: 压缩结果文件路径（中间文件也写在同一目录下）
+        target_size_mb: 目标大小（MB）
+        max_width: 最大宽度（像素）
+        two_pass: 是否使用两遍编码
+        info: 调用方已获得的 MediaInfo，为None时在此探测
+        
+    返回:
+        压缩后的视频文件路径，失败返回 None
+    """
+    original_size_mb = os.path.getsize(input_path) / (1024 * 1024)
+    output_dir = os.path.dirname(output_path)
+    passlog_prefix = os.path.join(output_dir, "x264_passlog")
+    segment_dir = os.path.join(output_dir, "segments")
+    
+    try:
+        if info is None:
+            info = await probe_media(input_path, need_video_info=True)
+            logging.info(f"视频信息: {info}")
+        
+        if not info.duration:
+            logging.warning("无法获取视频时长，回退到逐级压缩方案")
+            return await compress_video_cascade(input_path, output_path, target_size_mb, max_width)
+        
+        plan = plan_compression(info, target_size_mb, max_width)
+        logging.info(f"压缩方案: {plan}")
+        
+        # 大视频切分后并发编码
+        segments = None
+        encode_duration = plan["duration_limit"] or info.duration
+        slots = transcode_executor.slots
+        if original_size_mb >= SEGMENT_MIN_SIZE_MB and slots > 1 and encode_duration >= SEGMENT_MIN_SECONDS * 2:
+            segment_seconds = max(SEGMENT_MIN_SECONDS, math.ceil(encode_duration / slots))
+            os.makedirs(segment_dir, exist_ok=True)
+            segments = await split_at_keyframes(input_path, segment_dir, segment_seconds, plan["duration_limit"])
+            logging.info(f"视频已切分为 {len(segments)} 个片段 (每段约 {segment_seconds} 秒)，将并发编码")
+            if len(segments) < 2:
+                segments = None
+        
+        for attempt in range(2):
+            if segments:
+                await encode_segmented(segments, output_path, plan, two_pass)
+            else:
+                await encode_with_plan(input_path, output_path, plan, two_pass, passlog_prefix)
+            
+            output_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+            logging.info(f"压缩后视频大小: {output_size_mb:.2f}MB (目标 {target_size_mb}MB)")
+            
+            if output_size_mb <= target_size_mb * SIZE_TOLERANCE or attempt == 1:
+                break
+            
+            # 码率控制偏差导致超出目标，按超出比例降低视频码率后重新编码一次
+            ratio = target_size_mb / output_size_mb * 0.95
+            corrected_kbps = max(int(plan["video_bitrate_kbps"] * ratio), MIN_VIDEO_BITRATE_KBPS // 2)
+            logging.info(f"输出超出目标大小，视频码率修正为 {corrected_kbps}k 后重新编码")
+            plan["video_bitrate_kbps"] = corrected_kbps
+        
+        return output_path
+    
+    except Exception as e:
+        logging.error(f"压缩视频时出错: {e}")
+        return None
+    
+    finally:
+        # 清理两遍编码的统计文件和切分片段
+        for path in glob.glob(passlog_prefix + "*"):
+            try:
+                os.unlink(path)
+            except Exception as e:
+                logging.error(f"清理临时文件时出错: {e}")
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+async def compress_video_cascade(input_path, output_path, target_size_mb=19, max_width=1280, quality=23):
+    """
+    使用ffmpeg压缩视频文件到指定大小以下（旧的CRF逐级重试方案）
+    
+    根据文件大小猜测CRF，压缩后检查大小，必要时最多再以更激进的参数压缩两次。
+    compress_video 无法获取视频时长时回退到此方案，同时保留用于基准测试对比。
+    
+    参数:
+        input_path: 原始视频文件路径
+        output_path: 压缩结果文件路径（中间文件也写在同一目录下）
+        target_size_mb: 目标大小（MB）
+        max_width: 最大宽度（像素）
+        quality: 质量参数（CRF值，越小质量越高，范围通常是18-28）
+        
+    返回:
+        压缩后的视频文件路径；如果原视频已小于目标大小则直接返回 input_path；失败返回 None
+    """
+    if not input_path or not os.path.exists(input_path):
+        return None
+    
+    # 中间文件与输出文件放在同一目录下，由调用方的工作目录统一管理
+    output_dir = os.path.dirname(output_path)
+    intermediate_paths = []
     
     try:
         # 获取视频信息
@@ -45,14 +394,13 @@ async def compress_video(video_bytes, target_size_mb=19, max_width=1280, quality
         logging.info(f"视频信息: {probe_result}")
         
         # 计算当前视频大小（MB）
-        original_size_mb = len(video_bytes) / (1024 * 1024)
+        original_size_mb = os.path.getsize(input_path) / (1024 * 1024)
         logging.info(f"原始视频大小: {original_size_mb:.2f}MB")
         
         # 如果已经小于目标大小，不需要压缩
         if original_size_mb <= target_size_mb:
             logging.info(f"视频已经小于目标大小({target_size_mb}MB)，不需要压缩")
-            os.unlink(output_path)
-            return video_bytes
+            return input_path
         
         # 设定压缩参数，根据原始大小动态调整
         if original_size_mb > 100:
@@ -63,6 +411,9 @@ async def compress_video(video_bytes, target_size_mb=19, max_width=1280, quality
             quality = 26
             max_width = 854  # 480p
         
+        first_output_path = os.path.join(output_dir, "compress_pass1.mp4")
+        intermediate_paths.append(first_output_path)
+        
         # 确保帧率不超过30fps，降低视频复杂度
         # 使用yuv420p像素格式，确保最广泛的兼容性
         # 使用改进的编解码器选项来提高兼容性
@@ -80,16 +431,17 @@ async def compress_video(video_bytes, target_size_mb=19, max_width=1280, quality
             '-level', '3.0',  # 限制复杂度级别
             '-c:a', 'aac',
             '-b:a', '96k',
-            '-y', output_path
+            '-y', first_output_path
         ]
         
         logging.info(f"开始压缩视频: {' '.join(cmd)}")
         
         # 执行ffmpeg命令
         await run_command(cmd)
+        result_path = first_output_path
         
         # 检查输出文件大小
-        output_size = os.path.getsize(output_path)
+        output_size = os.path.getsize(result_path)
         output_size_mb = output_size / (1024 * 1024)
         
         logging.info(f"压缩后视频大小: {output_size_mb:.2f}MB")
@@ -97,12 +449,12 @@ async def compress_video(video_bytes, target_size_mb=19, max_width=1280, quality
         # 如果压缩后仍然太大，可以尝试第二次压缩（更激进）
         if output_size_mb > target_size_mb:
             logging.info(f"第一次压缩后视频仍然太大，尝试更激进的压缩")
-            second_output_fd, second_output_path = tempfile.mkstemp(suffix='.mp4')
-            os.close(second_output_fd)
+            second_output_path = os.path.join(output_dir, "compress_pass2.mp4")
+            intermediate_paths.append(second_output_path)
             
             # 更激进的压缩 - 降低分辨率、降低帧率、提高压缩比
             cmd2 = [
-                'ffmpeg', '-i', output_path,
+                'ffmpeg', '-i', result_path,
                 '-c:v', 'libx264',
                 '-crf', str(quality + 6),  # 更高的CRF，质量更低
                 '-preset', 'ultrafast',  # 最快速预设
@@ -123,21 +475,21 @@ async def compress_video(video_bytes, target_size_mb=19, max_width=1280, quality
             await run_command(cmd2)
             
             # 删除第一次的输出
-            os.unlink(output_path)
-            output_path = second_output_path
+            os.unlink(result_path)
+            result_path = second_output_path
             
-            output_size = os.path.getsize(output_path)
+            output_size = os.path.getsize(result_path)
             output_size_mb = output_size / (1024 * 1024)
             logging.info(f"第二次压缩后视频大小: {output_size_mb:.2f}MB")
             
             # 如果仍然太大，尝试最后的方法 - 截取视频前30秒
             if output_size_mb > target_size_mb:
                 logging.info("视频仍然太大，尝试截取前30秒")
-                third_output_fd, third_output_path = tempfile.mkstemp(suffix='.mp4')
-                os.close(third_output_fd)
+                third_output_path = os.path.join(output_dir, "compress_pass3.mp4")
+                intermediate_paths.append(third_output_path)
                 
                 cmd3 = [
-                    'ffmpeg', '-i', output_path,
+                    'ffmpeg', '-i', result_path,
                     '-ss', '0',  # 从开始
                     '-t', '30',  # 截取30秒
                     '-c:v', 'libx264',
@@ -159,49 +511,86 @@ async def compress_video(video_bytes, target_size_mb=19, max_width=1280, quality
                 await run_command(cmd3)
                 
                 # 删除第二次的输出
-                os.unlink(output_path)
-                output_path = third_output_path
+                os.unlink(result_path)
+                result_path = third_output_path
                 
-                output_size = os.path.getsize(output_path)
+                output_size = os.path.getsize(result_path)
                 output_size_mb = output_size / (1024 * 1024)
                 logging.info(f"截取后视频大小: {output_size_mb:.2f}MB")
         
-        # 读取压缩后的视频
-        with open(output_path, 'rb') as f:
-            compressed_bytes = f.read()
-        
-        # 返回压缩后的视频数据
-        return compressed_bytes
+        # 将最终结果移动到调用方指定的输出路径（同一文件系统内的重命名，不复制数据）
+        os.replace(result_path, output_path)
+        return output_path
     
     except Exception as e:
         logging.error(f"压缩视频时出错: {e}")
         return None
     
     finally:
-        # 清理临时文件
-        try:
-            if os.path.exists(input_path):
-                os.unlink(input_path)
-            if os.path.exists(output_path):
-                os.unlink(output_path)
-        except Exception as e:
-            logging.error(f"清理临时文件时出错: {e}")
+        # 清理残留的中间文件
+        for path in intermediate_paths:
+            try:
+                if os.path.exists(path):
+                    os.unlink(path)
+            except Exception as e:
+                logging.error(f"清理临时文件时出错: {e}")
 
-async def run_command(cmd):
+async def run_command(cmd, priority=PRIORITY_VIDEO, timeout=TRANSCODE_TIMEOUT):
     """
     异步执行命令行命令
+    
+    ffmpeg 通过全局转码执行器按优先级排队执行；ffprobe 开销很小，直接执行。
+    
+    参数:
+        cmd: 命令参数列表
+        priority: ffmpeg任务优先级（PRIORITY_AUDIO / PRIORITY_FRAMES / PRIORITY_VIDEO）
+        timeout: 超时时间（秒），超时后终止进程
     """
-    process = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
+    if cmd[0] == 'ffmpeg':
+        returncode, stdout, stderr = await transcode_executor.run(cmd, priority, timeout)
+    else:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            process.kill()
+            await process.wait()
+            raise
+        returncode = process.returncode
+    
+    if returncode != 0:
+        error_msg = stderr.decode('utf-8', errors='replace')
+        logging.error(f"命令执行失败 (代码 {returncode}): {error_msg}")
+        raise Exception(f"命令执行失败: {error_msg}")
+    
+    return stdout.decode('utf-8', errors='replace')
+
+async def run_command_piped(cmd, input_data=None, input_path=None, output_path=None,
+                            priority=PRIORITY_AUDIO, timeout=TRANSCODE_TIMEOUT, max_output_bytes=None):
+    """
+    通过管道异步执行命令：输入写入标准输入（pipe:0），输出从标准输出读取（pipe:1）
     
-    stdout, stderr = await process.communicate()
+    参数:
+        cmd: 命令参数列表
+        input_data: 写入标准输入的字节数据
+        input_path: 分块写入标准输入的文件路径
+        output_path: 标准输出写入的文件路径，为None时返回输出的字节数据
+        priority: 任务优先级
+        timeout: 超时时间（秒）
+        max_output_bytes: 输出字节数上限
+    """
+    returncode, stdout, stderr = await transcode_executor.run_piped(
+        cmd, input_data, input_path, output_path, priority, timeout, max_output_bytes
+    )
     
-    if process.returncode != 0:
+    if returncode != 0:
         error_msg = stderr.decode('utf-8', errors='replace')
-        logging.error(f"命令执行失败 (代码 {process.returncode}): {error_msg}")
+        logging.error(f"命令执行失败 (代码 {returncode}): {error_msg}")
         raise Exception(f"命令执行失败: {error_msg}")
     
-    return stdout.decode('utf-8', errors='replace') 
\ No newline at end of file
+    return stdout
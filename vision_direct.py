@@ -0,0 +1,104 @@
+import os
+import time
+import asyncio
+import logging
+import fastapi_poe as fp
+from circuit_breaker import poe_breaker
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 图片分析模式（按媒体类型分别配置）：
+#   direct  - 图片作为附件直接发送给支持视觉的Poe机器人，一次流式回复
+#   two_hop - 先由Gemini生成图片描述，再把描述发送给Poe机器人
+# 默认沿用 two_hop；设为 direct 后，失败（如附件上传出错）时自动回退到 two_hop
+PHOTO_ANALYSIS_MODE = os.environ.get("PHOTO_ANALYSIS_MODE", "two_hop").lower()
+ALBUM_ANALYSIS_MODE = os.environ.get("ALBUM_ANALYSIS_MODE", "two_hop").lower()
+
+# 接收图片附件的视觉模型
+VISION_BOT_NAME = os.environ.get("VISION_BOT_NAME", "Claude-3.5-Sonnet")
+POE_API_KEY = os.environ.get("POE_API_KEY", "")
+
+# Poe附件上传接口（可替换为本地替身服务器用于测试）
+POE_UPLOAD_BASE_URL = os.environ.get("POE_UPLOAD_BASE_URL", "https://www.quora.com/poe_api/")
+ATTACHMENT_UPLOAD_TIMEOUT = float(os.environ.get("ATTACHMENT_UPLOAD_TIMEOUT", "30"))  # 秒
+
+# 直接发送与回退的统计
+vision_stats = {
+    "direct": 0,
+    "fallbacks": 0,
+    "upload_seconds": 0.0,
+}
+
+def use_direct_vision(image_count):
+    """
+    判断这次图片请求是否使用直接发送模式
+
+    参数:
+        image_count: 图片数量，多于1张按相册处理
+
+    返回:
+        bool
+    """
+    mode = ALBUM_ANALYSIS_MODE if image_count > 1 else PHOTO_ANALYSIS_MODE
+    return mode == "direct"
+
+def build_vision_prompt(caption, image_count):
+    """构建随图片附件一起发送的文字内容"""
+    if image_count > 1:
+        prompt = f"用户一次发送了一组图片（共{image_count}张，附件按发送顺序排列）。\n\n用户说明: {caption}\n\n"
+        prompt += "请根据图片和用户说明，详细回答用户的问题。如果用户没有特定问题，请逐张描述图片内容，并对这组图片的内容及其关联进行深入解读。"
+    else:
+        prompt = f"用户发送了一张图片。\n\n用户说明: {caption}\n\n"
+        prompt += "请根据图片和用户说明，详细回答用户的问题。如果用户没有特定问题，请对图片内容进行深入解读。"
+    return prompt + "请用中文回答。"
+
+async def upload_images(images_bytes, api_key):
+    """
+    并发将图片上传为Poe附件
+
+    参数:
+        images_bytes: 图片字节数据列表（按发送顺序）
+        api_key: Poe API密钥
+
+    返回:
+        fp.Attachment 列表，顺序与 images_bytes 一致
+    """
+    start_time = time.time()
+
+    async def upload(index, image_bytes):
+        return await asyncio.wait_for(
+            fp.upload_file(
+                file=bytes(image_bytes),
+                file_name=f"photo_{index + 1}.jpg",  # Telegram的photo均为JPEG
+                api_key=api_key,
+                base_url=POE_UPLOAD_BASE_URL,
+            ),
+            timeout=ATTACHMENT_UPLOAD_TIMEOUT,
+        )
+
+    # 上传耗时取决于图片大小，熔断器只统计成败；Poe熔断时直接失败，由调用方回退
+    async with poe_breaker.guard(timed=False):
+        attachments = await asyncio.gather(*(upload(index, image_bytes) for index, image_bytes in enumerate(images_bytes)))
+
+    upload_seconds = time.time() - start_time
+    vision_stats["upload_seconds"] += upload_seconds
+    logging.info(f"已上传 {len(attachments)} 张图片为Poe附件 ({sum(len(b) for b in images_bytes)} 字节, {upload_seconds:.2f} 秒)")
+    return attachments
+
+def build_vision_message(attachments, caption):
+    """
+    构建带图片附件的用户消息，可直接加入对话上下文发送给 VISION_BOT_NAME
+
+    参数:
+        attachments: upload_images 返回的附件列表
+        caption: 用户说明
+
+    返回:
+        fp.ProtocolMessage
+    """
+    return fp.ProtocolMessage(
+        role="user",
+        content=build_vision_prompt(caption, len(attachments)),
+        attachments=attachments,
+    )